@@ -4,23 +4,19 @@ Requires GraphicsMagic commands be installed.
 """
 from __future__ import print_function
 import os
+import sys
 import subprocess
 import re
 from collections import defaultdict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import filescan
 
 
-def dirlist(root_dir, ffilter='*.*'):
+def dirlist(root_dir, ffilter='*'):
     if not os.path.isdir(root_dir):
         raise OSError('Input directory %s does not exist' % root_dir)
 
-    result = []
-    root_dir = root_dir + os.sep + ffilter
-    dirargs = ['dir', root_dir, '/B', '/S', '/A:-D']
-    proc = subprocess.Popen(dirargs, shell=True, stdout=subprocess.PIPE, bufsize=1)
-    for dirline in iter(proc.stdout.readline, b''):
-        result.append(dirline.strip())
-    proc.communicate()
-    return result
+    return list(filescan.scan(root_dir, pattern=ffilter))
 
 
 def dimgrouping(files):
@@ -0,0 +1,220 @@
+"""
+Benchmark the loan page counters on a synthetic loan tree.
+
+Builds a tree of loan folders holding minimal valid pdfs with known page
+counts.  Each counter is then run as a separate process at each worker count,
+the same way it runs in production, and its -stats output is collected.
+Results go to <out>.csv and <out>.json: files/sec, pages/sec, and the scan,
+first result and count phase timings.  The counted totals are checked
+against the tree.
+
+    python counter_bench.py C:\\bench\\tree -loans 200 -files 40 -p 1,2,4,8
+    python counter_bench.py C:\\bench\\tree -reuse -engines mp,pipeline
+
+Engines:
+    serial      loanpdfcounter.py
+    mp          loanpdfcounterMP.py, size balanced batches
+    pipeline    loanpdfcounterMP.py -pipeline
+    cached      loanpdfcounterMP.py -pagecache, with the cache already warm
+
+The first engine run also warms the OS file cache.  Use -repeat to keep the
+best of several runs.
+"""
+from __future__ import print_function
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import random
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ENGINES = {'serial': ('loanpdfcounter.py', []),
+           'mp': ('loanpdfcounterMP.py', []),
+           'pipeline': ('loanpdfcounterMP.py', ['-pipeline']),
+           'cached': ('loanpdfcounterMP.py', ['-pagecache'])}
+REPORTS = {'loanpdfcounter.py': 'LoanPageReportI.csv',
+           'loanpdfcounterMP.py': 'LoanPageReportMP.csv'}
+
+
+def minimal_pdf(pages, padding=0):
+    """A valid pdf with a classic xref table, pages empty pages and about padding bytes of filler."""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [%s] /Count %d >>' %
+               (' '.join('%d 0 R' % (i + 3) for i in xrange(pages)), pages)]
+    objects.extend(['<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>'] * pages)
+    chunks = ['%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    if padding:
+        chunks.append(('%' + 'x' * 78 + '\n') * (padding // 80 + 1))
+    size = sum(len(c) for c in chunks)
+    offsets = []
+    for objnum, obj in enumerate(objects, 1):
+        offsets.append(size)
+        chunk = '%d 0 obj\n%s\nendobj\n' % (objnum, obj)
+        chunks.append(chunk)
+        size += len(chunk)
+    chunks.append('xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    chunks.extend('%010d 00000 n \n' % offset for offset in offsets)
+    chunks.append('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' %
+                  (len(objects) + 1, size))
+    return ''.join(chunks)
+
+
+def make_tree(root, loans=100, files=20, pages=(1, 50), depth=1, giant=0, padkb=0, seed=1138):
+    """
+    Write a synthetic loan tree under root.  Files per loan vary uniformly
+    around files, giant gives the first loan that many files instead (one
+    huge loan is what stalls per loan scheduling).  Loan folders sit depth - 1
+    grouping folders down.  Returns the tree's (file count, page count).
+    """
+    rand = random.Random(seed)
+    contents = {}
+    totalfiles = totalpages = 0
+    for loan in xrange(loans):
+        groups = ['B%02d' % ((loan // 10 ** level) % 10) for level in xrange(depth - 1, 0, -1)]
+        loandir = os.path.join(root, *(groups + ['LN%08d' % (10000000 + loan)]))
+        os.makedirs(loandir)
+        numfiles = giant if loan == 0 and giant else rand.randint(1, 2 * files - 1)
+        for filenum in xrange(numfiles):
+            key = (rand.randint(pages[0], pages[1]), rand.randint(0, padkb))
+            if key not in contents:
+                contents[key] = minimal_pdf(key[0], key[1] * 1024)
+            with open(os.path.join(loandir, 'doc%04d.pdf' % filenum), 'wb') as pdffh:
+                pdffh.write(contents[key])
+            totalfiles += 1
+            totalpages += key[0]
+    return totalfiles, totalpages
+
+
+def report_totals(reportpath):
+    with open(reportpath, 'rb') as reportfh:
+        for row in csv.reader(reportfh):
+            if row and row[0] == 'Totals':
+                return int(row[1]), int(row[2])
+    return None
+
+
+def run_engine(engine, root, workers, workdir):
+    """Run one counter process, returns its -stats dict plus the wall time seen from here."""
+    script, extra = ENGINES[engine]
+    statspath = os.path.join(workdir, 'stats.json')
+    cmd = [sys.executable, os.path.join(HERE, script), root, '-stats', statspath] + extra
+    if engine == 'cached':
+        cmd.append(os.path.join(workdir, 'pagecache.db'))
+    if script == 'loanpdfcounterMP.py':
+        cmd.extend(['-p', str(workers)])
+    start = time.time()
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.check_call(cmd, stdout=devnull, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    with open(statspath, 'rb') as statsfh:
+        stats = json.load(statsfh)
+    stats['wall_seconds'] = wall
+    stats['reported'] = report_totals(os.path.join(root, REPORTS[script]))
+    return stats
+
+
+def bench(root, engines, workercounts, expected, repeat=1):
+    workdir = tempfile.mkdtemp(prefix='counter_bench')
+    rows = []
+    try:
+        if 'cached' in engines:
+            run_engine('cached', root, max(workercounts), workdir)  # warm the page cache
+        for engine in engines:
+            for workers in ([1] if engine == 'serial' else workercounts):
+                best = None
+                for i in xrange(repeat):
+                    stats = run_engine(engine, root, workers, workdir)
+                    if best is None or stats['wall_seconds'] < best['wall_seconds']:
+                        best = stats
+                wall = best['wall_seconds']
+                row = {'engine': engine, 'workers': workers,
+                       'files': best['files'], 'pages': best['pages'], 'loans': best['loans'],
+                       'wall_seconds': round(wall, 3),
+                       'files_per_sec': round(best['files'] / wall, 1),
+                       'pages_per_sec': round(best['pages'] / wall, 1),
+                       'scan_seconds': round(best['scan_seconds'], 3),
+                       'first_result_seconds': (round(best['first_result_seconds'], 3)
+                                                if best['first_result_seconds'] is not None else None),
+                       'count_seconds': round(best['count_seconds'], 3),
+                       'correct': tuple(best['reported'] or ()) == tuple(expected)}
+                rows.append(row)
+                print('  %-9s p=%-3s %8.1f files/s %10.1f pages/s  scan %.2fs  first %.2fs  %s' %
+                      (engine, workers, row['files_per_sec'], row['pages_per_sec'],
+                       row['scan_seconds'], row['first_result_seconds'] or 0,
+                       'ok' if row['correct'] else 'WRONG TOTALS'))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+COLUMNS = ['engine', 'workers', 'files', 'pages', 'loans', 'wall_seconds', 'files_per_sec',
+           'pages_per_sec', 'scan_seconds', 'first_result_seconds', 'count_seconds', 'correct']
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the loan page counters')
+    parser.add_argument('treeroot', action='store',
+                        help='folder for the synthetic loan tree, replaced unless -reuse')
+    parser.add_argument('-reuse', action='store_true', default=False,
+                        help='benchmark the existing tree instead of building one, flag')
+    parser.add_argument('-loans', action='store', type=int, default=100,
+                        help='number of loan folders, default 100')
+    parser.add_argument('-files', action='store', type=int, default=20,
+                        help='average pdfs per loan, default 20')
+    parser.add_argument('-pages', action='store', default='1-50',
+                        help='page count range per pdf, default 1-50')
+    parser.add_argument('-depth', action='store', type=int, default=1,
+                        help='folder depth of the loan folders, default 1')
+    parser.add_argument('-giant', action='store', type=int, default=0,
+                        help='give the first loan this many pdfs')
+    parser.add_argument('-padkb', action='store', type=int, default=0,
+                        help='pad each pdf with up to this many KB, for a size spread')
+    parser.add_argument('-engines', action='store', default='serial,mp,pipeline,cached',
+                        help='comma separated engines to run, default all')
+    parser.add_argument('-p', action='store', default='1,2,4', dest='workercounts',
+                        help='comma separated worker counts, default 1,2,4')
+    parser.add_argument('-repeat', action='store', type=int, default=1,
+                        help='runs per engine and worker count, the best is kept')
+    parser.add_argument('-out', action='store', default='counter_bench',
+                        help='prefix for the csv and json results')
+    args = parser.parse_args()
+
+    engines = [e for e in args.engines.split(',') if e]
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error('unknown engine %s' % engine)
+    workercounts = [int(p) for p in args.workercounts.split(',') if p]
+    root = os.path.abspath(args.treeroot)
+
+    starttime = time.time()
+    if args.reuse:
+        expected = report_totals(os.path.join(root, 'bench_expected.csv'))
+    else:
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        minpages, maxpages = [int(p) for p in args.pages.split('-')]
+        expected = make_tree(root, args.loans, args.files, (minpages, maxpages),
+                             args.depth, args.giant, args.padkb)
+        with open(os.path.join(root, 'bench_expected.csv'), 'wb') as expectfh:
+            csv.writer(expectfh).writerow(['Totals'] + list(expected))
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('Tree: %s files, %s pages (%s)\n' % (expected[0], expected[1], ctime))
+
+    rows = bench(root, engines, workercounts, expected, args.repeat)
+
+    with open(args.out + '.csv', 'wb') as outfh:
+        writer = csv.writer(outfh)
+        writer.writerow(COLUMNS)
+        writer.writerows([[row[c] for c in COLUMNS] for row in rows])
+    with open(args.out + '.json', 'wb') as outfh:
+        json.dump({'tree': root, 'expected_files': expected[0], 'expected_pages': expected[1],
+                   'results': rows}, outfh, indent=1)
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('\ncomplete', ctime)
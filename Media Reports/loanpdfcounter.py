@@ -2,63 +2,89 @@
 #Scans an input directory for pdf loan files and produces a page count report.Scans
 from __future__ import print_function
 import sys
-import subprocess
 import os
 #import re
-import string
 from collections import defaultdict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import filescan
+import pdfpages
+import pagecache
+import loanrules
 
 
-def genfilelist(root, minlen=5, maxlen=200, foldonly=False):
+def genfilelist(root, minlen=5, maxlen=200, foldonly=False, cachepath=None, threads=1,
+                extractor=None):
     '''
     Returns a dict table of loan numbers and associated paths to pdfs for all pdfs found
     on the path root.  Loan numbers are extracted from the file path.  Maximum and minimum
-    loan number lengths to search for can me set.
+    loan number lengths to search for can me set.  cachepath and threads are passed to
+    the filescan directory walk.  A loanrules.LoanExtractor can be given for other
+    extraction rules, its ambiguous list holds the paths to review afterwards.
     '''
     loantable = defaultdict(list)
-    splitchars = list(string.ascii_letters) + list(string.punctuation) + list(string.whitespace)
-    try:
-        os.chdir(root)
-    except:
+    if not os.path.isdir(root):
         print("Error: target directory not found\n")
         sys.exit(1)
-    proc = subprocess.Popen(['dir', '*.pdf', '/S', '/B'],
-                            shell=True, stdout=subprocess.PIPE, bufsize=1)
-    for line in iter(proc.stdout.readline, b''):
-        fullpath = line
-        if foldonly is True:
-            line = os.sep.join(line.split(os.sep)[:-1])
-        possiblenums = set([num for num in splitbyl(line, splitchars)
-                            if minlen <= len(num) <= maxlen])
-        if len(possiblenums) < 1:
-            continue
-        #if there are multiple possible loan numbers pick the longest one.
-        loannum = sorted(possiblenums, key=lambda x: len(x), reverse=True)[0]
-        loantable[loannum].append(fullpath.strip())
-    proc.communicate()
+    cache = filescan.DirCache(cachepath) if cachepath is not None else None
+    for loannum, fullpath in iterloanfiles(root, minlen, maxlen, foldonly, cache, threads,
+                                           extractor):
+        loantable[loannum].append(fullpath)
+    if cache is not None:
+        cache.save()
     return loantable
 
 
-def countpages(loannum, pdflist):
+def iterloanfiles(root, minlen=5, maxlen=200, foldonly=False, cache=None, threads=1,
+                  extractor=None):
+    """Generate (loannum, pdfpath) as the scan finds them."""
+    root = os.path.abspath(root)
+    if extractor is None:
+        extractor = loanrules.LoanExtractor(minlen=minlen, maxlen=maxlen, foldonly=foldonly)
+    extractor.root = root
+    pdfpaths = filescan.scan(root, exts=['.pdf'], cache=cache, threads=threads)
+    return extractor.stream(pdfpaths)
+
+
+def count_file(pdfpath, cache=None):
+    """
+    Page count for one pdf, read in process by pdfpages.  pdfinfo is only run
+    for files it can't read (encrypted or damaged).  With a pagecache.PageCache
+    unchanged files aren't opened at all.  Raises pdfpages.PageCountError.
+    """
+    if cache is not None:
+        return cache.count(pdfpath)
+    return pdfpages.count_pages(pdfpath)
+
+
+def countpages(loannum, pdflist, cache=None):
     totaldocs = len(pdflist)
     totalpages = 0
     errorfiles = []
     for pdfpath in pdflist:
         try:
-            dump = subprocess.check_output(["pdfinfo", pdfpath], shell=True,
-                                            stderr=subprocess.STDOUT)
-            dumpsplit = dump.split()
-            totalpages += int(dumpsplit[dumpsplit.index('Pages:') + 1])
-        except subprocess.CalledProcessError:
+            totalpages += count_file(pdfpath, cache)
+        except pdfpages.PageCountError:
             errorfiles.append(pdfpath)
     return (loannum, totaldocs, totalpages, errorfiles)
 
 
-def splitbyl(txt, seps):
-    default_sep = seps[0]
-    for sep in seps[1:]:  # we skip seps[0] because that's the default seperator
-        txt = txt.replace(sep, default_sep)
-    return txt.split(default_sep)
+def write_ambiguous(csvpath, extractor):
+    """Write the paths with more than one possible loan number for review."""
+    import csv
+
+    with open(csvpath, 'wb') as outcsv:
+        report = csv.writer(outcsv, dialect='excel')
+        report.writerow(['Loan Number', 'Rule', 'Candidates', 'Path'])
+        for path, loannum, rulename, candidates in extractor.ambiguous:
+            report.writerow([loannum, rulename, ' '.join(candidates), path])
+
+
+def write_stats(statspath, stats):
+    """Write run timings and totals as json, for counter_bench.py."""
+    import json
+
+    with open(statspath, 'wb') as statsfh:
+        json.dump(stats, statsfh, indent=1, sort_keys=True)
 
 
 if __name__ == '__main__':
@@ -66,26 +92,51 @@ if __name__ == '__main__':
 
     import csv
     import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description=
+                        'Count pdf pages in loan files and produce a by loan report')
+    parser.add_argument('rootpath', action='store',
+                        help='folder root to search for pdfs')
+    parser.add_argument('-pagecache', action='store', default=None,
+                        help='page count cache file, unchanged pdfs are not recounted')
+    parser.add_argument('-hash', action='store_true', default=False, dest='usehash',
+                        help='verify cached counts by content hash, slower, flag')
+    parser.add_argument('-rule', action='append', default=None, dest='rules',
+                        help='loan number rule, repeat to try several in order, see loanrules.py')
+    parser.add_argument('-stats', action='store', default=None,
+                        help='write run timings and totals to this json file')
+    args = parser.parse_args()
+    statspath = os.path.abspath(args.stats) if args.stats else None
 
     starttime = time.time()
     results = []
-    rootpath = sys.argv[1]
-    pdftable = genfilelist(rootpath)
+    rootpath = args.rootpath
+    extractor = loanrules.LoanExtractor(args.rules)
+    pdftable = genfilelist(rootpath, extractor=extractor)
+    cache = pagecache.PageCache(args.pagecache, args.usehash) if args.pagecache else None
 
-    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    scanend = time.time()
+    ctime = '%d:%.1f' % divmod(scanend - starttime, 60)
     print('Dir listing complete:', ctime, '\n')
 
     loancnt = len(pdftable)
     progcnt = 0
 
     for loan, pdflist in pdftable.viewitems():
-        out = countpages(loan, pdflist)
+        out = countpages(loan, pdflist, cache)
         results.append(out)
+        if progcnt == 0:
+            firstresult = time.time()
         progcnt += 1
         print('%s / %s counted' % (progcnt, loancnt), end='\r')
 
-    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    countend = time.time()
+    ctime = '%d:%.1f' % divmod(countend - starttime, 60)
     print('Count complete:', ctime)
+    if cache is not None:
+        cache.close()
+        print(cache.report())
 
     totalpdfs = sum([x[1] for x in results])
     totalpages = sum([x[2] for x in results])
@@ -101,6 +152,18 @@ if __name__ == '__main__':
         report = csv.writer(outcsv, dialect='excel')
         report.writerow(['Loan Number', 'File Count', 'Page Count'])
         report.writerows(results)
+    if extractor.ambiguous:
+        write_ambiguous('LoanAmbiguousI.csv', extractor)
+        print('%s files with ambiguous loan numbers, see LoanAmbiguousI.csv' %
+              len(extractor.ambiguous))
+
+    if statspath is not None:
+        write_stats(statspath, {'mode': 'serial', 'workers': 1, 'loans': loancnt,
+                                'files': totalpdfs, 'pages': totalpages,
+                                'scan_seconds': scanend - starttime,
+                                'first_result_seconds': (firstresult - starttime) if loancnt else None,
+                                'count_seconds': countend - scanend,
+                                'total_seconds': time.time() - starttime})
 
     ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
     print('Complete:', ctime)
\ No newline at end of file
@@ -4,10 +4,30 @@ import loanpdfcounter as lpc
 import sys
 import multiprocessing
 import os
+import time
+import json
+import signal
+import sqlite3
+import Queue
+import threading
+from collections import defaultdict
 
+BATCHES_PER_WORKER = 8  # smaller batches balance better, larger ones cost less queue traffic
+MAX_BATCH_FILES = 200
+PIPELINE_BATCH_FILES = 25
+PIPELINE_BATCH_SECONDS = 1.0  # queue a partial batch when the scan is slow to fill it
+PIPELINE_QUEUE_BATCHES = 4  # per worker, how far the scan may run ahead of the counting
+PIPELINE_PUT_WAIT = 0.5  # seconds between checks for a stop while the work queue is full
 
-class Worker(multiprocessing.Process):
 
+class Worker(multiprocessing.Process):
+    """
+    Counts batches of (loannum, pdfpath) from workq.  Each result is
+    (batchno, [(loannum, pdfpath, pages or None)], worker name, start, end).
+    On the poison pill it sends (None, (cache hits, cache misses), worker
+    name, None, None) as its last message.  If the page cache fails (a
+    locked or unreachable database) the worker carries on without it.
+    """
     def __init__(self, workq, resultq, args):
         super(Worker, self).__init__()
         self.workq = workq
@@ -15,33 +35,336 @@ class Worker(multiprocessing.Process):
         self.args = args
 
     def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles Ctrl-C and stops us
+        cache = None
+        hits = misses = 0  # from a cache given up on
+        if self.args.pagecache is not None:
+            try:
+                cache = lpc.pagecache.PageCache(self.args.pagecache, self.args.usehash)
+            except sqlite3.Error as e:
+                self._cache_failed(e)
         while True:
-            loannum, pdflist = self.workq.get()
-            if loannum is None:  # the poison pill
+            batchno, batch = self.workq.get()
+            if batchno is None:  # the poison pill
                 if self.args.debug:
                     self.args.stdout_lock.acquire()
                     print('%s: Exiting' % self.name)
                     self.args.stdout_lock.release()
-                self.workq.task_done()
+                if cache is not None:
+                    hits += cache.hits
+                    misses += cache.misses
+                    try:
+                        cache.close()
+                    except sqlite3.Error as e:
+                        self._cache_failed(e)
+                self.resultq.put((None, (hits, misses), self.name, None, None))
                 break
             if self.args.debug:
                 self.args.stdout_lock.acquire()
-                print('%s counting %s: %s' % (self.name, loannum, self.workq.qsize()))
-                self.args.stdout_lock.release()
-            else:
-                self.args.stdout_lock.acquire()
-                print('  %s / %s loans counted' %
-                     (self.resultq.qsize(), self.args.loancnt), end='\r')
+                print('%s counting batch %s, %s files' % (self.name, batchno, len(batch)))
                 self.args.stdout_lock.release()
-            out = lpc.countpages(loannum, pdflist)
-            self.workq.task_done()
-            self.resultq.put(out)
+            start = time.time()
+            counted = []
+            for loannum, pdfpath in batch:
+                try:
+                    try:
+                        pages = lpc.count_file(pdfpath, cache)
+                    except sqlite3.Error as e:  # count it as a miss and stop using the cache
+                        self._cache_failed(e)
+                        hits += cache.hits
+                        misses += cache.misses
+                        cache = None
+                        pages = lpc.count_file(pdfpath)
+                except lpc.pdfpages.PageCountError:
+                    pages = None
+                counted.append((loannum, pdfpath, pages))
+            self.resultq.put((batchno, counted, self.name, start, time.time()))
         return
 
+    def _cache_failed(self, e):
+        self.args.stdout_lock.acquire()
+        print('\n  %s: page cache error, continuing without it: %s' % (self.name, e))
+        self.args.stdout_lock.release()
+
+
+class Checkpoint(object):
+    """
+    Append only record of counted files, one json list of
+    [loannum, pdfpath, pages or null] per finished batch, so an interrupted
+    run can be resumed.  Batches finish long before the loans they belong to,
+    so this keeps far more of an interrupted run than recording whole loans.
+    Loaded counts are in done, pdfpath -> (loannum, pages).  Paths are byte
+    strings in whatever encoding the filesystem gave, so they go through
+    json as latin-1, which maps every byte to a character and back.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.batches = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as checkfh:
+                for line in checkfh:
+                    try:
+                        counted = json.loads(line)
+                    except ValueError:  # a line cut short by the interruption
+                        continue
+                    for loannum, pdfpath, pages in counted:
+                        self.done[pdfpath.encode('latin-1')] = (loannum.encode('latin-1'), pages)
+        self.checkfh = open(path, 'ab')
+
+    def add(self, counted):
+        self.checkfh.write(json.dumps(counted, encoding='latin-1') + '\n')
+        self.checkfh.flush()
+        self.batches += 1
+
+    def close(self):
+        self.checkfh.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def make_batches(pdftable, num_workers):
+    """
+    Split every loan's pdfs into size balanced batches of (loannum, pdfpath),
+    largest files first so the long counts start early and the small ones
+    fill in at the end.  A loan can be spread over any number of batches.
+    """
+    files = []
+    for loannum, pdflist in pdftable.viewitems():
+        for pdfpath in pdflist:
+            try:
+                size = os.path.getsize(pdfpath)
+            except OSError:
+                size = 0
+            files.append((size, loannum, pdfpath))
+    files.sort(reverse=True)
+    target = max(sum(f[0] for f in files) // (num_workers * BATCHES_PER_WORKER), 1)
+    batches = []
+    batch = []
+    batchbytes = 0
+    for size, loannum, pdfpath in files:
+        batch.append((loannum, pdfpath))
+        batchbytes += size
+        if batchbytes >= target or len(batch) >= MAX_BATCH_FILES:
+            batches.append(batch)
+            batch = []
+            batchbytes = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class LoanTotals(object):
+    """
+    Regroups (loannum, pdfpath, pages or None) file counts into per loan
+    (loannum, totaldocs, totalpages, errorfiles) like lpc.countpages.
+    pdftable can still be growing while a pipelined scan runs, the per loan
+    results are only final once it is complete.
+    """
+    def __init__(self, pdftable):
+        self.pdftable = pdftable
+        self.totals = defaultdict(lambda: [0, [], 0])  # pages, error files, files counted
+        self.counted = 0
+
+    def add(self, loannum, pdfpath, pages):
+        total = self.totals[loannum]
+        if pages is None:
+            total[1].append(pdfpath)
+        else:
+            total[0] += pages
+        total[2] += 1
+        self.counted += 1
+
+    def result(self, loannum):
+        pages, errorfiles, counted = self.totals[loannum]
+        return (loannum, len(self.pdftable[loannum]), pages, errorfiles)
+
+    def incomplete(self):
+        return [loannum for loannum, pdflist in self.pdftable.iteritems()
+                if loannum not in self.totals or self.totals[loannum][2] < len(pdflist)]
+
+    def results(self):
+        return [self.result(loannum) for loannum in self.pdftable]
+
+
+class ScanFeeder(threading.Thread):
+    """
+    Pipelined mode: queues batches of (loannum, pdfpath) while the scan is
+    still finding them, so counting starts with the first files found.
+    workq is bounded, a scan that gets ahead of the counting waits here
+    instead of filling memory.  Builds pdftable as it goes and sends the
+    poison pills once the scan is done.  Files with counts in done (from a
+    checkpoint) are kept in resumed instead of being queued.
+
+    The scan itself runs in a second thread so a partial batch is queued
+    after PIPELINE_BATCH_SECONDS even while the scan is stalled.  Setting
+    stop, or every worker dying, ends the feeder instead of leaving it
+    blocked on the full queue; scancomplete is False if it ended that way.
+    """
+    def __init__(self, workq, loanfiles, workers, done=None):
+        super(ScanFeeder, self).__init__()
+        self.daemon = True  # don't hold up the exit if interrupted while blocked on a full queue
+        self.workq = workq
+        self.loanfiles = loanfiles
+        self.workers = workers
+        self.done = done or {}
+        self.stop = threading.Event()
+        self.found = Queue.Queue(maxsize=PIPELINE_BATCH_FILES)
+        self.pdftable = defaultdict(list)
+        self.batches = []  # file count of each queued batch
+        self.resumed = []
+        self.scanend = None
+        self.scancomplete = False
+        self.error = None
+
+    def _scan(self):
+        try:
+            for found in self.loanfiles:
+                if not self._send(self.found, found):
+                    return  # stopped
+            self.scancomplete = True
+        except Exception as e:  # reported by the main thread
+            self.error = e
+        self.scanend = time.time()
+        self._send(self.found, None)
+
+    def run(self):
+        scanner = threading.Thread(target=self._scan, name='Scanner')
+        scanner.daemon = True
+        scanner.start()
+        try:
+            batch = []
+            batchstart = None
+            while not self.stop.is_set():
+                if batch:
+                    wait = PIPELINE_BATCH_SECONDS - (time.time() - batchstart)
+                    if wait <= 0:
+                        self._put(batch)
+                        batch = []
+                        continue
+                else:
+                    wait = PIPELINE_PUT_WAIT
+                try:
+                    found = self.found.get(timeout=wait)
+                except Queue.Empty:
+                    continue
+                if found is None:  # the scan is done
+                    if batch:
+                        self._put(batch)
+                    break
+                loannum, pdfpath = found
+                self.pdftable[loannum].append(pdfpath)
+                if pdfpath in self.done:
+                    self.resumed.append((loannum, pdfpath, self.done[pdfpath][1]))
+                    continue
+                if not batch:
+                    batchstart = time.time()
+                batch.append((loannum, pdfpath))
+                if len(batch) >= PIPELINE_BATCH_FILES:
+                    self._put(batch)
+                    batch = []
+        except Exception as e:  # reported by the main thread, the workers still need their pills
+            self.error = e
+        finally:
+            for i in xrange(len(self.workers)):
+                if not self._send(self.workq, (None, None)):
+                    break
+
+    def _send(self, queue, item):
+        """
+        put that gives up, returning False, once stop is set or every
+        worker has died, so a full queue can't block the feeder for good.
+        """
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=PIPELINE_PUT_WAIT)
+                return True
+            except Queue.Full:
+                if not any(w.is_alive() for w in self.workers):
+                    self.stop.set()
+        return False
+
+    def _put(self, batch):
+        if self._send(self.workq, (len(self.batches), batch)):
+            self.batches.append(len(batch))
+
+
+def collect(workers, resultq, tally, checkpoint=None, batches=(), debug=False):
+    """
+    Read results until every worker has sent its done message, each batch
+    goes to the checkpoint as it arrives.  A worker that dies without
+    a done message is reported and not waited for.  Returns
+    (batch timings, cache hits, cache misses).
+    """
+    running = dict((w.name, w) for w in workers)
+    timings = []
+    hits = misses = 0
+    while running:
+        try:
+            batchno, counted, workername, batchstart, batchend = resultq.get(timeout=1)
+        except Queue.Empty:
+            for name, w in running.items():
+                if w.exitcode not in (None, 0):
+                    print('\n  %s died with exit code %s, its batch is not counted' %
+                          (name, w.exitcode))
+                    del running[name]
+            continue
+        if batchno is None:
+            hits += counted[0]
+            misses += counted[1]
+            running.pop(workername, None)
+            continue
+        timings.append((workername, batchstart, batchend))
+        if checkpoint is not None:
+            checkpoint.add(counted)
+        for loannum, pdfpath, pages in counted:
+            tally.add(loannum, pdfpath, pages)
+        if not debug:
+            print('  %s / %s batches counted, %s files' %
+                  (len(timings), len(batches), tally.counted), end='\r')
+    return timings, hits, misses
+
+
+def stop_workers(workers, workq):
+    for w in workers:
+        if w.is_alive():
+            w.terminate()
+    for w in workers:
+        w.join()
+    workq.cancel_join_thread()  # unsent batches would otherwise block the exit
+
+
+def schedule_report(timings, countstart, countend):
+    """
+    Worker utilization and tail latency from (worker name, start, end) batch timings.
+    The tail is the time from the first worker running out of work to the end.
+    """
+    wall = max(countend - countstart, 1e-9)
+    busy = defaultdict(float)
+    lastend = {}
+    for name, start, end in timings:
+        busy[name] += end - start
+        lastend[name] = max(lastend.get(name, 0), end)
+    lines = ['Worker utilization:']
+    for name in sorted(busy):
+        lines.append('  %s %5.1f%% busy, %s batches' %
+                     (name, 100.0 * busy[name] / wall, sum(1 for t in timings if t[0] == name)))
+    lines.append('  overall %.1f%%' % (100.0 * sum(busy.values()) / (wall * max(len(busy), 1))))
+    durations = sorted(end - start for name, start, end in timings)
+    if durations:
+        lines.append('Batch seconds: median %.2f, 95th %.2f, max %.2f' %
+                     (durations[len(durations) // 2],
+                      durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+                      durations[-1]))
+        lines.append('Tail latency: %.2fs of %.2fs with idle workers' %
+                     (countend - min(lastend.values()), wall))
+    return '\n'.join(lines)
+
 
 if __name__ == '__main__':
     import csv
-    import time
     import argparse
     import itertools
 
@@ -55,54 +378,143 @@ if __name__ == '__main__':
                         help='maximum length of loan number to find')
     parser.add_argument('-folder', action='store_true', default=False,
                         help='ignore filename for finding loan numbers, flag')
+    parser.add_argument('-rule', action='append', default=None, dest='rules',
+                        help='loan number rule, repeat to try several in order, see loanrules.py')
     parser.add_argument('-p', action='store', dest='num_workers',
                         type=int, default=multiprocessing.cpu_count(),
                         help='number of concurrent processes, default core count')
     parser.add_argument('-debug', action='store_true', default=False,
                         help='print verbose debug output, flag')
+    parser.add_argument('-scancache', action='store', default=None,
+                        help='directory listing cache file, unchanged folders are not relisted')
+    parser.add_argument('-scanthreads', action='store', type=int, default=1,
+                        help='threads walking the top level folders, default 1')
+    parser.add_argument('-pagecache', action='store', default=None,
+                        help='page count cache file, unchanged pdfs are not recounted')
+    parser.add_argument('-hash', action='store_true', default=False, dest='usehash',
+                        help='verify cached counts by content hash, slower, flag')
+    parser.add_argument('-checkpoint', action='store', default=None,
+                        help='file recording counted files, an interrupted run resumes from it')
+    parser.add_argument('-pipeline', action='store_true', default=False,
+                        help='start counting while the directory scan is still running, flag')
+    parser.add_argument('-stats', action='store', default=None,
+                        help='write run timings and totals to this json file')
 
     args = parser.parse_args()
+    statspath = os.path.abspath(args.stats) if args.stats else None
 
     starttime = time.time()
     results = []
     errors = []
     rootpath = args.rootpath
     num_workers = args.num_workers
-    print('\n  Scanning directory, gathering loan numbers', end='\r')
-    pdftable = lpc.genfilelist(rootpath, minlen=args.minlen,
-                                maxlen=args.maxlen, foldonly=args.folder)
-    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
-    print(' ' * 50, '\r', ' Loan gather complete:', ctime, '\n')
-
-    args.loancnt = len(pdftable)
+    extractor = lpc.loanrules.LoanExtractor(args.rules, minlen=args.minlen,
+                                            maxlen=args.maxlen, foldonly=args.folder)
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint is not None else None
     args.stdout_lock = multiprocessing.Lock()
-    workq = multiprocessing.JoinableQueue()
+    if args.pagecache is not None:
+        args.pagecache = os.path.abspath(args.pagecache)
+        lpc.pagecache.PageCache(args.pagecache).close()  # create the tables once, before the workers start
     resultq = multiprocessing.Queue()
-    workers = [Worker(workq, resultq, args) for i in xrange(num_workers)]
+
+    if args.pipeline:
+        print('\n  Scanning and counting', end='\r')
+        scancache = lpc.filescan.DirCache(args.scancache) if args.scancache is not None else None
+        loanfiles = lpc.iterloanfiles(rootpath, cache=scancache, threads=args.scanthreads,
+                                      extractor=extractor)
+        workq = multiprocessing.Queue(maxsize=num_workers * PIPELINE_QUEUE_BATCHES)
+        workers = [Worker(workq, resultq, args) for i in xrange(num_workers)]
+        feeder = ScanFeeder(workq, loanfiles, workers, checkpoint.done if checkpoint else None)
+        pdftable = feeder.pdftable
+        batches = feeder.batches
+        tally = LoanTotals(pdftable)
+        countstart = time.time()
+        for w in workers:
+            w.start()
+        feeder.start()
+    else:
+        print('\n  Scanning directory, gathering loan numbers', end='\r')
+        pdftable = lpc.genfilelist(rootpath, cachepath=args.scancache, threads=args.scanthreads,
+                                    extractor=extractor)
+        scanend = time.time()
+        ctime = '%d:%.1f' % divmod(scanend - starttime, 60)
+        print(' ' * 50, '\r', ' Loan gather complete:', ctime, '\n')
+
+        tally = LoanTotals(pdftable)
+        tocount = pdftable
+        if checkpoint is not None:
+            tocount = {}
+            resumed = 0
+            for loannum, pdflist in pdftable.iteritems():
+                for pdfpath in pdflist:
+                    if pdfpath in checkpoint.done:
+                        tally.add(loannum, pdfpath, checkpoint.done[pdfpath][1])
+                        resumed += 1
+                    else:
+                        tocount.setdefault(loannum, []).append(pdfpath)
+            if resumed:
+                print('  Resuming, %s files already counted' % resumed)
+
+        batches = make_batches(tocount, num_workers)
+        workq = multiprocessing.Queue()
+        workers = [Worker(workq, resultq, args) for i in xrange(num_workers)]
+        countstart = time.time()
+        for w in workers:
+            w.start()
+
+    finished = False
+    try:
+        if not args.pipeline:
+            for batchno, batch in enumerate(batches):
+                workq.put((batchno, batch))
+            # Add a poison pill for each consumer
+            for i in xrange(num_workers):
+                workq.put((None, None))
+        timings, cache_hits, cache_misses = collect(workers, resultq, tally, checkpoint,
+                                                    batches, args.debug)
+        finished = True
+    except KeyboardInterrupt:
+        print('\n  Interrupted, stopping workers.')
+        if checkpoint is not None:
+            print('  %s batches saved to %s, rerun with the same -checkpoint to resume' %
+                  (checkpoint.batches, args.checkpoint))
+        sys.exit(1)
+    finally:
+        if args.pipeline:
+            feeder.stop.set()  # nothing is left to feed once collection has ended
+        if not finished:
+            stop_workers(workers, workq)
+            if checkpoint is not None:
+                checkpoint.close()
     for w in workers:
-        w.start()
-
-    for loan, pdflist in pdftable.viewitems():
-        workq.put((loan, pdflist))
-
-    # Add a poison pill for each consumer
-    for i in xrange(num_workers):
-        workq.put((None, None))
-
-    workq.join()
-    #try:
-        #workq.join()
-    #except KeyboardInterrupt:
-        #print('doh')
-        #for w in workers:
-            #w.terminate()
-        #sys.exit(1)
-
-    while not resultq.empty():
-        loannum, totaldocs, totalpages, errorfiles = resultq.get()
+        w.join()
+    countend = max([t[2] for t in timings] or [time.time()])
+
+    if args.pipeline:
+        feeder.join()
+        if feeder.error is not None:
+            raise feeder.error
+        if not feeder.scancomplete:
+            print('\n  Counting ended before the scan finished, the totals are partial')
+        elif scancache is not None:
+            scancache.save()
+        for loannum, pdfpath, pages in feeder.resumed:
+            tally.add(loannum, pdfpath, pages)
+        if feeder.resumed:
+            print('\n  Resumed %s files already counted' % len(feeder.resumed))
+        scanend = feeder.scanend or time.time()
+        if feeder.scancomplete:
+            print('\n  Scan finished after %.1fs' % (scanend - countstart))
+    if timings:
+        print('\n  First result after %.1fs' % (min(t[2] for t in timings) - starttime))
+
+    for loannum, totaldocs, totalpages, errorfiles in tally.results():
         results.append((loannum, totaldocs, totalpages))
         if len(errorfiles) > 0:
             errors.append(errorfiles)
+    incomplete = tally.incomplete()
+    if incomplete:
+        print('\n  Counts incomplete for %s loans: %s' % (len(incomplete), ', '.join(incomplete)))
 
     ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
     #print('Count complete:', ctime)
@@ -121,11 +533,36 @@ if __name__ == '__main__':
         report = csv.writer(outcsv, dialect='excel')
         report.writerow(['Loan Number', 'File Count', 'Page Count'])
         report.writerows(results)
+    if extractor.ambiguous:
+        lpc.write_ambiguous('LoanAmbiguousMP.csv', extractor)
+        print('%s files with ambiguous loan numbers, see LoanAmbiguousMP.csv' %
+              len(extractor.ambiguous))
+    if checkpoint is not None:
+        if incomplete:
+            checkpoint.close()
+        else:
+            checkpoint.remove()  # the report is written, the next run starts fresh
+
+    print(schedule_report(timings, countstart, countend))
+    if args.pagecache is not None:
+        print('Page cache: %s hits, %s misses (%.1f%% hit rate)' %
+              (cache_hits, cache_misses, 100.0 * cache_hits / max(cache_hits + cache_misses, 1)))
 
     if len(errors) > 0:
         print('Error files not included in count:\n')
         for err in itertools.chain(*errors):
             print(err)
 
+    if statspath is not None:
+        lpc.write_stats(statspath, {'mode': 'pipeline' if args.pipeline else 'mp',
+                                    'workers': num_workers, 'loans': len(pdftable),
+                                    'files': totalpdfs, 'pages': totalpages,
+                                    'scan_seconds': scanend - starttime,
+                                    'first_result_seconds': (min(t[2] for t in timings) - starttime
+                                                             if timings else None),
+                                    'count_seconds': countend - countstart,
+                                    'total_seconds': time.time() - starttime,
+                                    'cache_hits': cache_hits, 'cache_misses': cache_misses})
+
     ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
     print(' ' * 50, '\r', ' Complete:', ctime, '\n')
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+Loan number extraction from file paths.
+
+Rules are tried in order and the first one that finds a candidate decides
+the loan number.  Each rule can be written as a short spec on the command line:
+
+    longest                 longest run of characters between letters,
+                            punctuation and whitespace, within the length
+                            limits.  The default, same as the old splitbyl pass.
+    segment:POS             the whole path segment at POS, extension dropped.
+                            0 is the first folder under the scan root, -1 the
+                            filename, -2 its folder.
+    segment:POS:REGEX       group 1 of REGEX searched in that segment.
+    regex:REGEX             group 1 (or the group named loan) of REGEX searched
+                            in the whole path.
+    prefix:LN,LOAN          digits following one of the prefixes, case
+                            insensitive, with an optional space, _, - or #.
+
+A path is ambiguous when its rule finds more than one possible number:
+distinct candidates of the same longest length for 'longest', any distinct
+candidates for the other rules.  The chosen number is still used, the path
+is recorded in LoanExtractor.ambiguous for review.
+"""
+from __future__ import print_function
+import os
+import re
+import string
+
+SEPARATORS = string.ascii_letters + string.punctuation + string.whitespace
+SEGMENT_RE = re.compile(r'[\\/]+')
+
+
+class LongestRule(object):
+    name = 'longest'
+    strict = False
+
+    def __init__(self, minlen=5, maxlen=200):
+        self.minlen = minlen
+        self.maxlen = maxlen
+        self.token_re = re.compile('[^%s]+' % re.escape(SEPARATORS))
+
+    def candidates(self, path, parts):
+        return [token for token in self.token_re.findall(path)
+                if self.minlen <= len(token) <= self.maxlen]
+
+
+class SegmentRule(object):
+    name = 'segment'
+    strict = True
+
+    def __init__(self, position, pattern=None, minlen=5, maxlen=200):
+        self.position = position
+        self.pattern = re.compile(pattern) if pattern else None
+        self.minlen = minlen
+        self.maxlen = maxlen
+
+    def candidates(self, path, parts):
+        try:
+            segment = parts[self.position]
+        except IndexError:
+            return []
+        if self.pattern is None:
+            found = [os.path.splitext(segment)[0]]
+        else:
+            found = [m.group(1) for m in self.pattern.finditer(segment)]
+        return [f for f in found if f and self.minlen <= len(f) <= self.maxlen]
+
+
+class RegexRule(object):
+    name = 'regex'
+    strict = True
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+        if self.pattern.groups < 1:
+            raise ValueError('Loan regex %r needs a capture group' % pattern)
+        self.group = 'loan' if 'loan' in self.pattern.groupindex else 1
+
+    def candidates(self, path, parts):
+        return [m.group(self.group) for m in self.pattern.finditer(path) if m.group(self.group)]
+
+
+class PrefixRule(object):
+    name = 'prefix'
+    strict = True
+
+    def __init__(self, prefixes, minlen=5, maxlen=200):
+        alternatives = '|'.join(re.escape(p) for p in sorted(prefixes, key=len, reverse=True))
+        self.pattern = re.compile(r'(?:%s)[ _#-]?(\d{%d,%d})(?!\d)' % (alternatives, minlen, maxlen),
+                                  re.IGNORECASE)
+
+    def candidates(self, path, parts):
+        return self.pattern.findall(path)
+
+
+def parse_rule(spec, minlen=5, maxlen=200):
+    """Build a rule from its command line spec, see the module docstring."""
+    kind, _, arg = spec.partition(':')
+    if kind == 'longest':
+        return LongestRule(minlen, maxlen)
+    if kind == 'segment':
+        position, _, pattern = arg.partition(':')
+        return SegmentRule(int(position), pattern or None, minlen, maxlen)
+    if kind == 'regex':
+        return RegexRule(arg)
+    if kind == 'prefix':
+        return PrefixRule([p for p in arg.split(',') if p], minlen, maxlen)
+    raise ValueError('Unknown loan rule %r, use longest, segment, regex or prefix' % spec)
+
+
+class LoanExtractor(object):
+    """
+    Picks the loan number out of each path with the first rule that finds one.
+
+    Args:
+        rules- list of rule objects or spec strings, default [longest].
+        minlen, maxlen- loan number length limits for the rules that use them.
+        foldonly- ignore the filename, only match on the folders.
+        root- scan root, segment positions from 0 count from below it.
+
+    Attributes:
+        ambiguous- list of (path, loannum, rule name, candidates) for paths
+                   with more than one possible loan number.
+        unmatched- number of paths no rule matched.
+    """
+    def __init__(self, rules=None, minlen=5, maxlen=200, foldonly=False, root=None):
+        self.rules = [parse_rule(r, minlen, maxlen) if isinstance(r, basestring) else r
+                      for r in (rules or ['longest'])]
+        self.foldonly = foldonly
+        self.root = root
+        self.ambiguous = []
+        self.unmatched = 0
+
+    def _parts(self, path):
+        if self.root is not None:
+            relpath = os.path.relpath(path, self.root)
+            if not relpath.startswith(os.pardir):
+                path = relpath
+        return [p for p in SEGMENT_RE.split(path) if p]
+
+    def extract(self, path):
+        """Loan number for path, or None."""
+        fullpath = path
+        if self.foldonly:
+            path = os.path.dirname(path)
+        parts = None
+        for rule in self.rules:
+            if parts is None and isinstance(rule, SegmentRule):
+                parts = self._parts(path)
+            found = rule.candidates(path, parts)
+            if not found:
+                continue
+            longest = max(len(f) for f in found)
+            # the rightmost of the longest, the part of the path nearest the file
+            loannum = [f for f in found if len(f) == longest][-1]
+            distinct = set(found) if rule.strict else set(f for f in found if len(f) == longest)
+            if len(distinct) > 1:
+                self.ambiguous.append((fullpath, loannum, rule.name, sorted(set(found))))
+            return loannum
+        self.unmatched += 1
+        return None
+
+    def stream(self, paths):
+        """Generate (loannum, path) for each path with a loan number, as paths arrive."""
+        for path in paths:
+            loannum = self.extract(path)
+            if loannum is not None:
+                yield loannum, path
+
+    def ambiguous_loans(self):
+        """Loan number -> list of (path, candidates) for the ambiguous paths."""
+        loans = {}
+        for path, loannum, rulename, candidates in self.ambiguous:
+            loans.setdefault(loannum, []).append((path, candidates))
+        return loans
@@ -0,0 +1,276 @@
+"""
+Cross-platform file discovery shared by the scripts in this repo.
+
+Replaces shelling out to 'dir /S /B' and os.walk + glob with an os.scandir
+walk that:
+ - streams paths as a generator so callers can start before the scan ends,
+ - filters on extension or a filename pattern without a glob per directory,
+ - can walk the top level subtrees in parallel threads (network shares are
+   latency bound, so threads overlap the round trips),
+ - can keep a persistent cache of directory listings keyed on the directory
+   mtime.  A directory whose mtime hasn't changed is not listed again.  Each
+   directory is still stat'ed, since a change deep in a tree doesn't touch
+   the mtimes of its parents.
+
+Usage from a script folder:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, 'common'))
+    import filescan
+"""
+from __future__ import print_function
+import os
+import stat
+import fnmatch
+import threading
+import cPickle
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # pip install scandir, the python 2 backport
+    except ImportError:
+        scandir = None
+
+CACHE_VERSION = 1
+
+
+class _ListdirEntry(object):
+    """Minimal os.DirEntry stand-in when scandir isn't available."""
+    __slots__ = ('name', 'path', '_stat')
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            if not follow_symlinks:
+                return stat.S_ISDIR(os.lstat(self.path).st_mode)
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+def _entries(path):
+    if scandir is not None:
+        return scandir(path)
+    return (_ListdirEntry(path, name) for name in os.listdir(path))
+
+
+def listdir(path):
+    """Return ([file names], [subdirectory names]) for one directory."""
+    files = []
+    dirs = []
+    for entry in _entries(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):  # like os.walk, don't follow links into loops
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        except OSError:  # vanished or unreadable mid scan
+            continue
+    return files, dirs
+
+
+class DirCache(object):
+    """
+    Persistent directory listing cache, dirpath -> (mtime, files, subdirs).
+
+    Args:
+        cachepath- pickle file to load from and save to.  A missing or
+                   unreadable file starts an empty cache.
+    """
+    def __init__(self, cachepath=None):
+        self.cachepath = cachepath
+        self.listings = {}
+        self.hits = 0
+        self.misses = 0
+        if cachepath is not None and os.path.exists(cachepath):
+            try:
+                with open(cachepath, 'rb') as cachefh:
+                    version, listings = cPickle.load(cachefh)
+                if version == CACHE_VERSION:
+                    self.listings = listings
+            except (EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+                self.listings = {}
+
+    def listdir(self, path):
+        """Listing for path, from the cache when the directory mtime is unchanged."""
+        mtime = os.stat(path).st_mtime
+        cached = self.listings.get(path)
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            return cached[1], cached[2]
+        self.misses += 1
+        files, dirs = listdir(path)
+        self.listings[path] = (mtime, files, dirs)
+        return files, dirs
+
+    def save(self, cachepath=None):
+        cachepath = cachepath or self.cachepath
+        if cachepath is None:
+            return
+        tmppath = cachepath + '.tmp'
+        with open(tmppath, 'wb') as cachefh:
+            cPickle.dump((CACHE_VERSION, self.listings), cachefh, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(cachepath):
+            os.remove(cachepath)  # os.rename won't replace on Windows
+        os.rename(tmppath, cachepath)
+
+
+def _name_filter(exts, pattern):
+    """Build a filename -> bool test, None if everything matches."""
+    if exts:
+        exts = set(e.lower() if e.startswith('.') else '.' + e.lower() for e in exts)
+    if pattern in (None, '', '*'):
+        pattern = None
+    else:
+        pattern = os.path.normcase(pattern).lower()  # fnmatch is case-sensitive on Linux
+    if not exts and pattern is None:
+        return None
+
+    def keep(name):
+        if exts and os.path.splitext(name)[1].lower() not in exts:
+            return False
+        return pattern is None or fnmatch.fnmatchcase(os.path.normcase(name).lower(), pattern)
+    return keep
+
+
+def _walk(root, keep, cache, recursive, onerror):
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            files, dirs = cache.listdir(path) if cache is not None else listdir(path)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+        for name in files:
+            if keep is None or keep(name):
+                yield os.path.join(path, name)
+        if recursive:
+            stack.extend(os.path.join(path, name) for name in reversed(dirs))
+
+
+def scan(root, exts=None, pattern=None, recursive=True, cache=None, threads=1, onerror=None):
+    """
+    Generate the paths of all files under root.
+
+    Args:
+        root- directory to scan.
+        exts- optional list of extensions to keep, case insensitive, e.g. ['.pdf'].
+        pattern- optional fnmatch filename pattern, case insensitive, e.g. '*.tif'.
+        recursive- descend into subdirectories, default True.
+        cache- optional DirCache, it is not saved here.
+        threads- walk the top level subdirectories of root in this many
+                 threads.  Paths then arrive in no particular order.
+        onerror- optional callable given the OSError for unreadable directories.
+    """
+    if not os.path.isdir(root):
+        raise OSError('Input directory %s does not exist' % root)
+    keep = _name_filter(exts, pattern)
+    if threads <= 1 or not recursive:
+        for path in _walk(root, keep, cache, recursive, onerror):
+            yield path
+        return
+
+    files, dirs = cache.listdir(root) if cache is not None else listdir(root)
+    for name in files:
+        if keep is None or keep(name):
+            yield os.path.join(root, name)
+    subtrees = Queue.Queue()
+    for name in dirs:
+        subtrees.put(os.path.join(root, name))
+    results = Queue.Queue(maxsize=10000)
+    done = object()
+    stopping = threading.Event()
+
+    def walker():
+        try:
+            while not stopping.is_set():
+                try:
+                    subtree = subtrees.get_nowait()
+                except Queue.Empty:
+                    break
+                for path in _walk(subtree, keep, cache, True, onerror):
+                    if stopping.is_set():
+                        break
+                    results.put(path)
+        finally:
+            results.put(done)
+
+    workers = [threading.Thread(target=walker) for i in xrange(min(threads, len(dirs)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        remaining = len(workers)
+        while remaining:
+            path = results.get()
+            if path is done:
+                remaining -= 1
+            else:
+                yield path
+    finally:
+        stopping.set()
+        while any(worker.is_alive() for worker in workers):  # unblock workers if we stop early
+            try:
+                results.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def gather(root, exts=None, pattern=None, cachepath=None, threads=1):
+    """
+    List version of scan that loads and saves a DirCache at cachepath when given.
+    """
+    cache = DirCache(cachepath) if cachepath is not None else None
+    result = list(scan(root, exts=exts, pattern=pattern, cache=cache, threads=threads))
+    if cache is not None:
+        cache.save()
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Scan a directory tree and time it')
+    parser.add_argument('root', action='store', help='directory to scan')
+    parser.add_argument('-ext', action='append', default=None,
+                        help='extension to keep, repeat for more')
+    parser.add_argument('-threads', '-t', action='store', type=int, default=1,
+                        help='threads for walking top level subtrees')
+    parser.add_argument('-cache', action='store', default=None,
+                        help='directory listing cache file')
+    parser.add_argument('-print', action='store_true', default=False, dest='printpaths',
+                        help='print each path found, flag')
+    args = parser.parse_args()
+
+    starttime = time.time()
+    cache = DirCache(args.cache) if args.cache is not None else None
+    cnt = 0
+    for path in scan(args.root, exts=args.ext, cache=cache, threads=args.threads):
+        cnt += 1
+        if args.printpaths:
+            print(path)
+    if cache is not None:
+        cache.save()
+        print('Cache: %s directories reused, %s listed' % (cache.hits, cache.misses))
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('%s files in %s' % (cnt, ctime))
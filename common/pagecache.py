@@ -0,0 +1,246 @@
+"""
+Persistent pdf page count cache.
+
+An SQLite table of path -> (size, mtime, content hash, pages).  A file whose
+size and mtime match its row is not opened again.  With usehash the file's
+sha1 is also checked, which catches edits that keep size and mtime (restores
+from backup, some copy tools) and lets a moved or renamed file reuse the
+count stored under its old path, at the cost of reading every file.
+
+Each process opens its own PageCache on the same database file.  Writes
+and last used times are buffered in memory and flushed in one short
+transaction every COMMIT_EVERY rows and on close, so no process holds the
+write lock while it counts.  The database is put in WAL mode where the
+filesystem allows it, letting readers carry on during a flush.
+
+    cache = pagecache.PageCache('pagecounts.db')
+    pages = cache.count(pdfpath)
+    cache.close()
+"""
+from __future__ import print_function
+import os
+import time
+import sqlite3
+import hashlib
+
+import pdfpages
+
+SCHEMA_VERSION = 1
+COMMIT_EVERY = 500  # buffered rows written per flush
+HASH_BLOCK = 1 << 20
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        while True:
+            block = fh.read(HASH_BLOCK)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class PageCache(object):
+    """
+    Page counts keyed on path, size and mtime.
+
+    Args:
+        dbpath- SQLite database file, created if missing.
+        usehash- also verify the content hash, and look up moved files by hash.
+
+    Attributes:
+        hits- lookups answered from the cache.
+        misses- lookups that had to count the file.
+    """
+    def __init__(self, dbpath, usehash=False):
+        self.dbpath = dbpath
+        self.usehash = usehash
+        self.hits = 0
+        self.misses = 0
+        self._puts = {}  # path -> row, not yet written
+        self._touched = []  # paths used this run, their used time not yet written
+        # autocommit, transactions are only opened explicitly around a flush
+        self.db = sqlite3.connect(dbpath, timeout=60, isolation_level=None)
+        self.db.text_factory = str
+        try:
+            self.db.execute('PRAGMA journal_mode=WAL')  # refused on some network filesystems
+        except sqlite3.Error:
+            pass
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        version = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is not None and version[0] != SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS pages')
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (SCHEMA_VERSION,))
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (path TEXT PRIMARY KEY, size INTEGER, '
+                        'mtime REAL, hash TEXT, pages INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash)')
+        self._runstart = time.time()
+
+    def __len__(self):
+        self.commit()
+        return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def get(self, path, st=None, digest=None):
+        """Cached page count for path or None if it's missing or stale."""
+        st = st or os.stat(path)
+        row = self._puts.get(path)
+        if row is not None:
+            row = row[1:5]
+        else:
+            row = self.db.execute('SELECT size, mtime, hash, pages FROM pages WHERE path = ?',
+                                  (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+            if not self.usehash or row[2] == (digest or file_hash(path)):
+                self._touch(path)
+                return row[3]
+        if self.usehash:
+            digest = digest or file_hash(path)
+            moved = self.db.execute('SELECT pages FROM pages WHERE hash = ? AND size = ? LIMIT 1',
+                                    (digest, st.st_size)).fetchone()
+            if moved is not None:
+                self.put(path, moved[0], st, digest)
+                return moved[0]
+        return None
+
+    def put(self, path, pages, st=None, digest=None):
+        st = st or os.stat(path)
+        if self.usehash and digest is None:
+            digest = file_hash(path)
+        self._puts[path] = (path, st.st_size, st.st_mtime, digest, pages, time.time())
+        self._written()
+
+    def count(self, path):
+        """
+        Page count for path, from the cache if the file is unchanged, otherwise
+        counted with pdfpages.count_pages and stored.  Raises
+        pdfpages.PageCountError like count_pages, failures are not cached.
+        """
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise pdfpages.PageCountError('%s: %s' % (path, e))
+        digest = file_hash(path) if self.usehash else None
+        pages = self.get(path, st, digest)
+        if pages is not None:
+            self.hits += 1
+            return pages
+        self.misses += 1
+        pages = pdfpages.count_pages(path)
+        self.put(path, pages, st, digest)
+        return pages
+
+    def invalidate(self, path=None, prefix=None):
+        """
+        Drop cached counts for one path, every path under a folder prefix, or
+        everything when neither is given.  Returns the number of rows removed.
+        """
+        self.commit()
+        if path is not None:
+            cur = self.db.execute('DELETE FROM pages WHERE path = ?', (path,))
+        elif prefix is not None:
+            prefix = prefix.rstrip('\\/') + os.sep
+            cur = self.db.execute('DELETE FROM pages WHERE substr(path, 1, ?) = ?',
+                                  (len(prefix), prefix))
+        else:
+            cur = self.db.execute('DELETE FROM pages')
+        return cur.rowcount
+
+    def compact(self, unused_days=None):
+        """
+        Remove rows for files that no longer exist, and optionally rows not
+        used in unused_days, then VACUUM the database file.  Returns the number
+        of rows removed.
+        """
+        self.commit()
+        gone = [(path,) for (path,) in self.db.execute('SELECT path FROM pages')
+                if not os.path.exists(path)]
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('DELETE FROM pages WHERE path = ?', gone)
+            removed = len(gone)
+            if unused_days is not None:
+                cur = self.db.execute('DELETE FROM pages WHERE used < ?',
+                                      (time.time() - unused_days * 86400,))
+                removed += cur.rowcount
+            self.db.execute('COMMIT')
+        except sqlite3.Error:
+            self._rollback()
+            raise
+        self.db.execute('VACUUM')
+        return removed
+
+    def _touch(self, path):
+        if path not in self._puts:
+            self._touched.append(path)
+            self._written()
+
+    def _written(self):
+        if len(self._puts) + len(self._touched) >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        """Write the buffered rows and used times in one transaction."""
+        if not self._puts and not self._touched:
+            return
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                                self._puts.values())
+            # only rows not yet used this run, so a warm run rewrites nothing after the first
+            self.db.executemany('UPDATE pages SET used = ? WHERE path = ? AND used < ?',
+                                [(now, path, self._runstart) for path in self._touched])
+            self.db.execute('COMMIT')
+        except sqlite3.Error:
+            self._rollback()
+            raise
+        self._puts.clear()
+        del self._touched[:]
+
+    def _rollback(self):
+        try:
+            self.db.execute('ROLLBACK')
+        except sqlite3.Error:  # already rolled back by the failure
+            pass
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            self.db.close()
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return 'Page cache: %s hits, %s misses (%.1f%% hit rate)' % (self.hits, self.misses, rate)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Maintain a pdf page count cache')
+    parser.add_argument('dbpath', action='store', help='page count cache file')
+    parser.add_argument('-invalidate', action='store', default=None,
+                        help='drop cached counts for this file or folder')
+    parser.add_argument('-clear', action='store_true', default=False,
+                        help='drop every cached count, flag')
+    parser.add_argument('-compact', action='store_true', default=False,
+                        help='remove rows for deleted files and shrink the database, flag')
+    parser.add_argument('-unused', action='store', type=int, default=None,
+                        help='with -compact also remove rows not used in this many days')
+    args = parser.parse_args()
+
+    cache = PageCache(args.dbpath)
+    if args.clear:
+        print('%s rows removed' % cache.invalidate())
+    elif args.invalidate is not None:
+        target = os.path.abspath(args.invalidate)
+        if os.path.isdir(target):
+            print('%s rows removed' % cache.invalidate(prefix=target))
+        else:
+            print('%s rows removed' % cache.invalidate(path=target))
+    if args.compact:
+        print('%s rows removed by compaction' % cache.compact(args.unused))
+    print('%s cached page counts' % len(cache))
+    cache.close()
@@ -0,0 +1,490 @@
+"""
+In-process pdf page counts.
+
+Reads the page count straight from the file instead of running pdfinfo for
+every pdf: startxref -> cross reference table or stream -> trailer /Root ->
+catalog /Pages -> /Count.  The file is memory mapped and only the handful of
+objects on that path are parsed.  Handles classic xref tables, xref streams,
+hybrid files, incremental updates (/Prev) and objects inside object streams.
+
+Encrypted files, broken cross reference data and unsupported stream filters
+raise PDFParseError, and count_pages then falls back to pdfinfo.
+"""
+from __future__ import print_function
+import re
+import mmap
+import zlib
+import subprocess
+from collections import namedtuple
+
+Ref = namedtuple('Ref', 'num gen')
+
+WHITESPACE = '\x00\t\n\x0c\r '
+DELIMITERS = '()<>[]{}/%'
+TAIL_SEARCH = 65536  # how far from the end of file to look for startxref
+
+STARTXREF_RE = re.compile(r'startxref\s+(\d+)')
+OBJ_RE = re.compile(r'\s*(\d+)\s+(\d+)\s+obj\b')
+NUMBER_RE = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)')
+REF_RE = re.compile(r'\s+(\d+)\s+R(?=[\s()<>\[\]{}/%]|$)')
+XREF_ENTRY_RE = re.compile(r'(\d{10}) (\d{5}) ([nf])')
+SUBSECTION_RE = re.compile(r'\s*(\d+)\s+(\d+)')
+
+
+class PDFParseError(Exception):
+    """The page count could not be read natively."""
+    pass
+
+
+class PageCountError(Exception):
+    """Neither the native reader nor pdfinfo could count the pages."""
+    pass
+
+
+class Name(str):
+    """A pdf name object, e.g. /Pages, stored without the slash."""
+    pass
+
+
+class _ClassicXref(object):
+    """A classic xref table section, entries are read on demand."""
+    def __init__(self, data, subsections):
+        self.data = data
+        self.subsections = subsections  # (first objnum, count, file offset of first entry)
+
+    def lookup(self, objnum):
+        for first, count, pos in self.subsections:
+            if first <= objnum < first + count:
+                # entries are a fixed 20 bytes, but tolerate writers that used 19 or 21
+                entry = XREF_ENTRY_RE.match(self.data, pos + 20 * (objnum - first))
+                if entry is None:
+                    entry = self._scan_entry(pos, objnum - first)
+                if entry is not None and entry.group(3) == 'n':
+                    return (1, int(entry.group(1)), int(entry.group(2)))
+        return None
+
+    def _scan_entry(self, pos, index):
+        entry = None
+        for i in xrange(index + 1):
+            entry = XREF_ENTRY_RE.search(self.data, pos)
+            if entry is None:
+                return None
+            pos = entry.end()
+        return entry
+
+
+class _StreamXref(object):
+    """An xref stream section, decoded up front."""
+    def __init__(self, entries):
+        self.entries = entries  # objnum -> (type, field2, field3)
+
+    def lookup(self, objnum):
+        entry = self.entries.get(objnum)
+        if entry is None or entry[0] == 0:
+            return None
+        return entry
+
+
+class PDFReader(object):
+    """
+    Minimal pdf reader over a buffer (a memory mapped file or a str).
+
+    Args:
+        data- the whole pdf file.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.sections = []
+        self.trailer = {}
+        self._objstms = {}
+        self._load_xref()
+
+    # ---- object parsing ----
+
+    def _skip(self, pos):
+        data = self.data
+        end = len(data)
+        while pos < end:
+            ch = data[pos]
+            if ch in WHITESPACE:
+                pos += 1
+            elif ch == '%':
+                while pos < end and data[pos] not in '\r\n':
+                    pos += 1
+            else:
+                break
+        return pos
+
+    def parse_object(self, pos):
+        """Parse the object at pos, returns (value, position after it)."""
+        data = self.data
+        pos = self._skip(pos)
+        if pos >= len(data):
+            raise PDFParseError('Unexpected end of file')
+        ch = data[pos]
+        if ch == '<':
+            if data[pos + 1:pos + 2] == '<':
+                return self._parse_dict(pos + 2)
+            end = data.find('>', pos)
+            if end < 0:
+                raise PDFParseError('Unterminated hex string at %s' % pos)
+            return data[pos + 1:end], end + 1
+        if ch == '[':
+            items = []
+            pos += 1
+            while True:
+                pos = self._skip(pos)
+                if data[pos:pos + 1] == ']':
+                    return items, pos + 1
+                item, pos = self.parse_object(pos)
+                items.append(item)
+        if ch == '/':
+            end = pos + 1
+            while end < len(data) and data[end] not in WHITESPACE and data[end] not in DELIMITERS:
+                end += 1
+            return Name(data[pos + 1:end]), end
+        if ch == '(':
+            return self._parse_string(pos)
+        number = NUMBER_RE.match(data, pos)
+        if number is not None:
+            text = number.group()
+            if '.' in text:
+                return float(text), number.end()
+            ref = REF_RE.match(data, number.end())
+            if ref is not None:
+                return Ref(int(text), int(ref.group(1))), ref.end()
+            return int(text), number.end()
+        for keyword, value in (('true', True), ('false', False), ('null', None)):
+            if data[pos:pos + len(keyword)] == keyword:
+                return value, pos + len(keyword)
+        raise PDFParseError('Unexpected %r at %s' % (data[pos:pos + 10], pos))
+
+    def _parse_dict(self, pos):
+        result = {}
+        while True:
+            pos = self._skip(pos)
+            if self.data[pos:pos + 2] == '>>':
+                return result, pos + 2
+            key, pos = self.parse_object(pos)
+            if not isinstance(key, Name):
+                raise PDFParseError('Dictionary key %r is not a name at %s' % (key, pos))
+            value, pos = self.parse_object(pos)
+            result[key] = value
+
+    def _parse_string(self, pos):
+        data = self.data
+        depth = 0
+        start = pos
+        while pos < len(data):
+            ch = data[pos]
+            if ch == '\\':
+                pos += 2
+                continue
+            if ch == '(':
+                depth += 1
+            elif ch == ')':
+                depth -= 1
+                if depth == 0:
+                    return data[start + 1:pos], pos + 1
+            pos += 1
+        raise PDFParseError('Unterminated string at %s' % start)
+
+    def _parse_stream(self, streamdict, pos):
+        """Return the decoded stream data whose dictionary ended at pos."""
+        data = self.data
+        pos = self._skip(pos)
+        if data[pos:pos + 6] != 'stream':
+            raise PDFParseError('Expected stream at %s' % pos)
+        pos += 6
+        if data[pos:pos + 2] == '\r\n':
+            pos += 2
+        elif data[pos:pos + 1] in ('\n', '\r'):
+            pos += 1
+        length = self.resolve(streamdict.get('Length'))
+        if not isinstance(length, int):
+            raise PDFParseError('Stream without a usable /Length at %s' % pos)
+        return self._decode(data[pos:pos + length], streamdict)
+
+    def _decode(self, raw, streamdict):
+        filters = self.resolve(streamdict.get('Filter'))
+        parms = self.resolve(streamdict.get('DecodeParms'))
+        if filters is None:
+            return raw
+        if not isinstance(filters, list):
+            filters, parms = [filters], [parms]
+        elif not isinstance(parms, list):
+            parms = [parms] * len(filters)
+        for filt, parm in zip(filters, parms):
+            if filt not in ('FlateDecode', 'Fl'):
+                raise PDFParseError('Unsupported stream filter %s' % filt)
+            try:
+                raw = zlib.decompress(raw)
+            except zlib.error:
+                try:  # tolerate a truncated or padded stream
+                    raw = zlib.decompressobj().decompress(raw)
+                except zlib.error as e:
+                    raise PDFParseError('Bad FlateDecode stream: %s' % e)
+            parm = self.resolve(parm) or {}
+            if parm.get('Predictor', 1) >= 10:
+                raw = _png_unpredict(raw, parm.get('Columns', 1),
+                                     parm.get('Colors', 1) * parm.get('BitsPerComponent', 8))
+            elif parm.get('Predictor', 1) != 1:
+                raise PDFParseError('Unsupported predictor %s' % parm.get('Predictor'))
+        return raw
+
+    # ---- cross reference ----
+
+    def _load_xref(self):
+        data = self.data
+        tailstart = max(0, len(data) - TAIL_SEARCH)
+        tail = data[tailstart:]
+        found = list(STARTXREF_RE.finditer(tail))
+        if not found:
+            raise PDFParseError('startxref not found')
+        offset = int(found[-1].group(1))
+        seen = set()
+        while offset is not None:
+            if offset in seen or offset >= len(data):
+                raise PDFParseError('Bad xref offset %s' % offset)
+            seen.add(offset)
+            trailer = self._load_section(offset)
+            for key, value in trailer.iteritems():
+                self.trailer.setdefault(key, value)  # newest section wins
+            if 'XRefStm' in trailer:  # hybrid file, its stream ranks just after its table
+                self._load_section(trailer['XRefStm'])
+            offset = trailer.get('Prev')
+
+    def _load_section(self, offset):
+        pos = self._skip(offset)
+        if self.data[pos:pos + 4] == 'xref':
+            return self._load_table(pos + 4)
+        return self._load_xref_stream(pos)
+
+    def _load_table(self, pos):
+        subsections = []
+        while True:
+            pos = self._skip(pos)
+            if self.data[pos:pos + 7] == 'trailer':
+                trailer, pos = self.parse_object(pos + 7)
+                self.sections.append(_ClassicXref(self.data, subsections))
+                return trailer
+            header = SUBSECTION_RE.match(self.data, pos)
+            if header is None:
+                raise PDFParseError('Bad xref table at %s' % pos)
+            first, count = int(header.group(1)), int(header.group(2))
+            entrypos = self._skip(header.end())
+            subsections.append((first, count, entrypos))
+            pos = entrypos + 20 * count
+            if count and XREF_ENTRY_RE.match(self.data, pos - 20) is None:
+                last = _ClassicXref(self.data, [])._scan_entry(entrypos, count - 1)
+                if last is None:
+                    raise PDFParseError('Bad xref entries at %s' % entrypos)
+                pos = last.end()
+
+    def _load_xref_stream(self, pos):
+        header = OBJ_RE.match(self.data, pos)
+        if header is None:
+            raise PDFParseError('No xref table or stream at %s' % pos)
+        streamdict, pos = self.parse_object(header.end())
+        if not isinstance(streamdict, dict) or streamdict.get('Type') != 'XRef':
+            raise PDFParseError('Object at %s is not an xref stream' % pos)
+        raw = self._parse_stream(streamdict, pos)
+        widths = streamdict.get('W')
+        index = streamdict.get('Index', [0, streamdict.get('Size', 0)])
+        if not isinstance(widths, list) or len(widths) != 3:
+            raise PDFParseError('Bad xref stream /W %r' % widths)
+        rowlen = sum(widths)
+        raw = bytearray(raw)
+        entries = {}
+        row = 0
+        for i in xrange(0, len(index) - 1, 2):
+            for objnum in xrange(index[i], index[i] + index[i + 1]):
+                start = row * rowlen
+                if start + rowlen > len(raw):
+                    break
+                fields = []
+                for width in widths:
+                    value = 0
+                    for b in raw[start:start + width]:
+                        value = (value << 8) | b
+                    fields.append(value)
+                    start += width
+                if widths[0] == 0:
+                    fields[0] = 1
+                entries[objnum] = tuple(fields)
+                row += 1
+        self.sections.append(_StreamXref(entries))
+        return streamdict
+
+    # ---- object lookup ----
+
+    def resolve(self, value):
+        """Follow indirect references until a direct object."""
+        depth = 0
+        while isinstance(value, Ref):
+            value = self.get_object(value.num)
+            depth += 1
+            if depth > 32:
+                raise PDFParseError('Reference loop')
+        return value
+
+    def get_object(self, objnum):
+        for section in self.sections:
+            entry = section.lookup(objnum)
+            if entry is None:
+                continue
+            if entry[0] == 1:
+                return self._object_at(entry[1], objnum)
+            if entry[0] == 2:
+                return self._object_in_stream(entry[1], entry[2], objnum)
+        raise PDFParseError('Object %s not in xref' % objnum)
+
+    def _object_at(self, offset, objnum):
+        header = OBJ_RE.match(self.data, offset)
+        if header is None or int(header.group(1)) != objnum:
+            raise PDFParseError('Object %s not found at offset %s' % (objnum, offset))
+        return self.parse_object(header.end())[0]
+
+    def _object_in_stream(self, stmnum, index, objnum):
+        if stmnum not in self._objstms:
+            for section in self.sections:
+                entry = section.lookup(stmnum)
+                if entry is not None and entry[0] == 1:
+                    break
+            else:
+                raise PDFParseError('Object stream %s not in xref' % stmnum)
+            header = OBJ_RE.match(self.data, entry[1])
+            if header is None:
+                raise PDFParseError('Object stream %s not found' % stmnum)
+            streamdict, pos = self.parse_object(header.end())
+            self._objstms[stmnum] = (streamdict, self._parse_stream(streamdict, pos))
+        streamdict, content = self._objstms[stmnum]
+        offsets = content[:streamdict['First']].split()
+        if index * 2 + 1 >= len(offsets) or int(offsets[index * 2]) != objnum:
+            # index is only a hint, search the header pairs
+            pairs = zip(offsets[::2], offsets[1::2])
+            matching = [off for num, off in pairs if int(num) == objnum]
+            if not matching:
+                raise PDFParseError('Object %s not in object stream %s' % (objnum, stmnum))
+            objoffset = int(matching[0])
+        else:
+            objoffset = int(offsets[index * 2 + 1])
+        return _BufferReader(content).parse_object(streamdict['First'] + objoffset)[0]
+
+    # ---- pages ----
+
+    def page_count(self):
+        if 'Encrypt' in self.trailer:
+            raise PDFParseError('Encrypted')
+        catalog = self.resolve(self.trailer.get('Root'))
+        if not isinstance(catalog, dict):
+            raise PDFParseError('No document catalog')
+        pages = self.resolve(catalog.get('Pages'))
+        if not isinstance(pages, dict):
+            raise PDFParseError('No page tree')
+        count = self.resolve(pages.get('Count'))
+        if not isinstance(count, int) or count < 0:
+            raise PDFParseError('Bad page count %r' % count)
+        return count
+
+
+class _BufferReader(PDFReader):
+    """Parser over an in-memory buffer with no cross reference, for object streams."""
+    def __init__(self, data):
+        self.data = data
+        self.sections = []
+
+    def resolve(self, value):
+        return value
+
+
+def _png_unpredict(raw, columns, bitsperpixel=8):
+    """Undo PNG row predictors (Predictor >= 10)."""
+    bpp = max(1, bitsperpixel // 8)
+    rowlen = columns * bpp
+    raw = bytearray(raw)
+    out = bytearray()
+    prev = bytearray(rowlen)
+    for start in xrange(0, len(raw) - rowlen, rowlen + 1):
+        filt = raw[start]
+        row = raw[start + 1:start + 1 + rowlen]
+        if filt == 1:
+            for i in xrange(bpp, rowlen):
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+        elif filt == 2:
+            for i in xrange(rowlen):
+                row[i] = (row[i] + prev[i]) & 0xff
+        elif filt == 3:
+            for i in xrange(rowlen):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+        elif filt == 4:
+            for i in xrange(rowlen):
+                a = row[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                pred = a if pa <= pb and pa <= pc else (b if pb <= pc else c)
+                row[i] = (row[i] + pred) & 0xff
+        elif filt != 0:
+            raise PDFParseError('Bad PNG predictor row type %s' % filt)
+        out.extend(row)
+        prev = row
+    return str(out)
+
+
+def page_count(pdfpath):
+    """Read the page count of a pdf natively, raises PDFParseError when it can't."""
+    with open(pdfpath, 'rb') as pdffh:
+        try:
+            data = mmap.mmap(pdffh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error) as e:  # empty file
+            raise PDFParseError('Cannot map %s: %s' % (pdfpath, e))
+        try:
+            return PDFReader(data).page_count()
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError, RuntimeError) as e:
+            raise PDFParseError('Malformed pdf: %r' % e)
+        finally:
+            data.close()
+
+
+def pdfinfo_pages(pdfpath):
+    """Page count from the poppler pdfinfo command, raises PageCountError on failure."""
+    try:
+        dump = subprocess.check_output(['pdfinfo', pdfpath], stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise PageCountError('pdfinfo failed on %s: %s' % (pdfpath, getattr(e, 'output', e)))
+    dumpsplit = dump.split()
+    try:
+        return int(dumpsplit[dumpsplit.index('Pages:') + 1])
+    except (ValueError, IndexError):
+        raise PageCountError('pdfinfo gave no page count for %s' % pdfpath)
+
+
+def count_pages(pdfpath, fallback=True):
+    """
+    Page count of a pdf, read natively with pdfinfo as the fallback.
+    Raises PageCountError if it can't be counted.
+    """
+    try:
+        return page_count(pdfpath)
+    except PDFParseError as e:
+        if not fallback:
+            raise PageCountError('%s: %s' % (pdfpath, e))
+    except (IOError, OSError) as e:
+        raise PageCountError('%s: %s' % (pdfpath, e))
+    return pdfinfo_pages(pdfpath)
+
+
+if __name__ == '__main__':
+    import sys
+
+    for path in sys.argv[1:]:
+        try:
+            print('%s\t%s' % (page_count(path), path))
+        except PDFParseError as e:
+            try:
+                print('%s\t%s\t(pdfinfo, native failed: %s)' % (pdfinfo_pages(path), path, e))
+            except PageCountError as e:
+                print('ERROR\t%s\t%s' % (path, e))
@@ -0,0 +1,267 @@
+"""
+Check that every image an opticon file points to exists, and optionally
+that it is a readable image with enough pages.
+
+Pages are grouped by folder and each folder is listed once, in a pool of
+threads, instead of a stat per image.  Network shares are latency bound, so
+the threads overlap the round trips.  With -headers each image's header is
+read: TIFFs must have a valid byte order mark and first IFD, JPEGs their
+start and end markers, PDFs and PNGs their signatures.  With -pages every
+TIFF IFD is walked, and a multipage TIFF must have at least as many pages
+as distinct opt page keys point to it.  Page keys listed more than once
+are reported as duplicates.
+
+    python imageverify.py VOL001.opt -pathroot D:\\PROD -threads 32 -headers -pages
+
+Problems go to a csv of begdoc, page key, path, status and detail, where
+status is one of missing, unreadable, corrupt, unknown, pagecount or
+duplicate.
+"""
+from __future__ import print_function
+import os
+import sys
+import csv
+import time
+import struct
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import filescan
+import optdattools
+
+MAX_IFDS = 100000  # more than this many TIFF pages is taken as an IFD loop
+
+
+class ImageError(Exception):
+    """The file isn't a readable image, status is 'corrupt' or 'unknown'."""
+    def __init__(self, message, status='corrupt'):
+        super(ImageError, self).__init__(message)
+        self.status = status
+
+
+def tiff_pages(fh, size, header, countpages=True):
+    """Page count of an open TIFF by walking its IFD chain, or 1 after
+    checking only the first IFD when countpages is False.
+    """
+    endian = '<' if header[:2] == 'II' else '>'
+    version = struct.unpack(endian + 'H', header[2:4])[0]
+    if version == 42:
+        offset = struct.unpack(endian + 'I', header[4:8])[0]
+        countfmt, entrysize, nextfmt = endian + 'H', 12, endian + 'I'
+    elif version == 43:  # BigTIFF
+        offset = struct.unpack(endian + 'Q', header[8:16])[0]
+        countfmt, entrysize, nextfmt = endian + 'Q', 20, endian + 'Q'
+    else:
+        raise ImageError('bad TIFF version %d' % version)
+    countsize = struct.calcsize(countfmt)
+    nextsize = struct.calcsize(nextfmt)
+    pages = 0
+    seen = set()
+    while offset:
+        if offset in seen or pages >= MAX_IFDS:
+            raise ImageError('TIFF IFD chain loops at offset %d' % offset)
+        if offset + countsize > size:
+            raise ImageError('TIFF IFD %d at offset %d is past the end of the file' % (pages + 1, offset))
+        seen.add(offset)
+        fh.seek(offset)
+        entries = struct.unpack(countfmt, fh.read(countsize))[0]
+        if entries == 0:
+            raise ImageError('TIFF IFD %d is empty' % (pages + 1))
+        nextoffset = offset + countsize + entries * entrysize
+        if nextoffset + nextsize > size:
+            raise ImageError('TIFF IFD %d is truncated' % (pages + 1))
+        pages += 1
+        if not countpages:
+            break
+        fh.seek(nextoffset)
+        offset = struct.unpack(nextfmt, fh.read(nextsize))[0]
+    if pages == 0:
+        raise ImageError('TIFF has no IFDs')
+    return pages
+
+
+def check_image(path, countpages=False):
+    """
+    Read enough of an image to tell it's sound.  Returns (format, pages,
+    bytes read), pages being None unless a TIFF is counted.  Raises
+    ImageError for a bad file, IOError/OSError if it can't be read.
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        if size == 0:
+            raise ImageError('empty file')
+        fh.seek(0)
+        header = fh.read(16)
+        if header[:4] in ('II*\x00', 'MM\x00*', 'II+\x00', 'MM\x00+'):
+            if size < 16 and header[2:4] in ('+\x00', '\x00+'):
+                raise ImageError('BigTIFF header is truncated')
+            pages = tiff_pages(fh, size, header, countpages)
+            return 'tiff', pages if countpages else None, fh.tell()
+        if header[:3] == '\xff\xd8\xff':
+            fh.seek(-2, os.SEEK_END)
+            if fh.read(2) != '\xff\xd9':
+                raise ImageError('JPEG has no end marker, truncated')
+            return 'jpeg', None, len(header) + 2
+        if header[:8] == '\x89PNG\r\n\x1a\n':
+            return 'png', None, len(header)
+        if header[:5] == '%PDF-':
+            return 'pdf', None, len(header)
+        raise ImageError('unrecognised image format', 'unknown')
+
+
+class ImageVerifier(object):
+    """
+    Verify the images of an OptFile.
+
+    Args:
+        threads- folders checked at once.
+        headers- read each image's header, default only check it exists.
+        countpages- walk TIFF IFDs to count pages, implies headers.
+
+    Attributes after verify:
+        problems- list of (begdoc, page key, path, status, detail).
+        stats- dict of folders, files, pages, bytes read, seconds and rates.
+    """
+    def __init__(self, threads=16, headers=False, countpages=False):
+        if threads < 1:
+            raise ValueError('threads must be at least 1, not %s' % threads)
+        self.threads = threads
+        self.countpages = countpages
+        self.headers = headers or countpages
+        self.problems = []
+        self.stats = {}
+
+    def _folders(self, optfile):
+        """folder path -> {file name: [(begdoc, page key), ...]}."""
+        store = optfile.pagestore
+        byfolder = {}
+        for docnum, record in optfile.docrecords.iteritems():
+            for row in xrange(record.start, record.end):
+                folder = store.dirs[store.dirids[row]]
+                name = store.path(row)[len(folder):]
+                byfolder.setdefault(folder, {}).setdefault(name, []).append((docnum, store.key(row)))
+        return byfolder
+
+    def _check_folder(self, task):
+        folder, names = task
+        problems = []
+        checked = 0
+        nbytes = 0
+        try:
+            files, subdirs = filescan.listdir(folder or os.curdir)
+        except OSError as e:
+            for name, refs in names.iteritems():
+                problems.extend((docnum, key, folder + name, 'missing', 'folder unreadable: %s' % e)
+                                for docnum, key in refs)
+            return problems, checked, nbytes
+        present = set(os.path.normcase(name) for name in files)
+        for name, refs in names.iteritems():
+            path = folder + name
+            if os.path.normcase(name) not in present:
+                problems.extend((docnum, key, path, 'missing', '') for docnum, key in refs)
+                continue
+            checked += 1
+            if not self.headers:
+                continue
+            try:
+                kind, pages, read = check_image(path, self.countpages)
+            except ImageError as e:
+                problems.extend((docnum, key, path, e.status, str(e)) for docnum, key in refs)
+                continue
+            except (IOError, OSError) as e:
+                problems.extend((docnum, key, path, 'unreadable', str(e)) for docnum, key in refs)
+                continue
+            nbytes += read
+            listed = len(set(key for docnum, key in refs))
+            if pages is not None and pages < listed:
+                detail = 'TIFF has %d pages, the opt lists %d' % (pages, listed)
+                problems.extend((docnum, key, path, 'pagecount', detail) for docnum, key in refs)
+        return problems, checked, nbytes
+
+    def verify(self, optfile, progress=None):
+        """Check every page of optfile, returns the problems list.  progress
+        is an optional callable given (folders done, folder count).
+        """
+        starttime = time.time()
+        byfolder = self._folders(optfile)
+        pages = sum(len(refs) for names in byfolder.itervalues() for refs in names.itervalues())
+        files = sum(len(names) for names in byfolder.itervalues())
+        self.problems = []
+        checked = nbytes = done = 0
+        pool = ThreadPool(self.threads)
+        try:
+            for problems, fchecked, fbytes in pool.imap_unordered(self._check_folder,
+                                                                  byfolder.iteritems()):
+                self.problems.extend(problems)
+                checked += fchecked
+                nbytes += fbytes
+                done += 1
+                if progress is not None:
+                    progress(done, len(byfolder))
+        finally:
+            pool.terminate()
+        for key, docnums in optfile.bates_index().duplicates():
+            detail = 'page key listed %d times' % len(docnums)
+            self.problems.extend((docnum, key, '', 'duplicate', detail) for docnum in sorted(set(docnums)))
+        seconds = time.time() - starttime
+        self.stats = {'folders': len(byfolder), 'files': files, 'pages': pages,
+                      'files_found': checked, 'bytes_read': nbytes, 'seconds': seconds,
+                      'files_per_sec': files / seconds if seconds else 0.0,
+                      'folders_per_sec': len(byfolder) / seconds if seconds else 0.0}
+        return self.problems
+
+    def write_report(self, csvpath):
+        with open(csvpath, 'wb') as reportfh:
+            writer = csv.writer(reportfh)
+            writer.writerow(['BegDoc', 'Page', 'Path', 'Status', 'Detail'])
+            writer.writerows(sorted(self.problems))
+
+    def summary(self):
+        counts = {}
+        for problem in self.problems:
+            counts[problem[3]] = counts.get(problem[3], 0) + 1
+        stats = self.stats
+        lines = ['%(pages)s pages in %(files)s files across %(folders)s folders' % stats,
+                 '%d:%.1f' % divmod(stats['seconds'], 60) +
+                 ', %(files_per_sec).1f files/sec, %(folders_per_sec).1f folders/sec, '
+                 '%(bytes_read)s header bytes read' % stats]
+        if counts:
+            lines.append('Problem pages: ' + ', '.join('%s %s' % (status, counts[status])
+                                                      for status in sorted(counts)))
+        else:
+            lines.append('No problems found')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Verify the images an opticon file points to')
+    parser.add_argument('optpath', action='store', nargs='+', help='opticon file(s)')
+    parser.add_argument('-pathroot', action='store', default=None,
+                        help='folder the opt image paths are relative to')
+    parser.add_argument('-threads', '-t', action='store', type=int, default=16,
+                        help='folders checked at once, default 16')
+    parser.add_argument('-headers', action='store_true', default=False,
+                        help='read each image header, flag')
+    parser.add_argument('-pages', action='store_true', default=False,
+                        help='count TIFF pages against the opt rows, implies -headers, flag')
+    parser.add_argument('-report', action='store', default='ImageVerify.csv',
+                        help='problem report csv, default ImageVerify.csv')
+    args = parser.parse_args()
+    if args.threads < 1:
+        parser.error('-threads must be at least 1')
+
+    starttime = time.time()
+    optfile = optdattools.OptFile()
+    for optpath in args.optpath:
+        optfile.load_opt(optpath, args.pathroot)
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('%s documents loaded in %s' % (len(optfile), ctime))
+
+    verifier = ImageVerifier(args.threads, args.headers, args.pages)
+    verifier.verify(optfile)
+    verifier.write_report(args.report)
+    print(verifier.summary())
+    print('Report written to %s' % args.report)
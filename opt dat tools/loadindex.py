@@ -0,0 +1,448 @@
+"""
+Memory mapped, lazily indexed access to huge opticon and Concordance dat files.
+
+For looking up a few thousand keys in a load file too big to parse whole.
+The file is memory mapped and a sidecar index of key -> byte offset is built
+on the first open and saved next to it (<loadfile>.idx).  Later opens map
+the sidecar too, so they take milliseconds, and records are only parsed when
+asked for.  The sidecar holds the load file's size, mtime and a checksum of
+its first and last blocks, plus the index field, and is rebuilt when any of
+them no longer match.
+
+    dat = loadindex.MappedDat('VOL001.dat', 'BegBates')
+    print dat['ABC0000001']['LoanNumber']
+    opt = loadindex.MappedOpt('VOL001.opt', pathroot=r'c:\\images')
+    print opt['ABC0000001'].paths
+
+The sidecar stores a 64 bit hash of each key sorted with its offset.  A
+lookup binary searches the hashes and checks the key of the record found,
+so hash collisions cost a parse, never a wrong answer.  Like load_dat and
+load_opt, the last record wins when a key is repeated.
+"""
+from __future__ import print_function
+import os
+import csv
+import mmap
+import zlib
+import heapq
+import shutil
+import struct
+import hashlib
+
+import optdattools
+
+INDEX_MAGIC = 'GELIDX01'
+INDEX_HEADER = struct.Struct('<8sQdIQI')  # magic, size, mtime, checksum, count, keyname length
+ENTRY = struct.Struct('<Q')
+SAMPLE_BLOCK = 1 << 16  # bytes at each end of the load file in the checksum
+OFFSET_BITS = 40  # load files up to 1TB
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+BUILD_RUN = 1 << 20  # entries sorted in memory at a time, more are merged from sorted runs on disk
+WRITE_BLOCK = 1 << 16  # entries packed per write
+RUN_READ_BLOCK = 1 << 12  # entries read at a time from each run while merging
+DAT_DELIM = chr(20)
+DAT_QUOTE = chr(254)
+
+
+def key_hash(key):
+    return ENTRY.unpack(hashlib.md5(key).digest()[:8])[0]
+
+
+def pack_entries(values):
+    return struct.pack('<%dQ' % len(values), *values)
+
+
+def write_run(path, entries):
+    """Write sorted packed entries to a run file as (hash, offset) pairs."""
+    with open(path, 'wb') as runfh:
+        for i in xrange(0, len(entries), WRITE_BLOCK):
+            values = []
+            for entry in entries[i:i + WRITE_BLOCK]:
+                values.append(entry >> OFFSET_BITS)
+                values.append(entry & OFFSET_MASK)
+            runfh.write(pack_entries(values))
+
+
+def read_run(path):
+    """Generate the packed entries of a run file in order."""
+    with open(path, 'rb') as runfh:
+        while True:
+            data = runfh.read(RUN_READ_BLOCK * ENTRY.size * 2)
+            if not data:
+                break
+            values = struct.unpack('<%dQ' % (len(data) // ENTRY.size), data)
+            for i in xrange(0, len(values), 2):
+                yield (values[i] << OFFSET_BITS) | values[i + 1]
+
+
+def file_checksum(path, size):
+    """crc32 of the first and last SAMPLE_BLOCK bytes of a file."""
+    with open(path, 'rb') as fh:
+        crc = zlib.crc32(fh.read(SAMPLE_BLOCK))
+        if size > SAMPLE_BLOCK:
+            fh.seek(max(SAMPLE_BLOCK, size - SAMPLE_BLOCK))
+            crc = zlib.crc32(fh.read(SAMPLE_BLOCK), crc)
+    return crc & 0xffffffff
+
+
+class MappedLoadFile(object):
+    """
+    Base for the mapped load files.  Subclasses give _scan, generating
+    (key, offset) for every record, and _key_at, the key of the record at
+    an offset.
+
+    Args:
+        path- the load file.
+        keyname- what the keys are, stored in the sidecar so an index on
+                 another field is rebuilt rather than used.
+        indexpath- sidecar index file, default path + '.idx'.
+        rebuild- build the index even if the sidecar is current.
+
+    Attributes:
+        built- True when the index was built by this open rather than reused.
+    """
+    def __init__(self, path, keyname, indexpath=None, rebuild=False):
+        self.path = path
+        self.keyname = keyname
+        self.indexpath = indexpath or path + '.idx'
+        self.built = False
+        self.size = os.path.getsize(path)
+        self._fh = open(path, 'rb')
+        self.mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ) if self.size else ''
+        self._setup()
+        self._indexfh = None
+        self.idx = None
+        if rebuild or not self._open_index():
+            self._build_index()
+            if not self._open_index():
+                raise IOError('Index %s unreadable after building it' % self.indexpath)
+
+    def _setup(self):
+        """Read anything needed before scanning, e.g. a header row."""
+        pass
+
+    def _signature(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime, file_checksum(self.path, st.st_size)
+
+    def _open_index(self):
+        """Map the sidecar index if it matches the load file, returns whether it did."""
+        if not os.path.exists(self.indexpath):
+            return False
+        fh = open(self.indexpath, 'rb')
+        try:
+            header = fh.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                fh.close()
+                return False
+            magic, size, mtime, checksum, count, namelen = INDEX_HEADER.unpack(header)
+            keyname = fh.read(namelen)
+            if magic != INDEX_MAGIC or keyname != self.keyname or \
+                    (size, mtime, checksum) != self._signature():
+                fh.close()
+                return False
+            start = INDEX_HEADER.size + namelen
+            if os.path.getsize(self.indexpath) != start + count * ENTRY.size * 2:
+                fh.close()
+                return False
+            self.idx = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if count else ''
+        except (IOError, struct.error):
+            fh.close()
+            return False
+        self._indexfh = fh
+        self.count = count
+        self._hashstart = start
+        self._offsetstart = start + count * ENTRY.size
+        return True
+
+    def _build_index(self):
+        """
+        Sort the (hash, offset) entries and write the sidecar.  At most
+        BUILD_RUN entries are held in memory, a bigger load file is sorted
+        in runs written next to the index and merged from there.  The
+        offsets column is spooled to a file while the hashes are written.
+        """
+        runpaths = []
+        offsetpath = self.indexpath + '.offsets'
+        tmppath = self.indexpath + '.tmp'
+        try:
+            # hash and offset packed into one long so a plain sort orders both
+            entries = []
+            count = 0
+            for key, offset in self._scan():
+                entries.append((key_hash(key) << OFFSET_BITS) | offset)
+                if len(entries) >= BUILD_RUN:
+                    entries.sort()
+                    runpaths.append(self.indexpath + '.run%d' % len(runpaths))
+                    write_run(runpaths[-1], entries)
+                    count += len(entries)
+                    entries = []
+            entries.sort()
+            count += len(entries)
+            if runpaths:
+                merged = heapq.merge(entries, *[read_run(runpath) for runpath in runpaths])
+            else:
+                merged = entries
+            size, mtime, checksum = self._signature()
+            with open(tmppath, 'wb') as idxfh, open(offsetpath, 'w+b') as offsetfh:
+                idxfh.write(INDEX_HEADER.pack(INDEX_MAGIC, size, mtime, checksum,
+                                              count, len(self.keyname)))
+                idxfh.write(self.keyname)
+                hashes = []
+                offsets = []
+                for entry in merged:
+                    hashes.append(entry >> OFFSET_BITS)
+                    offsets.append(entry & OFFSET_MASK)
+                    if len(hashes) >= WRITE_BLOCK:
+                        idxfh.write(pack_entries(hashes))
+                        offsetfh.write(pack_entries(offsets))
+                        hashes = []
+                        offsets = []
+                idxfh.write(pack_entries(hashes))
+                offsetfh.write(pack_entries(offsets))
+                offsetfh.seek(0)
+                shutil.copyfileobj(offsetfh, idxfh)
+        finally:
+            for path in runpaths + [offsetpath]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if os.path.exists(self.indexpath):
+            os.remove(self.indexpath)  # os.rename won't replace on Windows
+        os.rename(tmppath, self.indexpath)
+        self.built = True
+
+    def _hash(self, i):
+        return ENTRY.unpack_from(self.idx, self._hashstart + i * ENTRY.size)[0]
+
+    def _offset(self, i):
+        return ENTRY.unpack_from(self.idx, self._offsetstart + i * ENTRY.size)[0]
+
+    def offset(self, key):
+        """Byte offset of the last record with key, None if there isn't one."""
+        target = key_hash(key)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = None
+        while lo < self.count and self._hash(lo) == target:
+            offset = self._offset(lo)
+            if self._key_at(offset) == key:
+                found = offset
+            lo += 1
+        return found
+
+    def _lines(self, offset):
+        """Generate (offset, line) from offset to the end of the file."""
+        mm = self.mm
+        end = self.size
+        while offset < end:
+            nl = mm.find('\n', offset)
+            nextoffset = end if nl == -1 else nl + 1
+            yield offset, mm[offset:nextoffset]
+            offset = nextoffset
+
+    def __contains__(self, key):
+        return self.offset(key) is not None
+
+    def __len__(self):
+        """Number of records indexed, repeated keys included."""
+        return self.count
+
+    def close(self):
+        if self.idx:
+            self.idx.close()
+        if self._indexfh is not None:
+            self._indexfh.close()
+        if self.mm:
+            self.mm.close()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MappedDat(MappedLoadFile):
+    """
+    Concordance dat with records parsed on lookup.  dat[key] gives the record
+    as a dict of field -> value, like DatFile.datrecords[key].  Quoted values
+    may hold line breaks.
+
+    Args:
+        datpath- the dat file.
+        index_header- header of the key field.
+        indexpath, rebuild- as MappedLoadFile.
+    """
+    def __init__(self, datpath, index_header, indexpath=None, rebuild=False):
+        self.index_fieldname = index_header
+        super(MappedDat, self).__init__(datpath, index_header, indexpath, rebuild)
+
+    def _setup(self):
+        records = self._records(0)
+        try:
+            headeroffset, headertext = records.next()
+        except StopIteration:
+            raise ValueError('%s has no header row' % self.path)
+        self.header_row = self._parse(headertext)
+        self.dataoffset = headeroffset + len(headertext)
+        self.keypos = self.header_row.index(self.index_fieldname)
+
+    def _records(self, offset):
+        """Generate (offset, text) of each record, joining lines that end inside quotes."""
+        start = None
+        quotes = 0
+        for lineoffset, line in self._lines(offset):
+            if start is None:
+                start = lineoffset
+                parts = [line]
+            else:
+                parts.append(line)
+            quotes += line.count(DAT_QUOTE)
+            if quotes % 2 == 0:
+                yield start, ''.join(parts)
+                start = None
+                quotes = 0
+        if start is not None:
+            yield start, ''.join(parts)
+
+    def _parse(self, text):
+        return csv.reader(text.splitlines(True), delimiter=DAT_DELIM, quotechar=DAT_QUOTE).next()
+
+    def _fastkey(self, text):
+        # the key field can't hold the delimiter, so no need for a full parse
+        fields = text.split(DAT_DELIM, self.keypos + 1)
+        if len(fields) <= self.keypos:
+            return ''
+        return fields[self.keypos].rstrip('\r\n').strip(DAT_QUOTE)
+
+    def _scan(self):
+        for offset, text in self._records(self.dataoffset):
+            if text.strip():
+                yield self._fastkey(text), offset
+
+    def _key_at(self, offset):
+        return self._fastkey(self._records(offset).next()[1])
+
+    def record(self, offset):
+        """The record at offset as a dict of field -> value."""
+        values = self._parse(self._records(offset).next()[1])
+        return dict(zip(self.header_row, values))
+
+    def __getitem__(self, key):
+        offset = self.offset(key)
+        if offset is None:
+            raise KeyError(key)
+        return self.record(offset)
+
+    def get(self, key, default=None):
+        offset = self.offset(key)
+        return default if offset is None else self.record(offset)
+
+
+class MappedOpt(MappedLoadFile):
+    """
+    Opticon file with every page key indexed.  opt[begdoc] gives the
+    document starting at begdoc as an OptRecord, opt.page(key) the split
+    row of any page.
+
+    Args:
+        optpath- the opt file.
+        pathroot- joined to each image path as in OptFile.load_opt.
+        indexpath, rebuild- as MappedLoadFile.
+    """
+    def __init__(self, optpath, pathroot=None, indexpath=None, rebuild=False):
+        self.pathroot = pathroot
+        super(MappedOpt, self).__init__(optpath, 'opt', indexpath, rebuild)
+
+    def _scan(self):
+        for offset, line in self._lines(0):
+            if line.strip():
+                yield line[:line.find(',')], offset
+
+    def _key_at(self, offset):
+        return self.mm[offset:self.mm.find(',', offset)]
+
+    def _row(self, line):
+        fields = line.split(',')
+        if self.pathroot is not None:
+            fields[2] = optdattools._joinpath(self.pathroot, fields[2])
+        return fields
+
+    def page(self, key):
+        """The split opt row of one page."""
+        offset = self.offset(key)
+        if offset is None:
+            raise KeyError(key)
+        return self._row(self._lines(offset).next()[1])
+
+    def __getitem__(self, begdoc):
+        offset = self.offset(begdoc)
+        if offset is None:
+            raise KeyError(begdoc)
+        rows = []
+        for lineoffset, line in self._lines(offset):
+            if not line.strip():
+                continue
+            fields = self._row(line)
+            docbreak = len(fields) > 3 and fields[3].rstrip('\r\n') == 'Y'
+            if docbreak and rows:
+                break
+            if not rows and not docbreak and lineoffset != 0:
+                raise KeyError('%s is a page inside a document, not a begdoc' % begdoc)
+            rows.append(fields)
+        return optdattools.OptRecord(pages=rows)
+
+    def get(self, begdoc, default=None):
+        try:
+            return self[begdoc]
+        except KeyError:
+            return default
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Look up keys in a load file through its sidecar index')
+    parser.add_argument('loadfile', action='store', help='opt or dat file')
+    parser.add_argument('keys', action='store', nargs='*', help='keys to look up')
+    parser.add_argument('-field', action='store', default=None,
+                        help='dat index field, the file is read as an opt without it')
+    parser.add_argument('-keyfile', action='store', default=None,
+                        help='file of keys to look up, one per line')
+    parser.add_argument('-rebuild', action='store_true', default=False,
+                        help='rebuild the sidecar index, flag')
+    args = parser.parse_args()
+
+    starttime = time.time()
+    if args.field is not None:
+        loadfile = MappedDat(args.loadfile, args.field, rebuild=args.rebuild)
+    else:
+        loadfile = MappedOpt(args.loadfile, rebuild=args.rebuild)
+    ctime = '%d:%.3f' % divmod(time.time() - starttime, 60)
+    print('%s records, index %s in %s' % (len(loadfile), 'built' if loadfile.built else 'reused', ctime),
+          file=sys.stderr)
+
+    keys = list(args.keys)
+    if args.keyfile is not None:
+        with open(args.keyfile) as keyfh:
+            keys.extend(line.strip() for line in keyfh if line.strip())
+    starttime = time.time()
+    missing = 0
+    for key in keys:
+        value = loadfile.get(key)
+        if isinstance(value, optdattools.OptRecord):
+            value = value.pages
+        if value is None:
+            missing += 1
+        print('%s\t%r' % (key, value))
+    ctime = '%d:%.3f' % divmod(time.time() - starttime, 60)
+    print('%s keys looked up, %s missing, in %s' % (len(keys), missing, ctime), file=sys.stderr)
+    loadfile.close()
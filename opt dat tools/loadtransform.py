@@ -0,0 +1,67 @@
+"""
+Stream an opt and dat pair through the optdattools Pipeline: re-path images,
+re-Bates number, subset fields, and write one pair or split it by a field.
+
+    python loadtransform.py VOL001.opt VOL001.dat -out D:\\PROD\\NEW001 -repath .\\IMAGES D:\\PROD\\IMAGES
+    python loadtransform.py VOL001.opt VOL001.dat -splitby LoanNumber -out D:\\PROD\\byloan
+    python loadtransform.py VOL001.opt VOL001.dat -out NEW001 -renumber ABC 1 8 -fields BegBates,EndBates,LoanNumber
+"""
+from __future__ import print_function
+import time
+
+import optdattools
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Transform an opt and dat pair in one streaming pass')
+    parser.add_argument('opt', action='store', help='opticon file, - for none')
+    parser.add_argument('dat', action='store', help='dat file, - for none')
+    parser.add_argument('-out', action='store', required=True,
+                        help='output path without extension, or the folder with -splitby')
+    parser.add_argument('-field', action='store', default='BegBates',
+                        help='dat field holding the begdoc, default BegBates')
+    parser.add_argument('-repath', action='store', nargs=2, default=None, metavar=('OLD', 'NEW'),
+                        help='replace the OLD image path prefix with NEW')
+    parser.add_argument('-volume', action='store', default=None,
+                        help='set the opt volume field')
+    parser.add_argument('-renumber', action='store', nargs=3, default=None,
+                        metavar=('PREFIX', 'START', 'WIDTH'), help='re-Bates number the pages')
+    parser.add_argument('-endfield', action='store', default='EndBates',
+                        help='dat field updated with the last page by -renumber, default EndBates')
+    parser.add_argument('-fields', action='store', default=None,
+                        help='comma separated dat fields to keep, in order')
+    parser.add_argument('-splitby', action='store', default=None,
+                        help='write one opt and dat pair per value of this dat field')
+    args = parser.parse_args()
+
+    starttime = time.time()
+    optpath = None if args.opt == '-' else args.opt
+    datpath = None if args.dat == '-' else args.dat
+    reader = optdattools.LoadFileReader(optpath, datpath, args.field)
+    fields = args.fields.split(',') if args.fields else reader.header_row
+    pipeline = optdattools.Pipeline(reader)
+    if args.repath is not None or args.volume is not None:
+        old, new = args.repath or ('', '')
+        pipeline.map(optdattools.repath(old, new, args.volume))
+    if args.renumber is not None:
+        prefix, start, width = args.renumber
+        pipeline.map(optdattools.renumber(prefix, int(start), int(width), args.field, args.endfield))
+    if args.fields:
+        pipeline.map(optdattools.select_fields(fields))
+    if args.splitby is not None:
+        splitby = args.splitby
+        if splitby not in fields:
+            parser.error('-splitby field %s is not in the dat fields kept' % splitby)
+
+        def splitkey(doc):
+            return (doc.fields.get(splitby) or None) if doc.fields else None
+        writer = optdattools.SplitWriter(args.out, splitkey, fields if datpath else None,
+                                         writeopt=optpath is not None)
+    else:
+        writer = optdattools.LoadFileWriter(args.out + '.opt' if optpath else None,
+                                            args.out + '.dat' if datpath else None, fields)
+    count = pipeline.write(writer)
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('%s documents written in %s' % (count, ctime))
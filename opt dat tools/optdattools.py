@@ -7,71 +7,533 @@
 #import sys
 #import os.path
 import csv
+import re
 import os
 import os.path
+import time
+import zlib
+import bisect
+import struct
+import marshal
+import itertools
+import collections
+import multiprocessing
+from array import array
 
 
-class OptRecord:
+DIGITS = '0123456789'
+MAX_KEY_DIGITS = 15  # Bates numbers are kept in a double, exact to 15 digits
+INTERN_SAMPLE = 10000  # dat rows read before deciding which columns share repeated values
+SNAPSHOT_MAGIC = 'GELSNAP\x00'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sIII')  # magic, version, section count, crc32 of the section table
+SNAPSHOT_SECTION = struct.Struct('<16s4sQQI')  # name, kind, offset, length, crc32
+DAT_DELIM = chr(20)
+DAT_QUOTE = chr(254)
+UTF8_BOM = '\xef\xbb\xbf'
+LINE_END = '\r\n'
+WRITE_BATCH = 2000  # lines collected before each write
+FILENAME_UNSAFE = re.compile(r'[\\/:*?"<>|]')
+OPTPAGES_ARRAYS = ['keyprefixids', 'keynums', 'keywidths', 'volids', 'dirids', 'namedbykey']
+
+
+class OptPages(object):
+    """
+    Columnar storage for the page rows of one or more opticon files, shared
+    by the OptRecords that point into it.  Row i is split into:
+     keyprefixids[i], keynums[i], keywidths[i]- the page's image key (Bates
+                 number) as an index into keyprefixes, its number and its zero
+                 padded width.  Keys without a trailing number go in oddkeys.
+     volids[i]- index into volumes of the volume name.
+     dirids[i], filenames[i]- image path as an index into dirs, which hold
+                 the directory part with its trailing separator, plus the name.
+                 When the name starts with the key (ABC0001.TIF for ABC0001)
+                 only the shared suffix is kept and namedbykey[i] is 1.
+     tails[i]- the rest of the row from the doc break field on, unsplit.
+                 There are only a handful of distinct ones so they are shared.
+    Equal file names are shared within each extend_rows or extend call, the
+    dict doing it is dropped when the call returns.
+    """
+    def __init__(self):
+        self.keyprefixids = array('I')
+        self.keynums = array('d')
+        self.keywidths = array('B')
+        self.keyprefixes = []
+        self.oddkeys = {}
+        self.volids = array('I')
+        self.volumes = []
+        self.dirids = array('I')
+        self.dirs = []
+        self.filenames = []
+        self.namedbykey = array('B')
+        self.tails = []
+        self._prefixidx = {}
+        self._volidx = {}
+        self._diridx = {}
+        self._tails = {}
+
+    def __len__(self):
+        return len(self.volids)
+
+    def append(self, key, volume, path, tail):
+        """
+        Add one row, given as its first three fields and the rest of the line
+        from the doc break field on.  Returns its row number.
+        """
+        self.extend_rows(((key, volume, path, tail),))
+        return len(self.volids) - 1
+
+    def extend_rows(self, rows):
+        """
+        Add rows given as (key, volume, path, tail), as append.  Loading a
+        whole opt through here is much faster than append per row: the
+        methods are looked up once, and the key prefix, volume and directory
+        ids of the previous row are reused while they repeat, as they do
+        down an opt.
+        """
+        keyprefixids = self.keyprefixids.append
+        keynums = self.keynums.append
+        keywidths = self.keywidths.append
+        volids = self.volids.append
+        dirids = self.dirids.append
+        namedbykey = self.namedbykey.append
+        filenames = self.filenames.append
+        tails = self.tails.append
+        names = {}
+        sharedtail = self._tails.setdefault
+        row = len(self.volids)
+        lastprefix = lastvolume = dirpath = None
+        for key, volume, path, tail in rows:
+            prefix = key.rstrip(DIGITS)
+            width = len(key) - len(prefix)
+            if 0 < width <= MAX_KEY_DIGITS:
+                if prefix != lastprefix:
+                    lastprefix = prefix
+                    prefixid = self._id(self._prefixidx, self.keyprefixes, prefix)
+                keyprefixids(prefixid)
+                keynums(float(key[-width:]))  # digits only, so exact and quicker than int
+                keywidths(width)
+            else:
+                keyprefixids(0)
+                keynums(0)
+                keywidths(0)
+                self.oddkeys[row] = key
+            if volume != lastvolume:
+                lastvolume = volume
+                volid = self._id(self._volidx, self.volumes, volume)
+            volids(volid)
+            name = path[len(dirpath):] if dirpath is not None and path.startswith(dirpath) else None
+            if name is None or '\\' in name or '/' in name:
+                cut = max(path.rfind('\\'), path.rfind('/')) + 1
+                dirpath = path[:cut]
+                name = path[cut:]
+                dirid = self._id(self._diridx, self.dirs, dirpath)
+            dirids(dirid)
+            if name.startswith(key):
+                name = name[len(key):]
+                namedbykey(1)
+            else:
+                namedbykey(0)
+            filenames(names.setdefault(name, name))
+            tails(sharedtail(tail, tail))
+            row += 1
+
+    def append_fields(self, fields):
+        """Add one row given as its list of fields."""
+        return self.append(fields[0], fields[1], fields[2], ','.join(fields[3:]))
+
+    def extend(self, other):
+        """Append every row of another OptPages.  Returns the row number its
+        first row now has.
+        """
+        base = len(self)
+        prefixmap = [self._id(self._prefixidx, self.keyprefixes, p) for p in other.keyprefixes] or [0]
+        volmap = [self._id(self._volidx, self.volumes, v) for v in other.volumes]
+        dirmap = [self._id(self._diridx, self.dirs, d) for d in other.dirs]
+        self.keyprefixids.extend(array('I', [prefixmap[i] for i in other.keyprefixids]))
+        self.keynums.extend(other.keynums)
+        self.keywidths.extend(other.keywidths)
+        for row, key in other.oddkeys.iteritems():
+            self.oddkeys[base + row] = key
+        self.volids.extend(array('I', [volmap[i] for i in other.volids]))
+        self.dirids.extend(array('I', [dirmap[i] for i in other.dirids]))
+        self.namedbykey.extend(other.namedbykey)
+        names = {}
+        self.filenames.extend([names.setdefault(name, name) for name in other.filenames])
+        sharedtail = self._tails.setdefault
+        self.tails.extend([sharedtail(tail, tail) for tail in other.tails])
+        return base
+
+    def _id(self, index, values, value):
+        i = index.get(value)
+        if i is None:
+            i = self._newid(index, values, value)
+        return i
+
+    def _newid(self, index, values, value):
+        index[value] = len(values)
+        values.append(value)
+        return index[value]
+
+    def key(self, i):
+        width = self.keywidths[i]
+        if width == 0:
+            return self.oddkeys[i]
+        return '%s%0*d' % (self.keyprefixes[self.keyprefixids[i]], width, self.keynums[i])
+
+    def path(self, i):
+        if self.namedbykey[i]:
+            return self.dirs[self.dirids[i]] + self.key(i) + self.filenames[i]
+        return self.dirs[self.dirids[i]] + self.filenames[i]
+
+    def volume(self, i):
+        return self.volumes[self.volids[i]]
+
+    def row(self, i):
+        """Row i as the list of fields it was read from."""
+        return [self.key(i), self.volume(i), self.path(i)] + self.tails[i].split(',')
+
+
+class OptRecord(object):
     """
-    Data structure of a document in an opt with associated metadata.
+    Data structure of a document in an opt with associated metadata.  Only
+    the document's range of rows in a shared OptPages is stored.
 
     Fields/init args:
      pages- list of rows from the opt file. Each row is also a list of
                  the fields in that row, e.g. pages[0][0] is the begdoc of the
-                 first page of the row.
+                 first page of the row.  Built on access from the page store.
+     store, start, end- alternatively the OptPages and the [start, end) row
+                 range holding this document's rows.
+     begdoc- optional, saves reading it from the store when already known.
+    """
+    __slots__ = ('begdoc', 'store', 'start', 'end')
+
+    def __init__(self, pages=None, store=None, start=0, end=0, begdoc=None):
+        if pages is not None:
+            store = OptPages()
+            start = 0
+            store.extend_rows((row[0], row[1], row[2], ','.join(row[3:])) for row in pages)
+            end = len(store)
+        self.store = store
+        self.start = start
+        self.end = end
+        self.begdoc = begdoc if begdoc is not None else store.key(start)
+
+    @property
+    def pgcount(self):
+        return self.end - self.start
+
+    @property
+    def pages(self):
+        return [self.store.row(i) for i in xrange(self.start, self.end)]
+
+    @property
+    def paths(self):
+        """Image path of each page."""
+        return [self.store.path(i) for i in xrange(self.start, self.end)]
+
+    @property
+    def keys(self):
+        """Image key of each page."""
+        return [self.store.key(i) for i in xrange(self.start, self.end)]
+
+
+def iter_opt(optpath, pathroot=None):
     """
-    def __init__(self, pages):
-        self.begdoc = pages[0][0]
-        self.pages = pages
-        self.pgcount = len(pages)
+    Generate (begdoc, rows) for each document in an opticon file, reading
+    one line at a time.  rows is the document's list of split rows as in
+    OptRecord.pages.  For one pass jobs that don't need the whole file held.
+    """
+    currlines = []
+    for fields in _opt_rows(optpath, pathroot):
+        if fields[3] == 'Y' and currlines:  # a new doc, hand over the current one
+            yield currlines[0][0], currlines
+            currlines = []
+        currlines.append(fields)
+    if currlines:
+        yield currlines[0][0], currlines
+
+
+def _opt_rows(optpath, pathroot=None, maxsplit=-1):
+    with open(optpath, 'r') as optfh:
+        for line in optfh:
+            if not line.strip():
+                continue
+            fields = line.split(',', maxsplit)
+            if pathroot is not None:
+                fields[2] = _joinpath(pathroot, fields[2])
+            yield fields
+
+
+def _joinpath(root, path):
+    if os.sep == '/':  # on linux
+        path = path.replace('\\', '/').strip('./')  # change windows path to linux
+        return os.path.join(root, path)
+    else:  # Assume on Windows
+        path = path.strip('.\\')
+        return os.path.join(root, path)
+
+
+def split_bates(key):
+    """Split a Bates number into (prefix, number), number None if the key
+    doesn't end in digits or has too many to hold exactly.
+    """
+    prefix = key.rstrip(DIGITS)
+    number = key[len(prefix):]
+    if 0 < len(number) <= MAX_KEY_DIGITS:
+        return prefix, int(number)
+    return key, None
+
+
+class BatesIndex(object):
+    """
+    Sorted index of every page of an OptFile's documents by Bates number,
+    split into prefix and number.  Each prefix has its page numbers sorted
+    in an array with the matching page rows and document ids, so lookups
+    and range queries are bisects.  Keys that don't end in digits are only
+    found by exact lookup.
+
+    Zero padding is part of a key: find, contains and duplicates only match
+    pages with the same padding, so ABC001 is not ABC0001, and overlaps
+    compares each padding width's pages separately.  range, count,
+    docs_in_range and gaps go by number and include pages of any padding.
+
+    Built by OptFile.bates_index.
+    """
+    def __init__(self, optfile):
+        store = optfile.pagestore
+        self.store = store
+        self.docnums = []
+        grouped = {}  # prefix id -> list of (number, row, doc id)
+        self.oddkeys = {}
+        for docid, (docnum, record) in enumerate(optfile.docrecords.iteritems()):
+            self.docnums.append(docnum)
+            for row in xrange(record.start, record.end):
+                if store.keywidths[row]:
+                    grouped.setdefault(store.keyprefixids[row], []).append(
+                        (store.keynums[row], row, docid))
+                else:
+                    self.oddkeys.setdefault(store.oddkeys[row], []).append((row, docid))
+        self.numbers = {}
+        self.rows = {}
+        self.docids = {}
+        for prefixid, pages in grouped.iteritems():
+            pages.sort()
+            prefix = store.keyprefixes[prefixid]
+            self.numbers[prefix] = array('d', [page[0] for page in pages])
+            self.rows[prefix] = array('I', [page[1] for page in pages])
+            self.docids[prefix] = array('I', [page[2] for page in pages])
+
+    def __len__(self):
+        return sum(len(numbers) for numbers in self.numbers.itervalues()) + \
+            sum(len(pages) for pages in self.oddkeys.itervalues())
+
+    def prefixes(self):
+        return sorted(self.numbers)
+
+    def _span(self, prefix, low, high):
+        """Index range of prefix's pages numbered low to high inclusive."""
+        numbers = self.numbers.get(prefix)
+        if numbers is None:
+            return None, 0, 0
+        return numbers, bisect.bisect_left(numbers, low), bisect.bisect_right(numbers, high)
+
+    def find(self, key):
+        """Documents containing page key, as a list of begdocs, more than one
+        if the page is in several.
+        """
+        prefix, number = split_bates(key)
+        if number is None:
+            return [self.docnums[docid] for row, docid in self.oddkeys.get(key, [])]
+        width = len(key) - len(prefix)
+        numbers, lo, hi = self._span(prefix, number, number)
+        keywidths = self.store.keywidths
+        rows = self.rows.get(prefix)
+        return [self.docnums[self.docids[prefix][i]] for i in xrange(lo, hi)
+                if keywidths[rows[i]] == width]
+
+    def contains(self, key):
+        """Begdoc of the document holding page key, None if no document does."""
+        found = self.find(key)
+        return found[0] if found else None
+
+    def range(self, begin, end):
+        """(page key, begdoc) of every page from begin to end inclusive, in
+        Bates order.  Both ends need the same prefix.
+        """
+        prefix, low = split_bates(begin)
+        endprefix, high = split_bates(end)
+        if low is None or high is None or prefix != endprefix:
+            raise ValueError('Bates range %s-%s needs numbered keys with the same prefix' % (begin, end))
+        numbers, lo, hi = self._span(prefix, low, high)
+        rows = self.rows.get(prefix)
+        docids = self.docids.get(prefix)
+        return [(self.store.key(rows[i]), self.docnums[docids[i]]) for i in xrange(lo, hi)]
+
+    def count(self, begin, end):
+        """Number of pages from begin to end inclusive, without listing them."""
+        prefix, low = split_bates(begin)
+        endprefix, high = split_bates(end)
+        if low is None or high is None or prefix != endprefix:
+            raise ValueError('Bates range %s-%s needs numbered keys with the same prefix' % (begin, end))
+        numbers, lo, hi = self._span(prefix, low, high)
+        return hi - lo
+
+    def docs_in_range(self, begin, end):
+        """Begdocs with at least one page from begin to end, in Bates order."""
+        seen = set()
+        out = []
+        for key, docnum in self.range(begin, end):
+            if docnum not in seen:
+                seen.add(docnum)
+                out.append(docnum)
+        return out
+
+    def gaps(self):
+        """Missing runs of numbers within each prefix, as (first missing key,
+        last missing key) pairs padded like the page before the gap.
+        """
+        out = []
+        for prefix in self.prefixes():
+            numbers = self.numbers[prefix]
+            rows = self.rows[prefix]
+            for i in xrange(1, len(numbers)):
+                if numbers[i] > numbers[i - 1] + 1:
+                    width = self.store.keywidths[rows[i - 1]]
+                    out.append(('%s%0*d' % (prefix, width, numbers[i - 1] + 1),
+                                '%s%0*d' % (prefix, width, numbers[i] - 1)))
+        return out
+
+    def overlaps(self):
+        """Pairs of documents whose Bates ranges overlap, as (begdoc, begdoc)
+        with the one starting first first.  Documents sharing a page overlap.
+        Pages padded to different widths are separate ranges.
+        """
+        out = []
+        keywidths = self.store.keywidths
+        for prefix in self.prefixes():
+            bywidth = {}  # padding width -> {doc id: [lowest, highest] page number}
+            for number, row, docid in zip(self.numbers[prefix], self.rows[prefix], self.docids[prefix]):
+                spans = bywidth.setdefault(keywidths[row], {})
+                span = spans.get(docid)
+                if span is None:
+                    spans[docid] = [number, number]
+                else:
+                    span[1] = number
+            for width, spans in sorted(bywidth.iteritems()):
+                active = []  # (highest number, doc id) of docs that may still overlap
+                for docid, (low, high) in sorted(spans.iteritems(), key=lambda item: item[1]):
+                    active = [(end, other) for end, other in active if end >= low]
+                    out.extend((self.docnums[other], self.docnums[docid]) for end, other in active)
+                    active.append((high, docid))
+        return out
+
+    def duplicates(self):
+        """Page keys found more than once, as (key, [begdocs]).  Keys are
+        compared with their padding, ABC001 and ABC0001 aren't duplicates.
+        """
+        out = []
+        keywidths = self.store.keywidths
+        for prefix in self.prefixes():
+            numbers = self.numbers[prefix]
+            rows = self.rows[prefix]
+            i = 0
+            while i < len(numbers):
+                j = i + 1
+                while j < len(numbers) and numbers[j] == numbers[i]:
+                    j += 1
+                if j - i > 1:
+                    bywidth = {}  # padding width -> positions of the pages with it
+                    for k in xrange(i, j):
+                        bywidth.setdefault(keywidths[rows[k]], []).append(k)
+                    for width, same in sorted(bywidth.iteritems()):
+                        if len(same) > 1:
+                            out.append((self.store.key(rows[same[0]]),
+                                        [self.docnums[self.docids[prefix][k]] for k in same]))
+                i = j
+        for key, pages in sorted(self.oddkeys.iteritems()):
+            if len(pages) > 1:
+                out.append((key, [self.docnums[docid] for row, docid in pages]))
+        return out
 
 
 class OptFile(object):
     """Store a representation of an opticon file, dict of OptRecords keyed on
-    begdoc or docid
+    begdoc or docid.  The page rows of every loaded opt are kept in one
+    OptPages, pagestore.
     """
     def __init__(self):
         """Create empty dict for documents."""
         self.docrecords = {}
+        self.pagestore = OptPages()
+        self._batesindex = None
         super(OptFile, self).__init__()
 
-    def load_opt(self, optpath, pathroot=None):
+    def load_opt(self, optpath, pathroot=None, batesindex=False):
         """Loads a opticon file into the internal dict.
 
         Args:
             optpath- file path to the target opticon file.
             pathroot- if supplied joins the file path in each line of the opt
                         to this root before storing it.
+            batesindex- also build the BatesIndex now rather than on first use.
 
         """
-        currlines = []  # per loop storage of the current docs lines
-        with open(optpath, 'r') as optfh:
-            # TODO: add first line checking here.
-            firstline = optfh.readline().split(',')
-            if pathroot is not None:
-                firstline[2] = self._joinpath(pathroot, firstline[2])
-            currlines.append(firstline)
-
-            for line in optfh.readlines():
-                linesp = line.split(',')
-                if pathroot is not None:
-                    linesp[2] = self._joinpath(pathroot, linesp[2])
-                if linesp[3] == 'Y':  # if new opt doc store current lines
-                    self.docrecords[currlines[0][0]] = OptRecord(currlines)
-                    currlines = []
-                    currlines.append(linesp)
-                else:
-                    currlines.append(linesp)  # if not a new doc keep adding
+        store = self.pagestore
+        base = len(store)
+        # TODO: add first line checking here.
+        store.extend_rows(_opt_rows(optpath, pathroot, 3))
+        end = len(store)
+        if end > base:
+            # a new opt doc starts at each Y doc break, checked once per distinct tail
+            tails = store.tails
+            docbreak = dict((tail, tail[:2] == 'Y,' or tail.rstrip('\r\n') == 'Y')
+                            for tail in set(itertools.islice(tails, base, end)))
+            docstarts = [base] + [i for i in xrange(base + 1, end) if docbreak[tails[i]]]
+            for start, docend in zip(docstarts, docstarts[1:] + [end]):
+                self._add_doc(start, docend)
+        if batesindex:
+            self.bates_index()
 
-            self.docrecords[currlines[0][0]] = OptRecord(currlines)
+    def _add_doc(self, docstart, docend):
+        record = OptRecord(store=self.pagestore, start=docstart, end=docend)
+        self.docrecords[record.begdoc] = record
 
     def _joinpath(self, root, path):
-        if os.sep == '/':  # on linux
-            path = path.replace('\\', '/').strip('./')  # change windows path to linux
-            return os.path.join(root, path)
-        else:  # Assume on Windows
-            path = path.strip('.\\')
-            return os.path.join(root, path)
+        return _joinpath(root, path)
+
+    def bates_index(self, rebuild=False):
+        """The BatesIndex of the documents, built on first use and again when
+        documents have been loaded or merged since.  Use rebuild after
+        replacing documents directly.
+        """
+        state = (len(self.pagestore), len(self.docrecords))
+        if rebuild or self._batesindex is None or self._batesindex[0] != state:
+            self._batesindex = (state, BatesIndex(self))
+        return self._batesindex[1]
+
+    def write_opt(self, optpath):
+        """Write the documents to an opticon file in the order their pages were loaded."""
+        with OptWriter(optpath) as writer:
+            for record in sorted(self.docrecords.itervalues(), key=lambda record: record.start):
+                writer.write(record.pages)
+
+    def merge_opt(self, other):
+        """Add the documents of another OptFile, whose pages are copied into
+        this pagestore.  A later document replaces an earlier one with the
+        same begdoc, as when loading opts one after the other.
+
+        Returns a list of (begdoc, first page row of the replaced document).
+        """
+        base = self.pagestore.extend(other.pagestore)
+        replaced = []
+        for docnum, record in other.docrecords.iteritems():
+            if docnum in self.docrecords:
+                replaced.append((docnum, self.docrecords[docnum].start))
+            self.docrecords[docnum] = OptRecord(store=self.pagestore, start=base + record.start,
+                                                end=base + record.end, begdoc=record.begdoc)
+        return replaced
 
     #magic functions to give [] access to the docrecords dict.
 
@@ -92,34 +554,202 @@ class OptFile(object):
         return self.docrecords.iterkeys()
 
 
+class DatRow(collections.Mapping):
+    """
+    Read only dict like view of one dat row, field name -> value, reading
+    from the DatFile's columns.
+    """
+    __slots__ = ('datfile', 'row')
+
+    def __init__(self, datfile, row):
+        self.datfile = datfile
+        self.row = row
+
+    def __getitem__(self, field):
+        return self.datfile.columns[self.datfile.fieldindex[field]][self.row]
+
+    def __iter__(self):
+        return iter(self.datfile.fields)
+
+    def __len__(self):
+        return len(self.datfile.fields)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class DatRecords(collections.Mapping):
+    """Dict like view of a DatFile's rows keyed on the index field, values are DatRows."""
+    def __init__(self, datfile):
+        self.datfile = datfile
+
+    def __getitem__(self, key):
+        return DatRow(self.datfile, self.datfile.rowindex[key])
+
+    def __contains__(self, key):
+        return key in self.datfile.rowindex
+
+    def __iter__(self):
+        return iter(self.datfile.rowindex)
+
+    def __len__(self):
+        return len(self.datfile.rowindex)
+
+    def viewkeys(self):
+        return self.datfile.rowindex.viewkeys()
+
+    def viewvalues(self):
+        return collections.ValuesView(self)
+
+    def viewitems(self):
+        return collections.ItemsView(self)
+
+
+class LoanDocs(collections.Mapping):
+    """
+    One loan's docs in a LoanFileList loan index, docnum -> dict of its
+    filename and images.  The dicts are built on each lookup from the opt
+    and dat records rather than held.
+    """
+    __slots__ = ('loanlist', 'docnums', 'filenamefield')
+
+    def __init__(self, loanlist, docnums, filenamefield=None):
+        self.loanlist = loanlist
+        self.docnums = frozenset(docnums)
+        self.filenamefield = filenamefield
+
+    def __getitem__(self, docnum):
+        if docnum not in self.docnums:
+            raise KeyError(docnum)
+        return self.loanlist._docdetails(docnum, self.filenamefield)
+
+    def __contains__(self, docnum):
+        return docnum in self.docnums
+
+    def __iter__(self):
+        return iter(self.docnums)
+
+    def __len__(self):
+        return len(self.docnums)
+
+    def viewkeys(self):
+        return collections.KeysView(self)
+
+    def viewvalues(self):
+        return collections.ValuesView(self)
+
+    def viewitems(self):
+        return collections.ItemsView(self)
+
+
 class DatFile(object):
-    """Stores a representation of a Concordance dat in a main dict, keyed on
-    an index field.  Each record is stored as a sub-dict.
+    """Stores a representation of a Concordance dat column by column: one list
+    of values per field and an index of key -> row number on an index field.
+    datrecords gives dict like access to each record as a DatRow.
     """
     def __init__(self):
-        self.datrecords = {}
         self.header_row = []
+        self.fields = []  # the fields kept, header_row order
+        self.fieldindex = {}
+        self.columns = []
+        self.rowindex = {}
+        self.nrows = 0
+        self.datrecords = DatRecords(self)
         super(DatFile, self).__init__()
 
-    def load_dat(self, datpath, index_header):
+    def load_dat(self, datpath, index_header, fields=None):
         """Load a dat into the object.
 
         Args:
             datpath- path to the dat file to be loaded.
             index_header- Header column of dat that will be the lookup index.
+            fields- optional list of the fields to keep, the others are
+                    skipped while reading.  The index field is always kept.
 
         """
         with open(datpath) as datfh:
-            datreader = csv.reader(datfh, delimiter=chr(20), quotechar=chr(254))
+            datreader = csv.reader(datfh, delimiter=DAT_DELIM, quotechar=DAT_QUOTE)
             self.header_row = datreader.next()
             self.index_fieldname = index_header
             dictidx = self.header_row.index(index_header)
-            for row in datreader:
-                d = {}
-                for i, item in enumerate(row):
-                    d[self.header_row[i]] = item
-                self.datrecords[row[dictidx]] = d
-                #self.datrecords[row[dictidx]] = row
+            keep = [name for name in self.header_row
+                    if fields is None or name in fields or name == index_header]
+            columns = [self._column(name) for name in keep]
+            positions = [self.header_row.index(name) for name in keep]
+            missing = [col for name, col in zip(self.fields, self.columns) if name not in keep]
+            pool = [{} for name in keep]  # shared copies of repeated values, per column
+            rowindex = self.rowindex
+            row = self.nrows
+            for values in datreader:
+                if len(values) < len(self.header_row):
+                    values.extend([''] * (len(self.header_row) - len(values)))
+                for col, pos, shared in zip(columns, positions, pool):
+                    value = values[pos]
+                    if shared is not None:
+                        value = shared.setdefault(value, value)
+                    col.append(value)
+                for col in missing:  # fields an earlier dat had but this one doesn't
+                    col.append('')
+                rowindex[values[dictidx]] = row
+                row += 1
+                if row - self.nrows == INTERN_SAMPLE:
+                    # stop sharing values in mostly unique columns, the pool costs more than it saves
+                    pool = [None if shared is None or len(shared) > INTERN_SAMPLE // 2 else shared
+                            for shared in pool]
+            self.nrows = row
+
+    def _column(self, name):
+        """The value list for a field, added and padded for the rows so far if new."""
+        if name not in self.fieldindex:
+            self.fieldindex[name] = len(self.columns)
+            self.fields.append(name)
+            self.columns.append([''] * self.nrows)
+        return self.columns[self.fieldindex[name]]
+
+    def write_dat(self, datpath, fields=None):
+        """Write the records to a Concordance dat in the order they were loaded.
+
+        Args:
+            datpath- file to write.
+            fields- optional list of the fields to write, default all.
+        """
+        fields = list(fields) if fields is not None else self.fields
+        columns = [self.column(field) for field in fields]
+        with DatWriter(datpath, fields) as writer:
+            for row in sorted(self.rowindex.itervalues()):
+                writer.write_values([col[row] for col in columns])
+
+    def merge_dat(self, other):
+        """Append the rows of another DatFile, adding any fields it has that
+        this one doesn't.  A later row replaces an earlier one with the same key.
+
+        Returns a list of (key, row number of the replaced row).
+        """
+        if not self.header_row:
+            self.header_row = list(other.header_row)
+            self.index_fieldname = other.index_fieldname
+        else:
+            self.header_row.extend(name for name in other.header_row if name not in self.header_row)
+        for name in other.fields:
+            self._column(name)
+        for name, col in zip(self.fields, self.columns):
+            if name in other.fieldindex:
+                col.extend(other.column(name))
+            else:
+                col.extend([''] * other.nrows)
+        base = self.nrows
+        rowindex = self.rowindex
+        replaced = []
+        for key, row in other.rowindex.iteritems():
+            if key in rowindex:
+                replaced.append((key, rowindex[key]))
+            rowindex[key] = base + row
+        self.nrows += other.nrows
+        return replaced
+
+    def column(self, field):
+        """All the values of one field, in row order."""
+        return self.columns[self.fieldindex[field]]
 
     def __len__(self):
         return len(self.datrecords)
@@ -128,8 +758,13 @@ class DatFile(object):
         return self.datrecords[key]
 
     def __setitem__(self, key, value):
-        if isinstance(value, list):
-            self.datrecords[key] = value
+        if isinstance(value, (dict, collections.Mapping)):
+            for name in value:
+                self._column(name)
+            for name, col in zip(self.fields, self.columns):
+                col.append(value.get(name, ''))
+            self.rowindex[key] = self.nrows
+            self.nrows += 1
         else:
             print "gaaa, invalid insertion", value.__class__
             pass  # TODO: add error raise for invalid type
@@ -138,6 +773,106 @@ class DatFile(object):
         return self.datrecords.iterkeys()
 
 
+class SnapshotError(Exception):
+    """The file isn't a snapshot this version can read, or it is damaged."""
+    pass
+
+
+def _encode_strings(values):
+    """Split a list of strings into its distinct values and an array of ids into them."""
+    index = {}
+    ids = array('I', [index.setdefault(value, len(index)) for value in values])
+    distinct = [None] * len(index)
+    for value, i in index.iteritems():
+        distinct[i] = value
+    return distinct, ids
+
+
+def _pack_sections(sections):
+    """Turn a list of (name, value) sections into (name, kind, bytes).  Arrays
+    are kept as their raw machine values, everything else is marshalled.
+    """
+    blobs = []
+    for name, value in sections:
+        if isinstance(value, array):
+            blobs.append((name, 'a' + value.typecode, value.tostring()))
+        else:
+            blobs.append((name, 'm', marshal.dumps(value, 2)))
+    return blobs
+
+
+def _unpack_sections(blobs):
+    """Inverse of _pack_sections, a dict of name -> value."""
+    sections = {}
+    for name, kind, data in blobs:
+        if kind[0] == 'a':
+            sections[name] = array(kind[1])
+            sections[name].fromstring(data)
+        else:
+            sections[name] = marshal.loads(data)
+    return sections
+
+
+def _write_snapshot(path, sections):
+    """Write a list of (name, value) sections to a snapshot file."""
+    blobs = _pack_sections(sections)
+    offset = SNAPSHOT_HEADER.size + SNAPSHOT_SECTION.size * len(blobs)
+    table = []
+    for name, kind, data in blobs:
+        table.append(SNAPSHOT_SECTION.pack(name, kind, offset, len(data), zlib.crc32(data) & 0xffffffff))
+        offset += len(data)
+    table = ''.join(table)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as snapfh:
+        snapfh.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(blobs),
+                                          zlib.crc32(table) & 0xffffffff))
+        snapfh.write(table)
+        for name, kind, data in blobs:
+            snapfh.write(data)
+    if os.path.exists(path):
+        os.remove(path)  # os.rename won't replace on Windows
+    os.rename(tmppath, path)
+
+
+def _read_snapshot(path, verify=True):
+    """Read a snapshot's sections into a dict of name -> value.  Arrays are
+    read straight into their buffers, and with verify every section's crc32
+    is checked.  Raises SnapshotError for a wrong version or a damaged file.
+    """
+    with open(path, 'rb') as snapfh:
+        header = snapfh.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size or header[:8] != SNAPSHOT_MAGIC:
+            raise SnapshotError('%s is not a snapshot' % path)
+        magic, version, count, tablecrc = SNAPSHOT_HEADER.unpack(header)
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError('%s is snapshot version %d, this reads version %d' %
+                                (path, version, SNAPSHOT_VERSION))
+        table = snapfh.read(SNAPSHOT_SECTION.size * count)
+        if len(table) < SNAPSHOT_SECTION.size * count or zlib.crc32(table) & 0xffffffff != tablecrc:
+            raise SnapshotError('%s has a damaged section table' % path)
+        sections = {}
+        for i in xrange(count):
+            name, kind, offset, length, crc = SNAPSHOT_SECTION.unpack_from(table, i * SNAPSHOT_SECTION.size)
+            name = name.rstrip('\x00')
+            kind = kind.rstrip('\x00')
+            snapfh.seek(offset)
+            if kind[0] == 'a':
+                value = array(kind[1])
+                try:
+                    value.fromfile(snapfh, length // value.itemsize)
+                except EOFError:
+                    raise SnapshotError('%s is truncated in section %s' % (path, name))
+                data = buffer(value)
+            else:
+                data = snapfh.read(length)
+                if len(data) < length:
+                    raise SnapshotError('%s is truncated in section %s' % (path, name))
+            if verify and zlib.crc32(data) & 0xffffffff != crc:
+                raise SnapshotError('%s fails its checksum in section %s' % (path, name))
+            sections[name] = value if kind[0] == 'a' else marshal.loads(data)
+    return sections
+
+
 class LoanFileList(OptFile, DatFile):
     """Object containing loan file info with their complete dcouments
     lists and page paths. Also includes utilities for gathering
@@ -148,56 +883,629 @@ class LoanFileList(OptFile, DatFile):
     def gather_loans_byfield(self, loanfield, filenamefield=None):
         """Merge loan, document, and image info into one dictionaty tree rooted at
         the loan number.  This variate uses a loan id column taken from the dat file.
+        One pass grouping the dat rows on the loan number, each loan's docs are
+        a LoanDocs whose details are only built when looked up.
 
         Args:
-            loanfield - (Required) Field heading from the dat that contains the loan number.
+            loanfield - (Required) Field heading from the dat that contains the loan number,
+                        or a list of headings to group on their values together,
+                        the loan key is then a tuple.
             filenamefield - Original file name field from the dat, if any.
         """
-        #set comprehension to get unique loan numbers
         self.filenamefield = filenamefield
-        loanset = {v[loanfield] for v in self.datrecords.viewvalues()}
-        docpairs = [(v[self.index_fieldname], v[loanfield])
-                    for v in self.datrecords.viewvalues()]
+        if isinstance(loanfield, basestring):
+            loancol = self.column(loanfield)
+            groups = {}
+            for docnum, row in self.rowindex.iteritems():
+                groups.setdefault(loancol[row], []).append(docnum)
+        else:
+            loancols = [self.column(field) for field in loanfield]
+            groups = {}
+            for docnum, row in self.rowindex.iteritems():
+                groups.setdefault(tuple([col[row] for col in loancols]), []).append(docnum)
+        self._setloans(groups)
+
+    def gather_loans_bypath(self, position=-1, keyfunc=None, filenamefield=None):
+        """Build the loan index as gather_loans_byfield does, taking the loan
+        number from the image folder of each opt document's first page.
 
-        self.loanindex = self._loanmatch(loanset, docpairs)
+        Args:
+            position- path segment of the folder holding the loan number, -1
+                      the image's own folder, -2 its parent and so on.
+            keyfunc- optional callable given the folder path, returning the loan
+                     number or None, used instead of position.
+            filenamefield- Original file name field from the dat, if any.
 
-    def _loanmatch(self, loannums, docs):
-        """Associate loan numbers with the list of docs in that loan.
-        Not very pythonic I know, but so much faster than the old way.
+        Docs whose folder gives no loan number are listed in self.ungathered.
         """
-        loannums = sorted(loannums)
-        docs = sorted(docs, key=lambda x: x[0])
-        docs = sorted(docs, key=lambda x: x[1])
+        self.filenamefield = filenamefield
+        store = self.pagestore
+        folderloans = {}  # loan number per distinct folder, there are far fewer folders than docs
+        groups = {}
+        self.ungathered = []
+        for docnum, record in self.docrecords.iteritems():
+            dirid = store.dirids[record.start]
+            if dirid not in folderloans:
+                folder = store.dirs[dirid]
+                if keyfunc is not None:
+                    folderloans[dirid] = keyfunc(folder)
+                else:
+                    parts = [part for part in folder.replace('\\', '/').split('/') if part]
+                    try:
+                        folderloans[dirid] = parts[position]
+                    except IndexError:
+                        folderloans[dirid] = None
+            loan = folderloans[dirid]
+            if loan is None:
+                self.ungathered.append(docnum)
+            else:
+                groups.setdefault(loan, []).append(docnum)
+        self._setloans(groups)
 
-        currdocdict = {}
-        out = {}
-        i = 0
-        for loan in loannums:
-            while True:
-                try:
-                    if loan == docs[i][1]:
-                        currdocdict[docs[i][0]] = self._docdetails(docs[i][0],
-                                                              self.filenamefield)
-                        i += 1
-                    else:
-                        out[loan] = currdocdict
-                        currdocdict = {}
-                        break
-                except IndexError:  # i has fallen off the end of docs so return
-                    out[loan] = currdocdict
-                    return out
+    def _setloans(self, groups):
+        self.loanindex = dict((loan, LoanDocs(self, docnums, self.filenamefield))
+                              for loan, docnums in groups.iteritems())
 
     def _docdetails(self, docnum, filenamef):
-        """Gather additional document details to a dict.
+        """Gather additional document details to a dict.  filename is None
+        without a filename field or a dat row, images empty without an opt
+        document.
         """
         out = {}
-        if filenamef is not None:
+        if filenamef is not None and docnum in self.rowindex:
             out['filename'] = self.datrecords[docnum][filenamef]
         else:
             out['filename'] = None
-        out['images'] = self.docrecords[docnum].pages
+        record = self.docrecords.get(docnum)
+        out['images'] = record.pages if record is not None else []
         return out
 
+    def save_snapshot(self, path):
+        """Save the loaded opt and dat records and the loan index to a binary
+        snapshot file, reloaded with load_snapshot much faster than parsing.
+        Repeated strings are stored once per column.
+
+        Args:
+            path- snapshot file to write, replaced if it exists.
+        """
+        _write_snapshot(path, self._sections())
+
+    def _sections(self):
+        """The whole state as a list of (name, value) of arrays and marshallable values."""
+        store = self.pagestore
+        for docnum, record in self.docrecords.items():
+            if record.store is not store:  # inserted from elsewhere, copy its rows into pagestore
+                start = len(store)
+                for i in xrange(record.start, record.end):
+                    store.append_fields(record.store.row(i))
+                self.docrecords[docnum] = OptRecord(store=store, start=start, end=len(store))
+        sections = [(name, getattr(store, name)) for name in OPTPAGES_ARRAYS]
+        filenames, filenameids = _encode_strings(store.filenames)
+        tails, tailids = _encode_strings(store.tails)
+        sections.extend([('keyprefixes', store.keyprefixes), ('oddkeys', store.oddkeys),
+                         ('volumes', store.volumes), ('dirs', store.dirs),
+                         ('filenames', filenames), ('filenameids', filenameids),
+                         ('tails', tails), ('tailids', tailids)])
+        docs = self.docrecords.items()
+        sections.extend([('docnums', [docnum for docnum, record in docs]),
+                         ('docstarts', array('I', [record.start for docnum, record in docs])),
+                         ('docends', array('I', [record.end for docnum, record in docs]))])
+        sections.append(('datheader', [self.header_row, self.fields,
+                                       getattr(self, 'index_fieldname', None), self.nrows]))
+        for n, column in enumerate(self.columns):
+            distinct, ids = _encode_strings(column)
+            sections.extend([('datvalues%d' % n, distinct), ('datids%d' % n, ids)])
+        sections.append(('rowindex', self.rowindex))
+        loanindex = getattr(self, 'loanindex', None)
+        if loanindex is not None:
+            loanindex = dict((loan, docs.keys()) for loan, docs in loanindex.iteritems())
+        sections.append(('loanindex', [getattr(self, 'filenamefield', None), loanindex]))
+        return sections
+
+    @classmethod
+    def load_snapshot(cls, path, verify=True):
+        """Build a LoanFileList from a snapshot written by save_snapshot.
+
+        Args:
+            path- snapshot file.
+            verify- check each section's checksum, default True.  Raises
+                    SnapshotError on a mismatch.
+        """
+        return cls._from_sections(_read_snapshot(path, verify))
+
+    @classmethod
+    def _from_sections(cls, snap):
+        loans = cls()
+        store = loans.pagestore
+        for name in OPTPAGES_ARRAYS:
+            setattr(store, name, snap[name])
+        store.keyprefixes = snap['keyprefixes']
+        store.oddkeys = snap['oddkeys']
+        store.volumes = snap['volumes']
+        store.dirs = snap['dirs']
+        store.filenames = map(snap['filenames'].__getitem__, snap['filenameids'])
+        store.tails = map(snap['tails'].__getitem__, snap['tailids'])
+        store._prefixidx = dict((value, i) for i, value in enumerate(store.keyprefixes))
+        store._volidx = dict((value, i) for i, value in enumerate(store.volumes))
+        store._diridx = dict((value, i) for i, value in enumerate(store.dirs))
+        store._tails = dict((value, value) for value in snap['tails'])
+        for docnum, start, end in zip(snap['docnums'], snap['docstarts'], snap['docends']):
+            loans.docrecords[docnum] = OptRecord(store=store, start=start, end=end)
+
+        loans.header_row, loans.fields, index_fieldname, loans.nrows = snap['datheader']
+        if index_fieldname is not None:
+            loans.index_fieldname = index_fieldname
+        loans.fieldindex = dict((name, i) for i, name in enumerate(loans.fields))
+        loans.columns = [map(snap['datvalues%d' % n].__getitem__, snap['datids%d' % n])
+                         for n in xrange(len(loans.fields))]
+        loans.rowindex = snap['rowindex']
+
+        filenamefield, loanindex = snap['loanindex']
+        if loanindex is not None:
+            loans.filenamefield = filenamefield
+            loans._setloans(loanindex)
+        return loans
+
+class DatReader(object):
+    """Streams a Concordance dat one record at a time as field -> value dicts.
+    header_row is read on opening.  Short rows are padded with ''.
+    """
+    def __init__(self, datpath):
+        self.datpath = datpath
+        self._fh = open(datpath, 'rb')
+        self._reader = csv.reader(self._fh, delimiter=DAT_DELIM, quotechar=DAT_QUOTE)
+        self.header_row = self._reader.next()
+        if self.header_row and self.header_row[0].startswith(UTF8_BOM):
+            self.header_row[0] = self.header_row[0][len(UTF8_BOM):].strip(DAT_QUOTE)
+
+    def __iter__(self):
+        header = self.header_row
+        try:
+            for values in self._reader:
+                if len(values) < len(header):
+                    values.extend([''] * (len(header) - len(values)))
+                yield dict(zip(header, values))
+        finally:
+            self._fh.close()
+
+
+class Document(object):
+    """
+    One document passing through a Pipeline.
+
+    Fields/init args:
+     begdoc- the document key.
+     fields- dict of its dat fields, None if the dat has no row for it.
+     pages- its opt rows, each a list of fields as in OptRecord.pages,
+            empty if the opt has no pages for it.
+    """
+    __slots__ = ('begdoc', 'fields', 'pages')
+
+    def __init__(self, begdoc, fields=None, pages=None):
+        self.begdoc = begdoc
+        self.fields = fields
+        self.pages = pages if pages is not None else []
+
+
+class LoadFileReader(object):
+    """Streams the Documents of an opt and dat pair, either may be None.  The
+    two files are read side by side and a document is handed on once both
+    its opt pages and dat row have been seen, so memory only grows with how
+    far out of step the files are.  Documents found in just one file come
+    out at the end.
+
+    Args:
+        optpath- opticon file or None.
+        datpath- dat file or None.
+        index_header- dat field holding the begdoc, default BegBates.
+        pathroot- passed to iter_opt.
+    """
+    def __init__(self, optpath=None, datpath=None, index_header='BegBates', pathroot=None):
+        self.optpath = optpath
+        self.pathroot = pathroot
+        self.index_header = index_header
+        self.dat = DatReader(datpath) if datpath is not None else None
+        self.header_row = self.dat.header_row if self.dat is not None else []
+
+    def __iter__(self):
+        opt = iter_opt(self.optpath, self.pathroot) if self.optpath is not None else iter(())
+        dat = iter(self.dat) if self.dat is not None else iter(())
+        if self.dat is None:
+            for begdoc, rows in opt:
+                yield Document(begdoc, None, rows)
+            return
+        if self.optpath is None:
+            for fields in dat:
+                yield Document(fields[self.index_header], fields)
+            return
+        waitingopt = collections.OrderedDict()
+        waitingdat = collections.OrderedDict()
+        optleft = datleft = True
+        while optleft or datleft:
+            if optleft:
+                try:
+                    begdoc, rows = opt.next()
+                except StopIteration:
+                    optleft = False
+                else:
+                    if begdoc in waitingdat:
+                        yield Document(begdoc, waitingdat.pop(begdoc), rows)
+                    else:
+                        if begdoc in waitingopt:  # repeated begdoc, hand on the first one alone
+                            yield Document(begdoc, None, waitingopt.pop(begdoc))
+                        waitingopt[begdoc] = rows
+            if datleft:
+                try:
+                    fields = dat.next()
+                except StopIteration:
+                    datleft = False
+                else:
+                    begdoc = fields[self.index_header]
+                    if begdoc in waitingopt:
+                        yield Document(begdoc, fields, waitingopt.pop(begdoc))
+                    else:
+                        if begdoc in waitingdat:
+                            yield Document(begdoc, waitingdat.pop(begdoc))
+                        waitingdat[begdoc] = fields
+        for begdoc, rows in waitingopt.iteritems():
+            yield Document(begdoc, None, rows)
+        for begdoc, fields in waitingdat.iteritems():
+            yield Document(begdoc, fields)
+
+
+class _BufferedWriter(object):
+    """Collects output lines and writes them WRITE_BATCH at a time."""
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append and os.path.exists(path)
+        self._fh = open(path, 'ab' if self.append else 'wb')
+        self._pending = []
+
+    def _writeline(self, line):
+        self._pending.append(line)
+        if len(self._pending) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        self._fh.write(''.join(self._pending))
+        del self._pending[:]
+
+    def close(self):
+        self.flush()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class OptWriter(_BufferedWriter):
+    """Writes opticon rows with CRLF line ends.
+
+    Args:
+        optpath- file to write.
+        append- add to the file if it exists.
+    """
+    def __init__(self, optpath, append=False):
+        super(OptWriter, self).__init__(optpath, append)
+        self.count = 0
+
+    def write(self, rows):
+        """Write one document's rows, each a list of fields as in OptRecord.pages."""
+        for row in rows:
+            self._writeline(','.join(row).rstrip('\r\n') + LINE_END)
+        self.count += len(rows)
+
+
+class DatWriter(_BufferedWriter):
+    """Writes a Concordance dat, values quoted with chr(254) and delimited
+    with chr(20).  A chr(254) inside a value is doubled, which DatReader
+    and load_dat read back as one.
+
+    Args:
+        datpath- file to write.
+        fields- the header, the fields written from each record, in order.
+        append- add to the file if it exists, without a second header.
+    """
+    def __init__(self, datpath, fields, append=False):
+        super(DatWriter, self).__init__(datpath, append)
+        self.fields = list(fields)
+        self.count = 0
+        if not self.append:
+            self._writevalues(self.fields)
+
+    def _writevalues(self, values):
+        self._writeline(DAT_DELIM.join(DAT_QUOTE + (value or '').replace(DAT_QUOTE, DAT_QUOTE * 2) +
+                                       DAT_QUOTE for value in values) + LINE_END)
+
+    def write_values(self, values):
+        """Write one record given as a list of values in the order of fields."""
+        self._writevalues(values)
+        self.count += 1
+
+    def write(self, record):
+        """Write one record, a field -> value mapping.  Missing fields are left empty."""
+        self.write_values([record.get(field, '') for field in self.fields])
+
+
+class LoadFileWriter(object):
+    """Writes Documents to an opt and dat pair, either path may be None.
+
+    Args:
+        optpath, datpath- files to write.
+        fields- dat header, needed with datpath.
+        append- add to the files if they exist.
+    """
+    def __init__(self, optpath=None, datpath=None, fields=None, append=False):
+        self.opt = OptWriter(optpath, append) if optpath is not None else None
+        self.dat = DatWriter(datpath, fields, append) if datpath is not None else None
+        self.count = 0
+
+    def write(self, doc):
+        if self.opt is not None and doc.pages:
+            self.opt.write(doc.pages)
+        if self.dat is not None and doc.fields is not None:
+            self.dat.write(doc.fields)
+        self.count += 1
+
+    def close(self):
+        if self.opt is not None:
+            self.opt.close()
+        if self.dat is not None:
+            self.dat.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SplitWriter(object):
+    """Writes each Document to its own opt and dat pair in outdir, chosen by
+    keyfunc, e.g. one pair per loan.  At most maxopen pairs are kept open,
+    the least recently used is closed and later reopened to append.
+
+    Args:
+        outdir- folder for the files, <key>.opt and <key>.dat.  Characters not
+            safe in a file name become _, keys that give the same file name,
+            ignoring case where the filesystem does, share the files.
+        keyfunc- callable given a Document, returns its file key or None to skip it.
+        fields- dat header, None to write no dats.
+        writeopt- write opts, default True.
+        maxopen- open file pairs limit.
+    """
+    def __init__(self, outdir, keyfunc, fields=None, writeopt=True, maxopen=64):
+        self.outdir = outdir
+        self.keyfunc = keyfunc
+        self.fields = fields
+        self.writeopt = writeopt
+        self.maxopen = maxopen
+        self.writers = collections.OrderedDict()
+        self.started = set()
+        self.count = 0
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+    def write(self, doc):
+        key = self.keyfunc(doc)
+        if key is None:
+            return
+        name = FILENAME_UNSAFE.sub('_', key)
+        filekey = os.path.normcase(name)
+        writer = self.writers.pop(filekey, None)
+        if writer is None:
+            if len(self.writers) >= self.maxopen:
+                self.writers.popitem(last=False)[1].close()
+            path = os.path.join(self.outdir, name)
+            writer = LoadFileWriter(path + '.opt' if self.writeopt else None,
+                                    path + '.dat' if self.fields is not None else None,
+                                    self.fields, append=filekey in self.started)
+            self.started.add(filekey)
+        self.writers[filekey] = writer
+        writer.write(doc)
+        self.count += 1
+
+    def close(self):
+        for writer in self.writers.itervalues():
+            writer.close()
+        self.writers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Pipeline(object):
+    """Streaming load file transform, read -> map/filter -> write, one
+    Document at a time.
+
+        reader = LoadFileReader('VOL001.opt', 'VOL001.dat')
+        Pipeline(reader).map(repath('.\\\\IMAGES', 'D:\\\\PROD\\\\IMAGES')).filter(
+            lambda doc: doc.fields['LoanNumber']).write(
+            LoadFileWriter('OUT.opt', 'OUT.dat', reader.header_row))
+
+    A map function returns the Document, changed or new, or None to drop it.
+    """
+    def __init__(self, documents):
+        self.documents = documents
+        self.steps = []
+
+    def map(self, func):
+        self.steps.append((True, func))
+        return self
+
+    def filter(self, func):
+        self.steps.append((False, func))
+        return self
+
+    def __iter__(self):
+        for doc in self.documents:
+            for ismap, func in self.steps:
+                if ismap:
+                    doc = func(doc)
+                    if doc is None:
+                        break
+                elif not func(doc):
+                    doc = None
+                    break
+            if doc is not None:
+                yield doc
+
+    def write(self, writer):
+        """Run every document through to writer, which is closed at the end.
+        Returns the number of documents written.
+        """
+        count = 0
+        try:
+            for doc in self:
+                writer.write(doc)
+                count += 1
+        finally:
+            writer.close()
+        return count
+
+
+def repath(old, new, volume=None):
+    """Pipeline map replacing the old prefix of each image path with new,
+    case insensitive, and optionally setting the volume field.
+    """
+    oldlower = old.lower()
+
+    def _repath(doc):
+        for row in doc.pages:
+            if row[2].lower().startswith(oldlower):
+                row[2] = new + row[2][len(old):]
+            if volume is not None:
+                row[1] = volume
+        return doc
+    return _repath
+
+
+def renumber(prefix, start=1, width=8, begfield='BegBates', endfield='EndBates'):
+    """Pipeline map giving every page a new Bates number, prefix plus a zero
+    padded counter from start, and updating begfield and endfield of the
+    dat row to match.  Documents without pages are left alone.
+    """
+    counter = [start]
+
+    def _renumber(doc):
+        if not doc.pages:
+            return doc
+        for row in doc.pages:
+            row[0] = '%s%0*d' % (prefix, width, counter[0])
+            counter[0] += 1
+        doc.begdoc = doc.pages[0][0]
+        if doc.fields is not None:
+            doc.fields[begfield] = doc.begdoc
+            if endfield is not None:
+                doc.fields[endfield] = doc.pages[-1][0]
+        return doc
+    return _renumber
+
+
+def select_fields(fields, rename=None):
+    """Pipeline map keeping only the dat fields given, with rename an
+    optional dict of old -> new field names.
+    """
+    rename = rename or {}
+
+    def _select(doc):
+        if doc.fields is not None:
+            doc.fields = dict((rename.get(field, field), doc.fields.get(field, '')) for field in fields)
+        return doc
+    return _select
+
+
+def _load_volume(job):
+    """Pool worker, load one opt or dat and return it packed for the trip back."""
+    kind, path, option, index_header, fields = job
+    starttime = time.time()
+    loans = LoanFileList()
+    if kind == 'opt':
+        loans.load_opt(path, option)
+    else:
+        loans.load_dat(path, index_header, fields)
+    loadtime = time.time() - starttime
+    count = len(loans.docrecords) if kind == 'opt' else loans.nrows
+    return loadtime, count, _pack_sections(loans._sections())
+
+
+def load_volumes(optpaths=(), datpaths=(), index_header=None, pathroot=None, fields=None,
+                 processes=None, report=True):
+    """Load the opt and dat volumes of a production in worker processes and
+    merge them into one LoanFileList.  Files are loaded largest first and
+    merged in the order given, so a key repeated across volumes ends up with
+    the later volume's record, as loading them one after the other would.
+    Workers send back the packed snapshot sections: raw arrays and
+    marshalled value lists, not pickled records.
+
+    Args:
+        optpaths- list of opt files.
+        datpaths- list of dat files.
+        index_header- dat key field, required with datpaths.
+        pathroot- passed to load_opt.
+        fields- passed to load_dat to load only some fields.
+        processes- number of worker processes, default one per cpu.
+        report- print each volume's timing and any duplicates, default True.
+
+    The returned LoanFileList also has:
+        duplicates- list of (kind, key, earlier volume, later volume) for keys
+                    found in more than one volume.
+        volume_timings- list of (path, kind, records, load seconds, merge seconds).
+    """
+    jobs = [('opt', path, pathroot, None, None) for path in optpaths]
+    jobs.extend(('dat', path, None, index_header, fields) for path in datpaths)
+    if datpaths and index_header is None:
+        raise ValueError('index_header is needed to load dat volumes')
+    loans = LoanFileList()
+    loans.duplicates = []
+    loans.volume_timings = []
+    volstarts = {'opt': [], 'dat': []}  # first row of each merged volume, to find a key's volume
+    volpaths = {'opt': [], 'dat': []}
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = {}
+        for i in sorted(xrange(len(jobs)), key=lambda i: -os.path.getsize(jobs[i][1])):
+            pending[i] = pool.apply_async(_load_volume, (jobs[i],))
+        pool.close()
+        for i, job in enumerate(jobs):
+            kind, path = job[:2]
+            loadtime, count, blobs = pending.pop(i).get()
+            starttime = time.time()
+            part = LoanFileList._from_sections(_unpack_sections(blobs))
+            del blobs
+            if kind == 'opt':
+                volstarts[kind].append(len(loans.pagestore))
+                replaced = loans.merge_opt(part)
+            else:
+                volstarts[kind].append(loans.nrows)
+                replaced = loans.merge_dat(part)
+            volpaths[kind].append(path)
+            for key, row in replaced:
+                earlier = volpaths[kind][bisect.bisect_right(volstarts[kind], row) - 1]
+                loans.duplicates.append((kind, key, earlier, path))
+            mergetime = time.time() - starttime
+            loans.volume_timings.append((path, kind, count, loadtime, mergetime))
+            if report:
+                print '%s: %d %s, load %d:%.1f, merge %d:%.1f, %d duplicates' % (
+                    (os.path.basename(path), count, 'docs' if kind == 'opt' else 'rows') +
+                    divmod(loadtime, 60) + divmod(mergetime, 60) + (len(replaced),))
+        pool.join()
+    except:
+        pool.terminate()
+        raise
+    if report and loans.duplicates:
+        print '%d keys in more than one volume' % len(loans.duplicates)
+        for kind, key, earlier, later in loans.duplicates[:20]:
+            print '  %s %s: %s, %s' % (kind, key, os.path.basename(earlier), os.path.basename(later))
+    return loans
+
+
 if __name__ == "__main__":
     import time
 
@@ -0,0 +1,50 @@
+"""
+Tests for optdattools, run with python -m unittest discover from this folder.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import optdattools
+
+
+def write_opt(path, docs):
+    """Write an opt of {begdoc: [page keys]} docs, in begdoc order."""
+    with open(path, 'wb') as optfh:
+        for begdoc in sorted(docs):
+            for i, key in enumerate(docs[begdoc]):
+                optfh.write('%s,VOL001,IMAGES\\%s.TIF,%s,,,%s\r\n' %
+                            (key, key, 'Y' if i == 0 else '', len(docs[begdoc]) if i == 0 else ''))
+
+
+class BatesIndexPaddingTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        optpath = os.path.join(self.root, 'VOL001.opt')
+        write_opt(optpath, {'ABC0001': ['ABC0001', 'ABC0002', 'ABC0003'],
+                            'ABC001': ['ABC001', 'ABC002'],
+                            'ABC0003': ['ABC0003']})
+        optfile = optdattools.OptFile()
+        optfile.load_opt(optpath)
+        self.index = optfile.bates_index()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_find_matches_padding(self):
+        self.assertEqual(self.index.find('ABC001'), ['ABC001'])
+        self.assertEqual(self.index.find('ABC0001'), ['ABC0001'])
+        self.assertEqual(self.index.contains('ABC002'), 'ABC001')
+        self.assertEqual(self.index.find('ABC00001'), [])
+
+    def test_duplicates_and_overlaps_match_padding(self):
+        self.assertEqual(self.index.duplicates(), [('ABC0003', ['ABC0001', 'ABC0003'])])
+        self.assertEqual(self.index.overlaps(), [('ABC0001', 'ABC0003')])
+
+    def test_ranges_go_by_number(self):
+        self.assertEqual(self.index.count('ABC1', 'ABC2'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
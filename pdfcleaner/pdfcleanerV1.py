@@ -2,7 +2,7 @@
 #Requirements:
 #gs command from the Ghostscript package
 #tiffcp and tiff2pdf from libtiff.net package
-#pdfinfo command from libpoppler.  Available on Windows in Cygwin
+#pdfinfo command from libpoppler, only for pdfs common/pdfpages.py can't read.  Available on Windows in Cygwin
 from __future__ import print_function
 __version__ = 1.0
 import subprocess
@@ -17,18 +17,13 @@ import multiprocessing
 import Queue
 import pprint as pp
 from os.path import join as joinp
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import filescan
+import pdfpages
 
 
 def gather_pdfs(targdir):
-    result = []
-    dirargs = ['dir', targdir, '/S', '/B', '/A-D']
-    proc = subprocess.Popen(dirargs, shell=True, stdout=subprocess.PIPE, bufsize=1)
-    for dirline in iter(proc.stdout.readline, b''):
-        result.append(dirline.strip())
-    proc.communicate()
-    allowed_ext = ['.pdf', '.PDF', '.Pdf', '.pDf', '.pdF', '.PDf', '.pDF', '.PdF']
-    result = [x for x in result if x[-4:] in allowed_ext]
-    return result
+    return list(filescan.scan(targdir, exts=['.pdf']))
 
 
 def gen_fileinfo(filepath, temproot, sourceroot, resultroot):
@@ -64,14 +59,10 @@ def create_dir(newdir):
 
 
 def pdf_info(finfo):
-    pdfinfoargs = ['pdfinfo', joinp(finfo['origdir'], finfo['origfilename'])]
-    pdfproc = subprocess.Popen(pdfinfoargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, errs = pdfproc.communicate()
-    if pdfproc.returncode > 0:
-        finfo['errors'] += 'PDFInfo:\n' + errs + '\n'
-        return finfo
-    outsplit = out.split()
-    finfo['pgcount'] += int(outsplit[outsplit.index('Pages:') + 1])
+    try:
+        finfo['pgcount'] += pdfpages.count_pages(joinp(finfo['origdir'], finfo['origfilename']))
+    except pdfpages.PageCountError as e:
+        finfo['errors'] += 'PDFInfo:\n' + str(e) + '\n'
     return finfo
 
 
@@ -0,0 +1,80 @@
+# cython: language_level=2, boundscheck=False, wraparound=False
+"""
+Compiled versions of the snippets.py / phrasematch.py inner loops.
+Build with 'python cythontest.py build', the scripts fall back to their pure
+python versions when this isn't built.
+"""
+import string
+from cpython cimport array
+
+DELMAP = {ord(char): None for char in string.digits + string.punctuation.replace('-', '')}
+
+cdef bint DELETE[128]
+cdef int _c
+for _c in range(128):
+    DELETE[_c] = _c in DELMAP
+
+
+cdef inline bint _needs_translate(unicode token):
+    cdef Py_UCS4 ch
+    for ch in token:
+        if ch < 128 and DELETE[ch]:
+            return True
+    return False
+
+
+def clean_token_list(list raw_tokens):
+    """Strip digits and punctuation (except -) from each token and lowercase it."""
+    cdef list out = []
+    cdef object token
+    for token in raw_tokens:
+        if type(token) is unicode and not _needs_translate(token):
+            out.append(token.lower())
+        else:
+            out.append(token.translate(DELMAP).lower())
+    return out
+
+
+def tokenize_text(unicode text):
+    """Split text on whitespace, returns (raw_tokens, clean_tokens)."""
+    cdef list raw_tokens = text.split()
+    return raw_tokens, clean_token_list(raw_tokens)
+
+
+def term_positions(search_tokens, list clean_tokens):
+    """One sorted position list per search token, in search token order."""
+    cdef dict positions = dict((term, []) for term in search_tokens)
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = len(clean_tokens)
+    cdef object found
+    for i in range(n):
+        found = positions.get(clean_tokens[i])
+        if found is not None:
+            (<list>found).append(i)
+    return [positions[term] for term in search_tokens]
+
+
+def merge_offset(first, second, long offset=0):
+    """
+    Linear merge form of phrasematch.intersect_offset, the values x of sorted
+    first where x + offset is in sorted second.
+    """
+    cdef array.array firstarr = array.array('l', first)
+    cdef array.array secondarr = array.array('l', second)
+    cdef long *a = firstarr.data.as_longs
+    cdef long *b = secondarr.data.as_longs
+    cdef Py_ssize_t i = 0, j = 0
+    cdef Py_ssize_t na = len(firstarr), nb = len(secondarr)
+    cdef long x
+    cdef list result = []
+    while i < na and j < nb:
+        x = a[i] + offset
+        if x == b[j]:
+            result.append(a[i])
+            i += 1
+            j += 1
+        elif x < b[j]:
+            i += 1
+        else:
+            j += 1
+    return result
@@ -1 +1,123 @@
+"""
+Build and benchmark the compiled tokenize/phrase match fast path (_speedups.pyx).
+
+    python cythontest.py build     compile _speedups in place, needs Cython and a C compiler
+    python cythontest.py bench     tokens/sec for the pure python and compiled paths
+
+snippets.py and phrasematch.py import _speedups when it has been built and
+otherwise use their pure python versions, nothing else needs to change.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+
 __author__ = 'tom'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def build():
+    """Compile _speedups.pyx into an extension module next to this file."""
+    from distutils.core import setup
+    from Cython.Build import cythonize
+
+    cwd = os.getcwd()
+    os.chdir(HERE)
+    try:
+        setup(name='_speedups', ext_modules=cythonize('_speedups.pyx'),
+              script_args=['build_ext', '--inplace'])
+    finally:
+        os.chdir(cwd)
+
+
+def synthetic_corpus(numtokens, vocabsize=5000, seed=1138):
+    """
+    Random OCR-ish text: mostly lowercase words with some capitalized,
+    punctuated and numeric tokens mixed in.
+    """
+    rand = random.Random(seed)
+    letters = u'abcdefghijklmnopqrstuvwxyz'
+    vocab = [u''.join(rand.choice(letters) for _ in xrange(rand.randint(2, 10)))
+             for _ in xrange(vocabsize)]
+    tokens = []
+    for _ in xrange(numtokens):
+        word = rand.choice(vocab)
+        roll = rand.random()
+        if roll < 0.1:
+            word = word.capitalize()
+        elif roll < 0.15:
+            word += rand.choice(u'.,;:)')
+        elif roll < 0.18:
+            word = unicode(rand.randint(0, 99999))
+        tokens.append(word)
+    return u' '.join(tokens)
+
+
+def timeit(func, *args, **kwargs):
+    """Best of repeat runs, returns (seconds, result)."""
+    repeat = kwargs.pop('repeat', 3)
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench(numtokens=1000000):
+    import snippets
+    import phrasematch
+
+    text = synthetic_corpus(numtokens)
+    raw_tokens = text.split()
+    print('%s tokens, compiled module %s\n' %
+          (len(raw_tokens), 'loaded' if snippets._speedups is not None else 'NOT built'))
+
+    pure = snippets.py_clean_token_list
+    fast = getattr(snippets._speedups, 'clean_token_list', None)
+    clean_tokens = pure(raw_tokens)
+    search_tokens = clean_tokens[1000:1003]
+
+    def pure_merge(first, second, offset):
+        saved, phrasematch._speedups = phrasematch._speedups, None
+        try:
+            return phrasematch.intersect_offset(first, second, offset)
+        finally:
+            phrasematch._speedups = saved
+
+    every_other = range(0, len(raw_tokens), 2)
+    every_third = range(0, len(raw_tokens), 3)
+    cases = [('clean + lower', pure, fast, (raw_tokens,)),
+             ('term positions', snippets.py_term_positions,
+              getattr(snippets._speedups, 'term_positions', None), (search_tokens, clean_tokens)),
+             ('position merge', pure_merge,
+              getattr(snippets._speedups, 'merge_offset', None), (every_other, every_third, 1))]
+    print('%-16s %16s %16s %8s' % ('', 'python tok/s', 'compiled tok/s', 'speedup'))
+    for name, purefunc, fastfunc, args in cases:
+        puresecs, pureresult = timeit(purefunc, *args)
+        line = '%-16s %16.0f' % (name, len(raw_tokens) / puresecs)
+        if fastfunc is not None:
+            fastsecs, fastresult = timeit(fastfunc, *args)
+            if list(fastresult) != list(pureresult):
+                raise AssertionError('compiled %s result differs from python' % name)
+            line += ' %16.0f %7.1fx' % (len(raw_tokens) / fastsecs, puresecs / fastsecs)
+        print(line)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build or benchmark the compiled text fast path')
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('-tokens', action='store', type=int, default=1000000,
+                        help='synthetic corpus size for bench, default 1,000,000')
+    args = parser.parse_args()
+    sys.path.insert(0, HERE)
+    if args.command == 'build':
+        build()
+    else:
+        bench(args.tokens)
@@ -0,0 +1,267 @@
+"""
+Phrase and proximity matching over sorted token position lists.
+
+Matching works by intersecting shifted position lists rather than testing
+every combination of term positions, so the cost grows with the length of
+the rarest term's list instead of the product of all of them.
+
+Query syntax, operands are one or more words:
+    due diligence                  exact phrase
+    loan w/5 default               within 5 words of each other, either order
+    loan agreement pre/5 default   second operand within 5 words after the first
+Operators chain left to right, e.g. 'loan w/5 default pre/10 notice'.
+"""
+import re
+from bisect import bisect_left, bisect_right
+try:
+    import _speedups  # compiled inner loops, see cythontest.py
+except ImportError:
+    _speedups = None
+
+OPERATOR_RE = re.compile(r'^(w|pre)/(\d+)$', re.IGNORECASE)
+GALLOP_RATIO = 8  # switch from a linear merge to bisection above this size ratio
+
+
+def intersect_offset(first, second, offset=0):
+    """
+    Return the values x of sorted list first where x + offset is in sorted
+    list second.  Uses a galloping (bisect) search through the longer list
+    when the lengths are lopsided, otherwise a linear merge.
+    """
+    result = []
+    if not first or not second:
+        return result
+    if len(second) > GALLOP_RATIO * len(first):
+        lo = 0
+        hi = len(second)
+        for x in first:
+            lo = bisect_left(second, x + offset, lo, hi)
+            if lo == hi:
+                break
+            if second[lo] == x + offset:
+                result.append(x)
+        return result
+    if len(first) > GALLOP_RATIO * len(second):
+        lo = 0
+        hi = len(first)
+        for y in second:
+            lo = bisect_left(first, y - offset, lo, hi)
+            if lo == hi:
+                break
+            if first[lo] == y - offset:
+                result.append(first[lo])
+        return result
+    if _speedups is not None:
+        return _speedups.merge_offset(first, second, offset)
+    i = j = 0
+    while i < len(first) and j < len(second):
+        x = first[i] + offset
+        y = second[j]
+        if x == y:
+            result.append(first[i])
+            i += 1
+            j += 1
+        elif x < y:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def phrase_starts(term_positions):
+    """
+    Return the sorted start positions where the terms occur contiguously
+    and in order.  term_positions is one sorted position list per term.
+    """
+    if not term_positions:
+        return []
+    # start from the rarest term, shifted back to where the phrase would begin
+    order = sorted(range(len(term_positions)), key=lambda i: len(term_positions[i]))
+    first = order[0]
+    starts = [p - first for p in term_positions[first] if p >= first]
+    for i in order[1:]:
+        starts = intersect_offset(starts, term_positions[i], i)
+        if not starts:
+            break
+    return starts
+
+
+def phrase_match(term_positions):
+    """
+    Return one tuple of positions per contiguous occurrence of the phrase,
+    in document order.
+    """
+    length = len(term_positions)
+    return [tuple(xrange(start, start + length)) for start in phrase_starts(term_positions)]
+
+
+def is_phrase(search_text):
+    """True if the search text is a plain phrase with no proximity operators."""
+    return not any(OPERATOR_RE.match(token) for token in search_text.split())
+
+
+class PhraseQuery(object):
+    """
+    Parsed search text.
+
+    Attributes:
+        tokens- the lowercased search text split on whitespace, operators included.
+        operands- list of word lists, one per phrase operand.
+        operators- list of (kind, distance) between consecutive operands,
+                   kind is 'w' or 'pre'.
+        terms- the unique words that need position lists, in first seen order.
+    """
+    def __init__(self, search_text):
+        self.tokens = search_text.lower().split()
+        self.operands = [[]]
+        self.operators = []
+        for token in self.tokens:
+            op = OPERATOR_RE.match(token)
+            if op is None:
+                self.operands[-1].append(token)
+                continue
+            if not self.operands[-1]:
+                raise ValueError('Operator %s missing a left operand in "%s"' % (token, search_text))
+            self.operators.append((op.group(1), int(op.group(2))))
+            self.operands.append([])
+        if not self.operands[-1]:
+            raise ValueError('Search "%s" is empty or ends with an operator' % search_text)
+        self.terms = []
+        for operand in self.operands:
+            for term in operand:
+                if term not in self.terms:
+                    self.terms.append(term)
+
+    def __repr__(self):
+        return ' '.join(self.tokens)
+
+    def match(self, term_pos):
+        """
+        Return the sorted position tuples matching the query.  term_pos is a
+        dict of term -> sorted positions; missing terms have no positions.
+        """
+        def operand_starts(operand):
+            return phrase_starts([term_pos.get(term, ()) for term in operand])
+
+        first = self.operands[0]
+        results = [tuple(xrange(s, s + len(first))) for s in operand_starts(first)]
+        for (kind, dist), operand in zip(self.operators, self.operands[1:]):
+            if not results:
+                break
+            length = len(operand)
+            starts = operand_starts(operand)
+            results = self._near(results, starts, length, dist, kind == 'w')
+        return results
+
+    @staticmethod
+    def _near(left, starts, length, dist, either_order):
+        """
+        Join the left matches with right operand occurrences that start
+        within dist words after them, or end within dist words before them
+        when either_order is set.
+        """
+        joined = set()
+        for match in left:
+            ranges = [(match[-1] + 1, match[-1] + dist)]
+            if either_order:
+                ranges.append((match[0] - dist - length + 1, match[0] - length))
+            for lo, hi in ranges:
+                for i in xrange(bisect_left(starts, lo), bisect_right(starts, hi)):
+                    joined.add(tuple(sorted(match + tuple(xrange(starts[i], starts[i] + length)))))
+        return sorted(joined)
+
+
+def parse_query(search_text):
+    return PhraseQuery(search_text)
+
+
+class PhraseAutomaton(object):
+    """
+    Aho-Corasick automaton over clean tokens, finds every occurrence of any
+    number of phrases in one pass over a document.
+
+    Args:
+        phrases- list of token lists.  Matches are reported by list index.
+    """
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for idx, phrase in enumerate(phrases):
+            if not phrase:
+                continue
+            node = 0
+            for token in phrase:
+                nxt = self.goto[node].get(token)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][token] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append((idx, len(phrase)))
+        self._link()
+
+    def _link(self):
+        """Breadth first pass to set the failure links and merge outputs."""
+        queue = list(self.goto[0].values())
+        for node in queue:  # queue grows as we go
+            for token, child in self.goto[node].iteritems():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(token, 0)
+                self.fail[child] = target if target != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def step(self, state, token):
+        """Advance from state on token, returns the new state."""
+        while state and token not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(token, 0)
+
+    def scan(self, tokens):
+        """Yield (phrase index, start position) for every match, in order of match end."""
+        state = 0
+        for i, token in enumerate(tokens):
+            state = self.step(state, token)
+            for idx, length in self.out[state]:
+                yield idx, i - length + 1
+
+
+class BatchQuery(object):
+    """
+    Match many search texts against a document in a single pass.  Plain
+    phrases go through a PhraseAutomaton, proximity queries have their term
+    positions collected during the same pass.
+    """
+    def __init__(self, search_texts):
+        self.queries = [parse_query(text) for text in search_texts]
+        self.phrase_idx = [i for i, q in enumerate(self.queries) if not q.operators]
+        self.automaton = PhraseAutomaton([self.queries[i].operands[0] for i in self.phrase_idx])
+        self.prox_idx = [i for i, q in enumerate(self.queries) if q.operators]
+        self.prox_terms = set()
+        for i in self.prox_idx:
+            self.prox_terms.update(self.queries[i].terms)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def match(self, clean_tokens):
+        """Return a list of sorted position tuples per query, in query order."""
+        results = [[] for q in self.queries]
+        term_pos = dict((term, []) for term in self.prox_terms)
+        automaton = self.automaton
+        state = 0
+        for i, token in enumerate(clean_tokens):
+            if token in term_pos:
+                term_pos[token].append(i)
+            state = automaton.step(state, token)
+            for idx, length in automaton.out[state]:
+                start = i - length + 1
+                results[self.phrase_idx[idx]].append(tuple(xrange(start, i + 1)))
+        for i in self.prox_idx:
+            results[i] = self.queries[i].match(term_pos)
+        return results
@@ -2,74 +2,122 @@ import csv
 import os
 import sys
 import string
-import itertools
-import subprocess
-import glob
 import xlsxwriter
 import codecs
+import time
+import multiprocessing
+from collections import deque
 import pprint as pp
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import filescan
+import phrasematch
+try:
+    import _speedups  # compiled inner loops, see cythontest.py
+except ImportError:
+    _speedups = None
 
+#Use translate to remove digits and punctuation
+#transmap = string.maketrans(string.letters, string.letters)
+#delchars = string.digits + string.punctuation.replace('-', '')
+DELMAP = {ord(char): None for char in string.digits + string.punctuation.replace('-', '')}  # unicode mapping
+BLOCKSIZE = 1 << 20  # characters read per block when streaming
 
-def gather_files(targetdir, filtr=''):
-    def gather_windows(targetdir, filtr):
-        result = []
-        if filtr:
-            targetdir = targetdir.rstrip('\\"') + '\\' + filtr
-        targetdir = targetdir.rstrip('\\"')
-        dirargs = ['dir', targetdir, '/S', '/B', '/A-D']
-        proc = subprocess.Popen(dirargs, shell=True, stdout=subprocess.PIPE, bufsize=1)
-        for dirline in iter(proc.stdout.readline, b''):
-            result.append(dirline.strip())
-        proc.communicate()
-        return result
 
-    def gather_linux(targetdir, filtr=None):
-        result = []
-        if not filtr:
-            filtr = '*.*'
-        for root, dirs, files in os.walk(targetdir):
-            globstr = os.path.join(root, filtr)
-            result.extend(glob.glob(globstr))
-        return result
+def gather_files(targetdir, filtr='', cachepath=None, threads=1):
+    """
+    List all files under targetdir, optionally matching the filename pattern filtr
+    e.g. '*.txt'.  See filescan.gather for the cache and threads options.
+    """
+    return filescan.gather(targetdir.rstrip('\\"'), pattern=filtr or None,
+                           cachepath=cachepath, threads=threads)
 
-    if os.name is 'nt':
-        return gather_windows(targetdir, filtr)
-    else:
-        return gather_linux(targetdir, filtr)
+
+def doc_id(txtpath, rootpath):
+    """
+    A document's id, its path under rootpath without the extension, so the
+    same file name in two custodian folders gives two documents.
+    """
+    return os.path.splitext(os.path.relpath(txtpath, rootpath))[0]
 
 
 def tokenize_txt(txtpath):
     with codecs.open(txtpath, encoding='utf8') as infile:
         raw_tokens = infile.read().split()
-    #Use translate to remove digits and punctuation
-    #transmap = string.maketrans(string.letters, string.letters)
-    #delchars = string.digits + string.punctuation.replace('-', '')
-    delmap = {ord(char): None for char in string.digits + string.punctuation.replace('-', '')}  # unicode mapping
-    clean_tokens = [token.translate(delmap).lower() for token in raw_tokens]
+    clean_tokens = clean_token_list(raw_tokens)
     return raw_tokens, clean_tokens
 
 
+def py_clean_token_list(raw_tokens):
+    """Strip digits and punctuation (except -) from each token and lowercase it."""
+    return [token.translate(DELMAP).lower() for token in raw_tokens]
+
+
+def iter_tokens(txtpath, blocksize=BLOCKSIZE):
+    """
+    Stream a text file as (position, raw token, clean token) tuples, reading
+    blocksize characters at a time.  Tokens are the same as tokenize_txt's, a token
+    cut by a block boundary is carried over and joined to the next block.
+    """
+    pos = 0
+    carry = u''
+    with codecs.open(txtpath, encoding='utf8') as infile:
+        while True:
+            block = infile.read(blocksize)
+            if not block:
+                break
+            block = carry + block
+            tokens = block.split()
+            carry = tokens.pop() if tokens and not block[-1].isspace() else u''
+            for raw in tokens:
+                yield pos, raw, raw.translate(DELMAP).lower()
+                pos += 1
+    if carry:
+        yield pos, carry, carry.translate(DELMAP).lower()
+
+
 def position_match(term_positions):
-    def contiguous(pos_set):
-        for x in enumerate(pos_set):
-            try:
-                if x[1] + 1 != pos_set[x[0] + 1]:
-                    return False
-            except IndexError:
-                pass
-        return True
+    """
+    Return a tuple of positions for each place the terms appear contiguously and in order.
+    term_positions is a sorted position list per search term.
+    """
+    return phrasematch.phrase_match(term_positions)
+
+
+def py_term_positions(search_tokens, clean_tokens):
+    """
+    Collect the positions of every search token in a single pass over the document.
+    Returns one sorted position list per search token, in search token order.
+    """
+    positions = dict((term, []) for term in search_tokens)
+    for i, token in enumerate(clean_tokens):
+        if token in positions:
+            positions[token].append(i)
+    return [positions[term] for term in search_tokens]
+
 
-    pos_sets = itertools.product(*term_positions)
-    return [pos_set for pos_set in pos_sets if contiguous(pos_set)]
+if _speedups is not None:
+    clean_token_list = _speedups.clean_token_list
+    term_positions = _speedups.term_positions
+else:
+    clean_token_list = py_clean_token_list
+    term_positions = py_term_positions
 
 
 def gen_snippet(search_text, raw_tokens, clean_tokens, width=10):
-    search_text = search_text.lower().split()
-    term_pos = []
-    for term in search_text:
-        positions = [t[0] for t in enumerate(clean_tokens) if t[1] == term]
-        term_pos.append(positions)
-    final_postitions = position_match(term_pos)
+    """
+    Return Snippets for every hit on search_text in the document.  search_text is
+    a phrase, optionally with w/N and pre/N proximity operators (see phrasematch).
+    """
+    query = phrasematch.parse_query(search_text)
+    term_pos = term_positions(query.terms, clean_tokens)
+    final_postitions = query.match(dict(zip(query.terms, term_pos)))
+    return snippets_at(query.tokens, raw_tokens, final_postitions, width)
+
+
+def snippets_at(search_tokens, raw_tokens, final_postitions, width=10):
+    """
+    Build Snippet objects around already matched position sets in a document.
+    """
     snippets = []
     for pos in final_postitions:
         #print pos[0], pos[-1]
@@ -77,12 +125,174 @@ def gen_snippet(search_text, raw_tokens, clean_tokens, width=10):
         upper = pos[-1] + width + 1 if pos[-1] + width < len(raw_tokens) else len(raw_tokens)
         #print lower, upper, '\n'
         snippets.append(Snippet(raw_tokens[lower:upper],
-                                search_text=' '.join(search_text),
+                                search_text=' '.join(search_tokens),
                                 width=width,
                                 term_pos=[p - lower for p in pos]))  # Realign the position for the smaller snippet
     return snippets
 
 
+def batch_snippets(batch, raw_tokens, clean_tokens, width=10):
+    """
+    Return a list of Snippets per search text for a phrasematch.BatchQuery, all
+    search texts are matched in one pass over the document.
+    """
+    return [snippets_at(query.tokens, raw_tokens, positions, width)
+            for query, positions in zip(batch.queries, batch.match(clean_tokens))]
+
+
+def document_snippets(batch, txtpath, width=10, stream=False):
+    """
+    Return a list of Snippets per search text for one document, either tokenized
+    whole or streamed through stream_snippets.
+    """
+    if not stream:
+        rawt, cleant = tokenize_txt(txtpath)
+        return batch_snippets(batch, rawt, cleant, width)
+    doc_snippets = [[] for q in batch.queries]
+    for idx, snip in stream_snippets(batch, txtpath, width):
+        doc_snippets[idx].append(snip)
+    return doc_snippets
+
+
+def scan_documents(batch, txtfiles, width=10, stream=False):
+    """
+    Serially tokenize and search each (docid, txtpath).  Yields
+    (docid, seconds, list of Snippets per search text).
+    """
+    for docid, txtfile in txtfiles:
+        scanstart = time.time()
+        doc_snippets = document_snippets(batch, txtfile, width, stream)
+        yield docid, time.time() - scanstart, doc_snippets
+
+
+_worker_batch = None
+_worker_width = 10
+_worker_stream = False
+
+
+def _init_search_worker(search_texts, width, stream=False):
+    """Pool initializer, builds the BatchQuery once per worker process."""
+    global _worker_batch, _worker_width, _worker_stream
+    _worker_batch = phrasematch.BatchQuery(search_texts)
+    _worker_width = width
+    _worker_stream = stream
+
+
+def _search_worker(task):
+    """
+    Search one document in a pool worker.  Only compact
+    (search index, snippet tokens, term positions) tuples go back to the parent,
+    never the document's token lists.
+    """
+    docid, txtfile = task
+    scanstart = time.time()
+    hits = []
+    for i, snippets in enumerate(document_snippets(_worker_batch, txtfile,
+                                                   _worker_width, _worker_stream)):
+        for snip in snippets:
+            hits.append((i, tuple(snip.snip), tuple(snip.term_pos)))
+    return docid, time.time() - scanstart, hits
+
+
+def scan_documents_parallel(search_texts, txtfiles, width=10, processes=None,
+                            chunksize=16, ordered=True, stream=False):
+    """
+    Tokenize and search the (docid, txtpath) list across a process pool, files are
+    dispatched to workers chunksize at a time.  Yields the same
+    (docid, seconds, list of Snippets per search text) as scan_documents, in
+    txtfiles order if ordered is set, otherwise as each document completes.
+    """
+    batch = phrasematch.BatchQuery(search_texts)
+    pool = multiprocessing.Pool(processes, _init_search_worker, (search_texts, width, stream))
+    try:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        for docid, seconds, hits in mapper(_search_worker, txtfiles, chunksize):
+            doc_snippets = [[] for q in batch.queries]
+            for i, snip, term_pos in hits:
+                doc_snippets[i].append(Snippet(list(snip),
+                                               search_text=' '.join(batch.queries[i].tokens),
+                                               width=width,
+                                               term_pos=list(term_pos)))
+            yield docid, seconds, doc_snippets
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def read_terms(termpath):
+    """
+    Read a search term list, one phrase or proximity search per line.  Blank lines
+    and duplicates are skipped.
+    """
+    terms = []
+    with codecs.open(termpath, encoding='utf-8-sig') as termfh:
+        for line in termfh:
+            line = ' '.join(line.split())
+            if line and line not in terms:
+                terms.append(line)
+    return terms
+
+
+def sheet_name(term, used):
+    """
+    Make a valid, unique excel worksheet name from a search term.  Excel limits
+    names to 31 characters and disallows []:*?/\\
+    """
+    name = ''.join(c for c in term if c not in '[]:*?/\\')[:31].strip() or 'Term'
+    base, cnt = name, 1
+    while name.lower() in used:
+        cnt += 1
+        suffix = ' (%s)' % cnt
+        name = base[:31 - len(suffix)] + suffix
+    used.add(name.lower())
+    return name
+
+
+def stream_snippets(batch, txtpath, width=10, blocksize=BLOCKSIZE):
+    """
+    Search a text file without holding it in memory.  Tokens from iter_tokens run
+    through the batch's phrase automaton while a ring buffer keeps only the raw
+    tokens a new hit needs for its leading context, open snippets collect their
+    trailing context as the stream moves on.  Yields (search index, Snippet) as
+    each snippet completes, the Snippets are the same ones gen_snippet makes.
+    Only plain phrases are supported, proximity searches need the whole document.
+    """
+    if batch.prox_idx:
+        raise ValueError('Streaming search does not support proximity operators: %s' %
+                         ', '.join(repr(batch.queries[i]) for i in batch.prox_idx))
+    if not batch.queries:
+        return
+    automaton = batch.automaton
+    longest = max(len(q.tokens) for q in batch.queries)
+    ring = deque(maxlen=width + longest)
+    pending = deque()  # [search index, snip tokens, term_pos, tokens still wanted]
+    state = 0
+    for pos, raw, clean in iter_tokens(txtpath, blocksize):
+        for opensnip in pending:
+            opensnip[1].append(raw)
+            opensnip[3] -= 1
+        while pending and pending[0][3] == 0:
+            idx, snip, term_pos, wanted = pending.popleft()
+            yield idx, Snippet(snip, ' '.join(batch.queries[idx].tokens), width, term_pos)
+        ring.append(raw)
+        state = automaton.step(state, clean)
+        for autoidx, length in automaton.out[state]:
+            idx = batch.phrase_idx[autoidx]
+            start = pos - length + 1
+            lower = start - width if start - width > 0 else 0
+            snip = list(ring)[lower - pos - 1:]
+            term_pos = range(start - lower, pos - lower + 1)
+            if width:
+                pending.append([idx, snip, term_pos, width])
+            else:
+                yield idx, Snippet(snip, ' '.join(batch.queries[idx].tokens), width, term_pos)
+    for idx, snip, term_pos, wanted in pending:  # end of file cuts the trailing context short
+        yield idx, Snippet(snip, ' '.join(batch.queries[idx].tokens), width, term_pos)
+
+
 class Snippet(object):
     def __init__(self, snip, search_text='', width=10, term_pos=(0, 0, 0)):
         self.snip = snip
@@ -104,7 +314,10 @@ class Snippet(object):
         """
         result = [' '.join(self.snip[:self.term_pos[0]])]
         result.append(excel_format)
-        result.append(self.search_text)
+        if phrasematch.is_phrase(self.search_text):
+            result.append(self.search_text)
+        else:  # proximity hit, highlight the whole span between the terms
+            result.append(' '.join(self.snip[self.term_pos[0]:self.term_pos[-1]+1]))
         result.append(' '.join(self.snip[self.term_pos[-1]+1:]))
         return result
 
@@ -123,28 +336,114 @@ class Excelfile(object):
         self.workbook.close()
 
 
+def write_snippets(ws, rowcnt, docid, snippets, excel_format):
+    """
+    Write a document's snippets to a DocID/Snippet worksheet after row rowcnt.
+    Returns the last row written.
+    """
+    for snip in snippets:
+        rowcnt += 1
+        cellA, cellB = 'A' + str(rowcnt), 'B' + str(rowcnt)
+        ws.write(cellA, docid)
+        ws.write_rich_string(cellB, *snip.term_highlight(excel_format))
+    return rowcnt
+
+
+def new_snippet_sheet(excel, name=None):
+    ws = excel.add_worksheet(name)
+    ws.write('A1', 'DocID')
+    ws.write('B1', 'Snippet')
+    return ws
+
+
 if __name__ == '__main__':
-    cnt = 0
-    rowcnt = 1
-    inpath = sys.argv[1]
-    txtfiles = gather_files(inpath)
-    txtfiles = [(os.path.split(os.path.splitext(p)[0])[1], p) for p in txtfiles]
-
-    with Excelfile('test.xlsx') as excel:
-        ws = excel.add_worksheet()
+    import argparse
+
+    parser = argparse.ArgumentParser(description=
+                        'Search a folder of text files and write the hits in context to excel')
+    parser.add_argument('inpath', action='store',
+                        help='folder root to search for text files')
+    parser.add_argument('-search', '-s', action='store', default='Due Diligence',
+                        help='phrase to search for')
+    parser.add_argument('-terms', '-t', action='store', default=None,
+                        help='file of search terms, one per line, each gets its own worksheet')
+    parser.add_argument('-out', '-o', action='store', default='test.xlsx',
+                        help='excel file to write the snippets to')
+    parser.add_argument('-width', '-w', action='store', type=int, default=10,
+                        help='number of words of context either side of a hit')
+    parser.add_argument('-index', '-i', action='store', default=None,
+                        help='positional index file, built on first use then reused')
+    parser.add_argument('-p', action='store', dest='num_workers', type=int, default=1,
+                        help='number of worker processes for tokenizing and searching, default 1')
+    parser.add_argument('-chunk', action='store', type=int, default=16,
+                        help='files handed to a worker at a time, default 16')
+    parser.add_argument('-unordered', action='store_true', default=False,
+                        help='write documents as workers finish rather than in file order, flag')
+    parser.add_argument('-stream', action='store_true', default=False,
+                        help='stream each file instead of reading it whole, for very large text files.'
+                             ' Phrases only, no proximity searches, flag')
+    args = parser.parse_args()
+
+    search_texts = [args.search] if args.terms is None else read_terms(args.terms)
+    txtfiles = None
+    if args.index is None or not os.path.exists(args.index):  # an existing index needs no rescan
+        txtfiles = gather_files(args.inpath)
+        txtfiles = [(doc_id(p, args.inpath), p) for p in txtfiles]
+    index = None
+    if args.index is not None:
+        import textindex
+        index = textindex.open_index(args.index, txtfiles)
+
+    with Excelfile(args.out) as excel:
         bold = excel.add_format({'bold': True})
-        ws.write('A1', 'DocID')
-        ws.write('B1', 'Snippet')
-        for docid, txtfile in txtfiles:
-            cnt += 1
-            if cnt % 30 == 0: print cnt
-            print docid
-            rawt, cleant = tokenize_txt(txtfile)
-            snippets = gen_snippet('Due Diligence', rawt, cleant)
-            for snip in snippets:
-                rowcnt += 1
-                cellA, cellB = 'A' + str(rowcnt), 'B' + str(rowcnt)
-                ws.write(cellA, docid)
-                ws.write_rich_string(cellB, *snip.term_highlight(bold))
+        if args.terms is not None:
+            summary = excel.add_worksheet('Summary')
+            used = set(['summary'])
+            sheets = [new_snippet_sheet(excel, sheet_name(text, used)) for text in search_texts]
+        else:
+            sheets = [new_snippet_sheet(excel)]
+        rowcnts = [1] * len(search_texts)
+        hitcnts = [0] * len(search_texts)
+        doccnts = [0] * len(search_texts)
+        termtimes = [0.0] * len(search_texts)
+        scantime = 0.0
 
+        if index is not None:
+            for i, text in enumerate(search_texts):
+                termstart = time.time()
+                hits = index.search_phrase(text, args.width)
+                for docid, snip in hits:
+                    rowcnts[i] = write_snippets(sheets[i], rowcnts[i], docid, [snip], bold)
+                hitcnts[i] = len(hits)
+                doccnts[i] = len(set(docid for docid, snip in hits))
+                termtimes[i] = time.time() - termstart
+        else:
+            if args.num_workers > 1:
+                results = scan_documents_parallel(search_texts, txtfiles, args.width,
+                                                  args.num_workers, args.chunk,
+                                                  ordered=not args.unordered, stream=args.stream)
+            else:
+                results = scan_documents(phrasematch.BatchQuery(search_texts), txtfiles,
+                                         args.width, args.stream)
+            for cnt, (docid, seconds, doc_snippets) in enumerate(results, 1):
+                if cnt % 30 == 0: print cnt
+                print docid
+                scantime += seconds
+                for i, snippets in enumerate(doc_snippets):
+                    if not snippets:
+                        continue
+                    rowcnts[i] = write_snippets(sheets[i], rowcnts[i], docid, snippets, bold)
+                    hitcnts[i] += len(snippets)
+                    doccnts[i] += 1
 
+        if args.terms is not None:
+            summary.write_row('A1', ['Search Term', 'Hits', 'Documents', 'Seconds'], bold)
+            for i, text in enumerate(search_texts):
+                # a scan has no per term time, its one pass is the row below
+                summary.write_row('A' + str(i + 2), [text, hitcnts[i], doccnts[i],
+                                                     termtimes[i] if index is not None else ''])
+            if index is None:  # one pass matched every term, its time can't be split per term
+                summary.write_row('A' + str(len(search_texts) + 2),
+                                  ['(tokenize and match, all terms)', sum(hitcnts), '', scantime])
+                if args.num_workers > 1:  # scantime is summed across the workers
+                    summary.write('E' + str(len(search_texts) + 2), 'worker seconds')
@@ -1 +1,265 @@
+"""
+Corpus term statistics for building search term proposals.
+
+Counts are kept as a scipy.sparse document x term matrix.  Documents are
+tokenized with snippets.tokenize_txt and counted a batch at a time with numpy:
+each batch's tokens are uniqued once, only the unique terms are looked up in
+the vocabulary, and the per document counts come from summing duplicate
+(row, column) entries in a sparse matrix.  New documents can be added to a
+saved set of statistics without recounting the old ones.
+"""
+from __future__ import print_function
+import os
+import csv
+import numpy as np
+import scipy.sparse as sp
+
+import snippets
+
 __author__ = 'tom'
+
+MAX_TERM_LEN = 40  # longer tokens are OCR noise, not search terms
+
+
+class TermStats(object):
+    """
+    Term frequency (tf), document frequency (df) and tf-idf over a corpus.
+
+    Attributes:
+        terms- list of terms, the column labels.
+        docids- list of document ids, the row labels.  From the command line
+            a document's id is its path under the root without the extension,
+            so files with the same name in different folders are kept apart.
+        custodians- custodian of each document row.
+    """
+    def __init__(self):
+        self.vocab = {}
+        self.terms = []
+        self.docids = []
+        self.custodians = []
+        self._docset = set()
+        self._blocks = []  # csr matrices of document rows, as few columns as existed when counted
+        self._tf = None
+
+    def __len__(self):
+        return len(self.docids)
+
+    def __contains__(self, docid):
+        return docid in self._docset
+
+    def add_documents(self, txtfiles, custodian=None, batchsize=500, maxlen=MAX_TERM_LEN):
+        """
+        Count a list of (docid, txtpath) pairs, batchsize documents at a time.
+        Documents already counted are skipped.  Returns the number added.
+        """
+        batch = []
+        added = 0
+        for docid, txtpath in txtfiles:
+            if docid in self._docset:
+                continue
+            self._docset.add(docid)
+            clean_tokens = snippets.tokenize_txt(txtpath)[1]
+            batch.append((docid, [t for t in clean_tokens if t and len(t) <= maxlen]))
+            if len(batch) >= batchsize:
+                added += self._count_batch(batch, custodian)
+                batch = []
+        if batch:
+            added += self._count_batch(batch, custodian)
+        return added
+
+    def add_tokens(self, docid, clean_tokens, custodian=None, maxlen=MAX_TERM_LEN):
+        """Count a single already tokenized document, skipped if already counted.
+        Returns the number added, 0 or 1.
+        """
+        if docid in self._docset:
+            return 0
+        self._docset.add(docid)
+        return self._count_batch([(docid, [t for t in clean_tokens if t and len(t) <= maxlen])],
+                                 custodian)
+
+    def _count_batch(self, batch, custodian):
+        lengths = np.array([len(tokens) for docid, tokens in batch], dtype=np.int64)
+        alltokens = [t for docid, tokens in batch for t in tokens]
+        if alltokens:
+            uniq, inverse = np.unique(np.array(alltokens, dtype=np.unicode_), return_inverse=True)
+            colmap = np.array([self._intern(term) for term in uniq], dtype=np.int32)
+            cols = colmap[inverse]
+        else:
+            cols = np.zeros(0, dtype=np.int32)
+        rows = np.repeat(np.arange(len(batch), dtype=np.int32), lengths)
+        counts = sp.coo_matrix((np.ones(len(cols), dtype=np.int32), (rows, cols)),
+                               shape=(len(batch), len(self.terms))).tocsr()  # sums duplicates
+        self._blocks.append(counts)
+        self.docids.extend(docid for docid, tokens in batch)
+        self.custodians.extend([custodian] * len(batch))
+        self._tf = None
+        return len(batch)
+
+    def _intern(self, term):
+        term = unicode(term)
+        try:
+            return self.vocab[term]
+        except KeyError:
+            self.vocab[term] = len(self.terms)
+            self.terms.append(term)
+            return self.vocab[term]
+
+    @property
+    def tf(self):
+        """Document x term count matrix, csr."""
+        if self._tf is None:
+            ncols = len(self.terms)
+            blocks = [sp.csr_matrix((b.data, b.indices, b.indptr), shape=(b.shape[0], ncols))
+                      for b in self._blocks]
+            if blocks:
+                self._tf = sp.vstack(blocks, format='csr')
+            else:
+                self._tf = sp.csr_matrix((0, ncols), dtype=np.int32)
+            self._blocks = [self._tf]  # later additions stack onto the merged matrix
+        return self._tf
+
+    @property
+    def df(self):
+        """Number of documents containing each term."""
+        return np.bincount(self.tf.indices, minlength=len(self.terms))
+
+    @property
+    def corpus_tf(self):
+        """Total occurrences of each term across the corpus."""
+        return np.asarray(self.tf.sum(axis=0)).ravel()
+
+    def idf(self):
+        """Inverse document frequency, log(N / df)."""
+        df = self.df
+        return np.log(float(len(self.docids)) / np.maximum(df, 1))
+
+    def tfidf(self):
+        """Document x term tf-idf matrix, csr."""
+        return scale_columns(self.tf, self.idf())
+
+    def custodian_tf(self):
+        """
+        Sum document rows by custodian.  Returns (custodian names, custodian x
+        term count matrix).
+        """
+        names = sorted(set(self.custodians))
+        nameidx = dict((name, i) for i, name in enumerate(names))
+        rows = np.array([nameidx[c] for c in self.custodians], dtype=np.int32)
+        grouping = sp.csr_matrix((np.ones(len(rows), dtype=np.int32),
+                                  (rows, np.arange(len(rows), dtype=np.int32))),
+                                 shape=(len(names), len(rows)))
+        return names, (grouping * self.tf).tocsr()
+
+    def top_terms(self, matrix, labels, topn=25):
+        """
+        Yield (label, rank, term, score) for the topn highest scoring terms in
+        each row of a csr matrix.
+        """
+        for row, label in enumerate(labels):
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            scores = matrix.data[start:end]
+            cols = matrix.indices[start:end]
+            best = np.argsort(-scores, kind='mergesort')[:topn]
+            for rank, i in enumerate(best, 1):
+                yield label, rank, self.terms[cols[i]], scores[i]
+
+    def save(self, statspath):
+        """Save the statistics in numpy .npz format for later incremental updates.
+        statspath is used as given, np.savez would add .npz to a bare path.
+        """
+        tf = self.tf
+        with open(statspath, 'wb') as statsfh:
+            np.savez(statsfh, terms=np.array(self.terms, dtype=np.unicode_),
+                     docids=np.array(self.docids, dtype=np.unicode_),
+                     custodians=np.array([c or u'' for c in self.custodians], dtype=np.unicode_),
+                     data=tf.data, indices=tf.indices, indptr=tf.indptr,
+                     shape=np.array(tf.shape))
+
+    @classmethod
+    def load(cls, statspath):
+        stored = np.load(statspath)
+        stats = cls()
+        stats.terms = [unicode(t) for t in stored['terms']]
+        stats.vocab = dict((t, i) for i, t in enumerate(stats.terms))
+        stats.docids = [unicode(d) for d in stored['docids']]
+        stats._docset = set(stats.docids)
+        stats.custodians = [unicode(c) or None for c in stored['custodians']]
+        stats._blocks = [sp.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                       shape=tuple(stored['shape']))]
+        return stats
+
+
+def scale_columns(matrix, weights):
+    """Multiply each column of a csr matrix by its weight, returns a float csr."""
+    if not len(weights):  # no terms, sp.diags can't build an empty diagonal
+        return sp.csr_matrix(matrix.shape, dtype=np.float64)
+    return (matrix.astype(np.float64) * sp.diags(weights)).tocsr()
+
+
+def write_rows(csvpath, header, rows):
+    with open(csvpath, 'wb') as outcsv:
+        report = csv.writer(outcsv, dialect='excel')
+        report.writerow(header)
+        for row in rows:
+            report.writerow([x.encode('utf8') if isinstance(x, unicode) else x for x in row])
+
+
+def custodian_of(txtpath, rootpath):
+    """The first folder under the root, e.g. root\\Smith\\docs\\1.txt -> Smith."""
+    relpath = os.path.relpath(txtpath, rootpath)
+    parts = relpath.split(os.sep)
+    return parts[0] if len(parts) > 1 else None
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from collections import defaultdict
+
+    parser = argparse.ArgumentParser(description=
+                        'Term frequency, document frequency and tf-idf reports for a folder of text')
+    parser.add_argument('rootpath', action='store',
+                        help='folder root to search for text files, subfolders are custodians')
+    parser.add_argument('-stats', action='store', default=None,
+                        help='.npz statistics file, new documents are added to it if it exists')
+    parser.add_argument('-top', action='store', type=int, default=25,
+                        help='number of top terms per document and custodian, default 25')
+    parser.add_argument('-score', action='store', choices=['tf', 'tfidf'], default='tfidf',
+                        help='score used to rank the top terms, default tfidf')
+    parser.add_argument('-out', action='store', default='TermFreq',
+                        help='prefix for the csv reports')
+    args = parser.parse_args()
+
+    starttime = time.time()
+    stats = TermStats()
+    if args.stats is not None and os.path.exists(args.stats):
+        stats = TermStats.load(args.stats)
+    before = len(stats)
+
+    bycustodian = defaultdict(list)
+    for txtpath in snippets.gather_files(args.rootpath):
+        bycustodian[custodian_of(txtpath, args.rootpath)].append(
+            (snippets.doc_id(txtpath, args.rootpath), txtpath))
+    for custodian, txtfiles in sorted(bycustodian.items()):
+        stats.add_documents(txtfiles, custodian)
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('%s documents counted (%s new), %s terms: %s' %
+          (len(stats), len(stats) - before, len(stats.terms), ctime))
+    if args.stats is not None:
+        stats.save(args.stats)
+
+    idf = stats.idf()
+    write_rows(args.out + '_corpus.csv', ['Term', 'Occurrences', 'Documents', 'IDF'],
+               sorted(zip(stats.terms, stats.corpus_tf, stats.df, idf),
+                      key=lambda x: -x[1]))
+    docscores = stats.tfidf() if args.score == 'tfidf' else stats.tf
+    write_rows(args.out + '_bydoc.csv', ['DocID', 'Rank', 'Term', args.score],
+               stats.top_terms(docscores, stats.docids, args.top))
+    names, custtf = stats.custodian_tf()
+    if args.score == 'tfidf':
+        custtf = scale_columns(custtf, idf)
+    write_rows(args.out + '_bycustodian.csv', ['Custodian', 'Rank', 'Term', args.score],
+               stats.top_terms(custtf, names, args.top))
+
+    ctime = '%d:%.1f' % divmod(time.time() - starttime, 60)
+    print('Complete:', ctime)
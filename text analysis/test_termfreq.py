@@ -0,0 +1,44 @@
+"""
+Tests for termfreq, run with python -m unittest discover from this folder.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import termfreq
+
+
+class SaveLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_txt(self, name, text):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as txtfh:
+            txtfh.write(text)
+        return path
+
+    def test_incremental_update_through_a_path_without_extension(self):
+        first = self.write_txt('1.txt', 'loan default notice')
+        second = self.write_txt('2.txt', 'loan payment letter')
+        statspath = os.path.join(self.root, 'corpus.stats')
+
+        stats = termfreq.TermStats()
+        self.assertEqual(stats.add_documents([('1', first)]), 1)
+        stats.save(statspath)
+        self.assertTrue(os.path.exists(statspath))
+        self.assertFalse(os.path.exists(statspath + '.npz'))
+
+        stats = termfreq.TermStats.load(statspath)
+        self.assertEqual(stats.add_documents([('1', first), ('2', second)]), 1)
+        self.assertEqual(stats.docids, [u'1', u'2'])
+        self.assertEqual(stats.corpus_tf[stats.vocab[u'loan']], 2)
+        self.assertEqual(stats.df[stats.vocab[u'payment']], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
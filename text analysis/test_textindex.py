@@ -0,0 +1,40 @@
+"""
+Tests for textindex, run with python -m unittest discover from this folder.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import snippets
+import textindex
+
+
+class OpenIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for custodian, text in (('Smith', u'the loan default notice'),
+                                ('Jones', u'a second loan default letter')):
+            os.mkdir(os.path.join(self.root, custodian))
+            with open(os.path.join(self.root, custodian, '1.txt'), 'wb') as txtfh:
+                txtfh.write(text.encode('utf8'))
+        self.indexpath = os.path.join(self.root, 'corpus.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_same_file_name_in_two_folders(self):
+        txtfiles = [(snippets.doc_id(p, self.root), p)
+                    for p in snippets.gather_files(self.root, '*.txt')]
+        index = textindex.open_index(self.indexpath, txtfiles)
+        expected = sorted([os.path.join('Jones', '1'), os.path.join('Smith', '1')])
+        self.assertEqual(sorted(index.docpaths), expected)
+        hits = index.search_phrase('loan default', 2)
+        self.assertEqual(sorted(docid for docid, snip in hits), expected)
+
+        reloaded = textindex.open_index(self.indexpath)
+        self.assertEqual(sorted(reloaded.docpaths), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Persistent positional inverted index over a text corpus.
+
+The index maps each clean token to the documents it occurs in and the sorted
+token positions within each document, so a search only has to re-read the
+text files that actually contain every search term.
+"""
+import os
+import cPickle
+from array import array
+
+import snippets
+import phrasematch
+
+INDEX_VERSION = 1
+
+
+class PositionalIndex(object):
+    """
+    term -> {docid: array('I') of token positions}, plus the source path
+    of each indexed document so snippets can be cut from the raw text.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.docpaths = {}
+
+    def __len__(self):
+        return len(self.docpaths)
+
+    def __contains__(self, docid):
+        return docid in self.docpaths
+
+    def add_document(self, docid, txtpath, clean_tokens=None):
+        """
+        Index a single document.  clean_tokens can be passed in if the
+        document has already been tokenized.
+        """
+        if docid in self.docpaths:
+            raise KeyError('Document %s is already indexed' % docid)
+        if clean_tokens is None:
+            clean_tokens = snippets.tokenize_txt(txtpath)[1]
+        docpositions = {}
+        for i, token in enumerate(clean_tokens):
+            if not token:  # token was all digits/punctuation
+                continue
+            try:
+                docpositions[token].append(i)
+            except KeyError:
+                docpositions[token] = array('I', [i])
+        for token, positions in docpositions.iteritems():
+            self.postings.setdefault(token, {})[docid] = positions
+        self.docpaths[docid] = txtpath
+
+    def build(self, txtfiles, progress=None):
+        """
+        Index a list of (docid, txtpath) pairs.  progress is an optional
+        callable that gets the running document count.
+        """
+        for cnt, (docid, txtpath) in enumerate(txtfiles, 1):
+            self.add_document(docid, txtpath)
+            if progress is not None:
+                progress(cnt)
+
+    def term_docs(self, term):
+        """Return the {docid: positions} postings for a single clean term."""
+        return self.postings.get(term, {})
+
+    def candidate_docs(self, search_tokens):
+        """
+        Return the sorted docids that contain every one of search_tokens,
+        intersecting the rarest postings first.
+        """
+        postings = sorted((self.term_docs(t) for t in set(search_tokens)), key=len)
+        if not postings or not postings[0]:
+            return []
+        docs = set(postings[0])
+        for termdocs in postings[1:]:
+            docs.intersection_update(termdocs)
+            if not docs:
+                break
+        return sorted(docs)
+
+    def search_phrase(self, search_text, width=10):
+        """
+        Find search_text in the indexed corpus.  Returns a list of
+        (docid, Snippet) pairs in docid order, the same snippets gen_snippet
+        produces for each document.  Proximity operators are supported.
+        """
+        query = phrasematch.parse_query(search_text)
+        results = []
+        for docid in self.candidate_docs(query.terms):
+            term_pos = dict((t, self.postings[t][docid]) for t in query.terms)
+            final_positions = query.match(term_pos)
+            if not final_positions:
+                continue
+            raw_tokens = snippets.tokenize_txt(self.docpaths[docid])[0]
+            for snip in snippets.snippets_at(query.tokens, raw_tokens, final_positions, width):
+                results.append((docid, snip))
+        return results
+
+    def save(self, indexpath):
+        with open(indexpath, 'wb') as indexfh:
+            cPickle.dump((INDEX_VERSION, self.docpaths, self.postings),
+                         indexfh, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, indexpath):
+        with open(indexpath, 'rb') as indexfh:
+            version, docpaths, postings = cPickle.load(indexfh)
+        if version != INDEX_VERSION:
+            raise ValueError('Index %s is version %s, expected %s' %
+                             (indexpath, version, INDEX_VERSION))
+        index = cls()
+        index.docpaths = docpaths
+        index.postings = postings
+        return index
+
+
+def open_index(indexpath, txtfiles=None):
+    """
+    Load the index at indexpath, or build it from txtfiles and save it there
+    if it doesn't exist yet.
+    """
+    if os.path.exists(indexpath):
+        return PositionalIndex.load(indexpath)
+    if txtfiles is None:
+        raise IOError('Index %s not found and no files given to build it' % indexpath)
+    index = PositionalIndex()
+    index.build(txtfiles)
+    index.save(indexpath)
+    return index
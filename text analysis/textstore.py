@@ -0,0 +1,192 @@
+"""
+Compact in-memory storage for a text corpus, so a whole custodian's documents
+can stay resident for interactive searching.
+
+Each document keeps its original text as one string, the clean tokens as an
+array of ids into a shared vocabulary, and the raw tokens as start/end offsets
+into the text.  Snippets are views onto a document that only build their text
+when it is asked for.
+"""
+from __future__ import print_function
+import re
+import codecs
+from array import array
+
+import snippets
+import phrasematch
+
+TOKEN_RE = re.compile(r'\S+', re.UNICODE)  # same tokens as unicode.split()
+
+
+class Vocabulary(object):
+    """Interns clean tokens to integer ids."""
+    def __init__(self):
+        self.ids = {}
+        self.terms = []
+
+    def __len__(self):
+        return len(self.terms)
+
+    def intern(self, term):
+        try:
+            return self.ids[term]
+        except KeyError:
+            self.ids[term] = len(self.terms)
+            self.terms.append(term)
+            return self.ids[term]
+
+    def lookup(self, term):
+        """Return the id for term, or None if it was never seen."""
+        return self.ids.get(term)
+
+
+class CompactDocument(object):
+    """
+    A tokenized document.
+
+    Fields:
+        docid- document identifier.
+        text- the full original text.
+        token_ids- array('I') of vocabulary ids, one per token.
+        starts, ends- array('L') offsets of each raw token in text.
+    """
+    __slots__ = ('docid', 'text', 'token_ids', 'starts', 'ends')
+
+    def __init__(self, docid, text, vocab):
+        self.docid = docid
+        self.text = text
+        self.token_ids = array('I')
+        self.starts = array('L')
+        self.ends = array('L')
+        for match in TOKEN_RE.finditer(text):
+            raw = match.group()
+            self.token_ids.append(vocab.intern(raw.translate(snippets.DELMAP).lower()))
+            self.starts.append(match.start())
+            self.ends.append(match.end())
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def raw_tokens(self, lower=0, upper=None):
+        """Materialize the raw tokens in [lower, upper)."""
+        if upper is None:
+            upper = len(self.token_ids)
+        text, starts, ends = self.text, self.starts, self.ends
+        return [text[starts[i]:ends[i]] for i in xrange(lower, upper)]
+
+    def term_positions(self, term_ids):
+        """One pass over the token ids, returns {term id: positions}."""
+        positions = dict((tid, []) for tid in term_ids)
+        for i, tid in enumerate(self.token_ids):
+            if tid in positions:
+                positions[tid].append(i)
+        return positions
+
+
+class SnippetView(snippets.Snippet):
+    """
+    A Snippet that only stores (doc, start, end).  The snippet tokens are
+    sliced from the document's text each time they are used.
+    """
+    def __init__(self, doc, start, end, search_text='', width=10, term_pos=(0, 0, 0)):
+        self.doc = doc
+        self.start = start
+        self.end = end
+        self.search_text = search_text
+        self.width = width
+        self.term_pos = term_pos
+
+    @property
+    def search_tokens(self):
+        return self.search_text.lower().split()
+
+    @property
+    def snip(self):
+        return self.doc.raw_tokens(self.start, self.end)
+
+
+class CompactCorpus(object):
+    """
+    Resident corpus of CompactDocuments sharing one Vocabulary, with a
+    term id -> array of document numbers map to skip documents that can't match.
+    """
+    def __init__(self):
+        self.vocab = Vocabulary()
+        self.docs = []
+        self.term_docs = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add_text(self, docid, text):
+        doc = CompactDocument(docid, text, self.vocab)
+        docnum = len(self.docs)
+        self.docs.append(doc)
+        for tid in set(doc.token_ids):
+            try:
+                self.term_docs[tid].append(docnum)
+            except KeyError:
+                self.term_docs[tid] = array('I', [docnum])
+        return doc
+
+    def add_document(self, docid, txtpath):
+        with codecs.open(txtpath, encoding='utf8') as infile:
+            return self.add_text(docid, infile.read())
+
+    def build(self, txtfiles):
+        """Load a list of (docid, txtpath) pairs."""
+        for docid, txtpath in txtfiles:
+            self.add_document(docid, txtpath)
+
+    def search(self, search_text, width=10):
+        """
+        Return (docid, SnippetView) pairs for every hit on search_text, which may
+        use the phrasematch proximity operators.
+        """
+        query = phrasematch.parse_query(search_text)
+        term_ids = [self.vocab.lookup(term) for term in query.terms]
+        if None in term_ids:
+            return []
+        docnums = set(self.term_docs[term_ids[0]])
+        for tid in term_ids[1:]:
+            docnums.intersection_update(self.term_docs[tid])
+        results = []
+        search_text = ' '.join(query.tokens)
+        for docnum in sorted(docnums):
+            doc = self.docs[docnum]
+            positions = doc.term_positions(term_ids)
+            term_pos = dict((term, positions[tid]) for term, tid in zip(query.terms, term_ids))
+            for pos in query.match(term_pos):
+                lower = pos[0] - width if pos[0] - width > 0 else 0
+                upper = pos[-1] + width + 1 if pos[-1] + width < len(doc) else len(doc)
+                results.append((doc.docid, SnippetView(doc, lower, upper, search_text, width,
+                                                       [p - lower for p in pos])))
+        return results
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import time
+
+    starttime = time.time()
+    txtfiles = snippets.gather_files(sys.argv[1])
+    corpus = CompactCorpus()
+    corpus.build((os.path.split(os.path.splitext(p)[0])[1], p) for p in txtfiles)
+    print('%s documents, %s terms loaded in %d:%.1f' %
+          ((len(corpus), len(corpus.vocab)) + divmod(time.time() - starttime, 60)))
+    while True:
+        try:
+            search_text = raw_input('search> ').decode(sys.stdin.encoding or 'utf8')
+        except EOFError:
+            break
+        if not search_text.strip():
+            continue
+        try:
+            hits = corpus.search(search_text)
+        except ValueError as e:
+            print(e)
+            continue
+        for docid, snip in hits:
+            print(docid, ':', ' '.join(snip.snip).encode('utf8'))
+        print(len(hits), 'hits')